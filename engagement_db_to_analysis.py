@@ -16,6 +16,23 @@ if __name__ == "__main__":
                         help="Path to a directory to use to cache results needed for incremental operation.")
     parser.add_argument("--export-large-files", action="store_true",
                         help="If set, will export/upload potential large files. Otherwise, only necessary files will be exported/uploaded.")
+    parser.add_argument("--full-provenance", action="store_true",
+                        help="If set, records TracedData Metadata for every update to every TracedData object, for "
+                             "auditing. Otherwise, records one Metadata per pipeline step, which is much faster.")
+    parser.add_argument("--imputation-workers", type=int, default=1,
+                        help="Number of worker processes to run the code imputations in, sharding the messages "
+                             "across the workers by participant. Defaults to 1.")
+    parser.add_argument("--regression-workers", type=int, default=1,
+                        help="Number of worker processes to run the experimental multiple-imputation regression "
+                             "analysis in, analysing the RQAs in parallel. Defaults to 1.")
+    parser.add_argument("--map-workers", type=int, default=1,
+                        help="Number of worker processes to draw the participation maps in, when exporting large "
+                             "files. Defaults to 1.")
+    parser.add_argument("--export-workers", type=int, default=1,
+                        help="Number of worker processes to run the automated analysis exporters in, running the "
+                             "independent analyses concurrently. Defaults to 1.")
+    parser.add_argument("--drive-upload-workers", type=int, default=1,
+                        help="Maximum number of Google Drive folders to upload files to at once. Defaults to 1.")
 
     parser.add_argument("user", help="Identifier of the user launching this program")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
@@ -35,6 +52,12 @@ if __name__ == "__main__":
     dry_run = args.dry_run
     incremental_cache_path = args.incremental_cache_path
     export_large_files = args.export_large_files
+    full_provenance = args.full_provenance
+    imputation_workers = args.imputation_workers
+    regression_workers = args.regression_workers
+    map_workers = args.map_workers
+    export_workers = args.export_workers
+    drive_upload_workers = args.drive_upload_workers
 
     user = args.user
     google_cloud_credentials_file_path = args.google_cloud_credentials_file_path
@@ -60,4 +83,6 @@ if __name__ == "__main__":
         exit(0)
 
     generate_analysis_files(user, google_cloud_credentials_file_path, pipeline_config, uuid_table, engagement_db, rapid_pro,
-                            membership_group_dir_path, output_dir, incremental_cache_path, dry_run, export_large_files)
+                            membership_group_dir_path, output_dir, incremental_cache_path, dry_run, export_large_files,
+                            full_provenance, imputation_workers, regression_workers, map_workers,
+                            export_workers, drive_upload_workers)
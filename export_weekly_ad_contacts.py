@@ -4,7 +4,8 @@ import importlib
 
 from core_data_modules.cleaners import Codes
 from core_data_modules.logging import Logger
-from core_data_modules.traced_data.io import TracedDataJsonIO
+
+from src.common.traced_data_jsonl import read_traced_data_jsonl
 
 log = Logger(__name__)
 
@@ -39,15 +40,14 @@ if __name__ == "__main__":
     opt_out_uuids = set()
     for path in traced_data_paths:
         log.info(f"Loading previous traced data from file '{path}'...")
-        with open(path) as f:
-            data = TracedDataJsonIO.import_jsonl_to_traced_data_iterable(f)
-        log.info(f"Loaded {len(data)} traced data objects")
-
-        for td in data:
+        loaded = 0
+        for td in read_traced_data_jsonl(path):
             if td["consent_withdrawn"] == Codes.TRUE:
                 opt_out_uuids.add(td["participant_uuid"])
 
             uuids.add(td["participant_uuid"])
+            loaded += 1
+        log.info(f"Loaded {loaded} traced data objects")
     log.info(f"Loaded {len(uuids)} uuids from TracedData (of which {len(opt_out_uuids)} uuids withdrew consent)")
     uuids = uuids - opt_out_uuids
     log.info(f"Proceeding with {len(uuids)} opt-in uuids")
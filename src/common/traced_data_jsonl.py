@@ -0,0 +1,114 @@
+import gzip
+import io
+import os
+import threading
+from itertools import islice
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data.io import TracedDataJsonIO
+
+log = Logger(__name__)
+
+
+def _open_text(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class BackgroundTracedDataJsonlExport:
+    def __init__(self, traced_data, export_path, chunk_size=1000):
+        """
+        Exports TracedData to a JSONL file on a background thread, so that later stages of the pipeline can continue
+        while the file is written.
+
+        The TracedData are serialized and written a chunk at a time, so only one chunk of serialized TracedData is held
+        in memory at once. If `export_path` ends in ".gz", the file is gzip-compressed as it is written. The file is
+        written to a temporary path and moved to `export_path` once complete, so `export_path` only ever contains a
+        complete export.
+
+        The TracedData must not be modified until the export has finished. Call `wait` to wait for the export to
+        finish, and to raise any error that occurred while exporting.
+
+        :param traced_data: TracedData to export.
+        :type traced_data: iterable of core_data_modules.traced_data.TracedData
+        :param export_path: Path to export the JSONL file to e.g. "messages.jsonl.gz".
+        :type export_path: str
+        :param chunk_size: Number of TracedData to serialize and write at a time.
+        :type chunk_size: int
+        """
+        self.export_path = export_path
+        self._traced_data = traced_data
+        self._chunk_size = chunk_size
+        self._error = None
+        self._thread = threading.Thread(target=self._export, name=f"export-{os.path.basename(export_path)}",
+                                        daemon=True)
+        self._thread.start()
+
+    def _export(self):
+        # Keep the export path's extension on the temporary path, so it is compressed in the same way.
+        temp_path = os.path.join(os.path.dirname(self.export_path), f".temp_{os.path.basename(self.export_path)}")
+        try:
+            exported = 0
+            with _open_text(temp_path, "wt") as f:
+                for chunk in _chunks(self._traced_data, self._chunk_size):
+                    TracedDataJsonIO.export_traced_data_iterable_to_jsonl(chunk, f)
+                    exported += len(chunk)
+            os.replace(temp_path, self.export_path)
+            log.info(f"Exported {exported} TracedData to '{self.export_path}'")
+        except BaseException as e:
+            self._error = e
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def wait(self):
+        """
+        Waits for the export to finish.
+
+        :raises Exception: If the export failed, re-raises the error that caused it to fail.
+        """
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def export_traced_data_jsonl_in_background(traced_data, export_path, chunk_size=1000):
+    """
+    Starts exporting TracedData to a JSONL file on a background thread. See `BackgroundTracedDataJsonlExport`.
+
+    :param traced_data: TracedData to export.
+    :type traced_data: iterable of core_data_modules.traced_data.TracedData
+    :param export_path: Path to export the JSONL file to. If this ends in ".gz", the file is gzip-compressed.
+    :type export_path: str
+    :param chunk_size: Number of TracedData to serialize and write at a time.
+    :type chunk_size: int
+    :return: Handle to the export. Call `wait` on this to wait for the export to finish.
+    :rtype: BackgroundTracedDataJsonlExport
+    """
+    log.info(f"Exporting TracedData to '{export_path}' in the background...")
+    return BackgroundTracedDataJsonlExport(traced_data, export_path, chunk_size)
+
+
+def read_traced_data_jsonl(path, chunk_size=1000):
+    """
+    Reads TracedData from a JSONL file one chunk at a time, so that the file never needs to be loaded fully into memory.
+
+    :param path: Path to the JSONL file to read. If this ends in ".gz", the file is gzip-decompressed as it is read.
+    :type path: str
+    :param chunk_size: Number of lines to read and deserialize at a time.
+    :type chunk_size: int
+    :return: Generator of the TracedData in the file, in file order.
+    :rtype: generator of core_data_modules.traced_data.TracedData
+    """
+    with _open_text(path, "rt") as f:
+        for lines in _chunks(f, chunk_size):
+            yield from TracedDataJsonIO.import_jsonl_to_traced_data_iterable(io.StringIO("".join(lines)))
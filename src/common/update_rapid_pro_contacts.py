@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+def update_rapid_pro_contacts(rapid_pro, urn_to_contact_fields, max_workers=1, on_contact_updated=None, dry_run=False):
+    """
+    Updates the contact fields of multiple Rapid Pro contacts, using a bounded pool of worker threads.
+
+    Rapid Pro throttles API requests per workspace. The Rapid Pro client waits and retries requests that are
+    throttled, so `max_workers` bounds the number of requests that can be in flight (and hence waiting) at once
+    rather than the request rate itself. Keep it small.
+
+    :param rapid_pro: Rapid Pro client to use to update the contacts.
+    :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+    :param urn_to_contact_fields: Dictionary of contact urn -> (dictionary of contact field key -> value to write).
+    :type urn_to_contact_fields: dict of str -> (dict of str -> str)
+    :param max_workers: Maximum number of contact updates to run concurrently.
+    :type max_workers: int
+    :param on_contact_updated: Function to call with each urn once its contact has been updated, or None.
+                               This is always called from the calling thread, in order of completion. If an update
+                               fails, the updates that haven't started are cancelled, this is called for every other
+                               update that succeeded, then the error is raised.
+    :type on_contact_updated: (function of str -> None) | None
+    :param dry_run: Whether to perform a dry run. If True, no contacts are updated, but `on_contact_updated` is still
+                    called for each urn.
+    :type dry_run: bool
+    """
+    if dry_run:
+        for urn in urn_to_contact_fields.keys():
+            if on_contact_updated is not None:
+                on_contact_updated(urn)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures_to_urn = {
+            executor.submit(rapid_pro.update_contact, urn, contact_fields=contact_fields): urn
+            for urn, contact_fields in urn_to_contact_fields.items()
+        }
+
+        reported_futures = set()
+        try:
+            for future in as_completed(futures_to_urn):
+                # Re-raise any exception from the worker thread, so a failed update stops the sync.
+                future.result()
+                if on_contact_updated is not None:
+                    on_contact_updated(futures_to_urn[future])
+                reported_futures.add(future)
+        except BaseException:
+            # Cancel the updates that haven't started yet and wait for those already in flight, then report every
+            # update that succeeded before re-raising, so that their progress is recorded and a resumed sync doesn't
+            # update those contacts again.
+            for future in futures_to_urn:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for future, urn in futures_to_urn.items():
+                if future in reported_futures or future.cancelled() or future.exception() is not None:
+                    continue
+                if on_contact_updated is not None:
+                    on_contact_updated(urn)
+            raise
@@ -0,0 +1,149 @@
+from core_data_modules.logging import Logger
+
+from src.engagement_db_coda_sync.cache import CodaSyncCache
+from src.engagement_db_coda_sync.coda_to_engagement_db import _sync_coda_dataset_to_engagement_db
+from src.engagement_db_coda_sync.engagement_db_to_coda import _sync_engagement_db_dataset_to_coda
+from src.engagement_db_coda_sync.sync_stats import EngagementDBToCodaSyncStats, CodaToEngagementDBSyncStats
+
+log = Logger(__name__)
+
+
+def _get_coda_messages_to_sync_to_engagement_db(coda, dataset_config, prefetched_coda_messages, cache=None):
+    """
+    Gets the Coda messages that the Coda -> engagement db pass needs to sync, by combining the prefetched messages
+    that were updated since the last run with the messages that were added or updated in Coda after the prefetch
+    (for example by the engagement db -> Coda pass that has just run).
+
+    :param coda: Coda instance to download the messages updated after the prefetch from.
+    :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+    :param dataset_config: Configuration for the dataset to get messages for.
+    :type dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
+    :param prefetched_coda_messages: All the messages in this Coda dataset, as downloaded at the start of this
+                                     dataset's sync.
+    :type prefetched_coda_messages: list of core_data_modules.data_models.Message
+    :param cache: Coda -> engagement db sync cache.
+    :type cache: src.engagement_db_coda_sync.cache.CodaSyncCache | None
+    :return: Coda messages to sync, with at most one version of each message.
+    :rtype: list of core_data_modules.data_models.Message
+    """
+    last_updated_after = None if cache is None else cache.get_last_updated_timestamp(dataset_config.coda_dataset_id)
+
+    prefetch_last_updated = None
+    coda_messages = dict()  # of coda message id -> Coda message
+    for msg in prefetched_coda_messages:
+        if prefetch_last_updated is None or msg.last_updated > prefetch_last_updated:
+            prefetch_last_updated = msg.last_updated
+        if last_updated_after is None or msg.last_updated > last_updated_after:
+            coda_messages[msg.message_id] = msg
+
+    # Download the messages that were updated after the prefetch. If the prefetch was empty, there's no prefetched
+    # timestamp to download from, so download every message updated since the last run instead.
+    if prefetch_last_updated is not None:
+        updated_coda_messages = coda.get_dataset_messages(
+            dataset_config.coda_dataset_id, last_updated_after=prefetch_last_updated
+        )
+        log.info(f"Downloaded {len(updated_coda_messages)} message(s) that were updated in Coda dataset "
+                 f"{dataset_config.coda_dataset_id} since the prefetch (after {prefetch_last_updated})")
+    else:
+        updated_coda_messages = coda.get_dataset_messages(
+            dataset_config.coda_dataset_id, last_updated_after=last_updated_after
+        )
+        if last_updated_after is None:
+            log.info(f"The prefetch of Coda dataset {dataset_config.coda_dataset_id} was empty, so downloaded all "
+                     f"{len(updated_coda_messages)} message(s) in the dataset")
+        else:
+            log.info(f"The prefetch of Coda dataset {dataset_config.coda_dataset_id} was empty, so downloaded the "
+                     f"{len(updated_coda_messages)} message(s) that were updated after {last_updated_after}")
+    for msg in updated_coda_messages:
+        coda_messages[msg.message_id] = msg
+
+    return list(coda_messages.values())
+
+
+def sync_coda_bidirectional(engagement_db, coda, coda_config, cache_path=None, dry_run=False):
+    """
+    Syncs messages from an engagement database to Coda, then from Coda back to the engagement database, in a single
+    pass over each dataset.
+
+    This is equivalent to running `sync_engagement_db_to_coda` then `sync_coda_to_engagement_db`, except that each
+    Coda dataset is downloaded once and shared between both directions, rather than being read message-by-message by
+    the engagement db -> Coda direction and again by the Coda -> engagement db direction.
+
+    :param engagement_db: Engagement database to sync.
+    :type engagement_db: engagement_database.EngagementDatabase
+    :param coda: Coda instance to sync.
+    :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+    :param coda_config: Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param cache_path: Path to a directory to use to cache results needed for incremental operation.
+                       The caches for each direction are stored in the same sub-directories as those used by
+                       `sync_engagement_db_to_coda` and `sync_coda_to_engagement_db`.
+                       If None, runs in non-incremental mode.
+    :type cache_path: str | None
+    :param dry_run: Whether to perform a dry run.
+    :type dry_run: bool
+    """
+    coda_config = coda_config.compile()
+
+    # Initialise the caches
+    if cache_path is None:
+        engagement_db_to_coda_cache = None
+        coda_to_engagement_db_cache = None
+        log.warning(f"No `cache_path` provided. This tool will process all relevant messages from all of time")
+    else:
+        log.info(f"Initialising Coda sync caches at '{cache_path}/engagement_db_to_coda' and "
+                 f"'{cache_path}/coda_to_engagement_db'")
+        engagement_db_to_coda_cache = CodaSyncCache(f"{cache_path}/engagement_db_to_coda")
+        coda_to_engagement_db_cache = CodaSyncCache(f"{cache_path}/coda_to_engagement_db")
+
+    if dry_run:
+        log.warning("Running without --dry-run may cause more reads than suggested here, because any update made to "
+                    "an engagement db message when syncing it will result in it being synced again")
+
+    # Sync each dataset in turn, in both directions
+    dataset_to_engagement_db_to_coda_sync_stats = dict()  # of engagement db dataset -> EngagementDBToCodaSyncStats
+    dataset_to_coda_to_engagement_db_sync_stats = dict()  # of coda dataset id -> CodaToEngagementDBSyncStats
+    for dataset_config in coda_config.dataset_configurations:
+        log.info(f"Getting all messages from Coda dataset {dataset_config.coda_dataset_id}...")
+        prefetched_coda_messages = coda.get_dataset_messages(dataset_config.coda_dataset_id)
+        coda_messages_map = {msg.message_id: msg for msg in prefetched_coda_messages}
+        log.info(f"Downloaded {len(prefetched_coda_messages)} message(s) from Coda dataset "
+                 f"{dataset_config.coda_dataset_id}")
+
+        log.info(f"Syncing engagement db dataset {dataset_config.engagement_db_dataset} to Coda dataset "
+                 f"{dataset_config.coda_dataset_id}...")
+        dataset_to_engagement_db_to_coda_sync_stats[dataset_config.engagement_db_dataset] = \
+            _sync_engagement_db_dataset_to_coda(
+                engagement_db, coda, coda_config, dataset_config, engagement_db_to_coda_cache, dry_run,
+                coda_messages_map
+            )
+
+        log.info(f"Syncing Coda dataset {dataset_config.coda_dataset_id} to engagement db dataset "
+                 f"{dataset_config.engagement_db_dataset}...")
+        coda_messages = _get_coda_messages_to_sync_to_engagement_db(
+            coda, dataset_config, prefetched_coda_messages, coda_to_engagement_db_cache
+        )
+        coda_to_engagement_db_sync_stats = _sync_coda_dataset_to_engagement_db(
+            coda, engagement_db, coda_config, dataset_config, coda_to_engagement_db_cache, dry_run, coda_messages
+        )
+        dataset_to_coda_to_engagement_db_sync_stats[dataset_config.coda_dataset_id] = coda_to_engagement_db_sync_stats
+
+    # Log the summaries of actions taken for each dataset then for all datasets combined, for each direction.
+    all_engagement_db_to_coda_sync_stats = EngagementDBToCodaSyncStats()
+    all_coda_to_engagement_db_sync_stats = CodaToEngagementDBSyncStats()
+    for dataset_config in coda_config.dataset_configurations:
+        log.info(f"Summary of actions for engagement db dataset '{dataset_config.engagement_db_dataset}' -> Coda:")
+        dataset_to_engagement_db_to_coda_sync_stats[dataset_config.engagement_db_dataset].print_summary()
+        all_engagement_db_to_coda_sync_stats.add_stats(
+            dataset_to_engagement_db_to_coda_sync_stats[dataset_config.engagement_db_dataset])
+
+        log.info(f"Summary of actions for Coda dataset '{dataset_config.coda_dataset_id}' -> engagement db:")
+        dataset_to_coda_to_engagement_db_sync_stats[dataset_config.coda_dataset_id].print_summary()
+        all_coda_to_engagement_db_sync_stats.add_stats(
+            dataset_to_coda_to_engagement_db_sync_stats[dataset_config.coda_dataset_id])
+
+    dry_run_text = "(dry run)" if dry_run else ""
+    log.info(f"Summary of engagement db -> Coda actions for all datasets {dry_run_text}:")
+    all_engagement_db_to_coda_sync_stats.print_summary()
+    log.info(f"Summary of Coda -> engagement db actions for all datasets {dry_run_text}:")
+    all_coda_to_engagement_db_sync_stats.print_summary()
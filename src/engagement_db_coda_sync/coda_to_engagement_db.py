@@ -27,7 +27,7 @@ def _sync_coda_message_to_engagement_db_batch(transaction, coda, coda_message, e
     :param engagement_db_dataset: Dataset in the engagement database to update.
     :type engagement_db_dataset: str
     :param coda_config: Configuration for the update.
-    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :type coda_config: src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
     :return Sync stats.
@@ -97,7 +97,7 @@ def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engag
     :param engagement_db_dataset: Dataset in the engagement database to update.
     :type engagement_db_dataset: str
     :param coda_config: Configuration for the update.
-    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :type coda_config: src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
     :return Sync stats.
@@ -123,7 +123,8 @@ def _sync_coda_message_to_engagement_db(coda, coda_message, engagement_db, engag
     return sync_stats
 
 
-def _sync_coda_dataset_to_engagement_db(coda, engagement_db, coda_config, dataset_config, cache=None, dry_run=False):
+def _sync_coda_dataset_to_engagement_db(coda, engagement_db, coda_config, dataset_config, cache=None, dry_run=False,
+                                        coda_messages=None):
     """
     Syncs messages from one Coda dataset to an engagement database.
     
@@ -132,22 +133,25 @@ def _sync_coda_dataset_to_engagement_db(coda, engagement_db, coda_config, datase
     :param engagement_db: Engagement database to sync to.
     :type engagement_db: engagement_database.EngagementDatabase
     :param coda_config: Coda sync configuration.
-    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :type coda_config: src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :param cache: Coda sync cache.
     :type cache: src.engagement_db_coda_sync.cache.CodaSyncCache | None
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :param coda_messages: Coda messages to sync, or None. If None, downloads the messages in this dataset that were
+                          updated since the last run from Coda.
+    :type coda_messages: list of core_data_modules.data_models.Message | None
     :return Sync stats for the update.
     :rtype: src.engagement_db_coda_sync.sync_stats.CodaToEngagementDBSyncStats
     """
-    log.info(f"Getting messages from Coda dataset {dataset_config.coda_dataset_id}...")
-
     sync_stats = CodaToEngagementDBSyncStats()
 
-    coda_messages = coda.get_dataset_messages(
-        dataset_config.coda_dataset_id,
-        last_updated_after=None if cache is None else cache.get_last_updated_timestamp(dataset_config.coda_dataset_id)
-    )
+    if coda_messages is None:
+        log.info(f"Getting messages from Coda dataset {dataset_config.coda_dataset_id}...")
+        coda_messages = coda.get_dataset_messages(
+            dataset_config.coda_dataset_id,
+            last_updated_after=None if cache is None else cache.get_last_updated_timestamp(dataset_config.coda_dataset_id)
+        )
     for _ in coda_messages:
         sync_stats.add_event(CodaSyncEvents.READ_MESSAGE_FROM_CODA)
 
@@ -190,6 +194,8 @@ def sync_coda_to_engagement_db(coda, engagement_db, coda_config, cache_path=None
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
     """
+    coda_config = coda_config.compile()
+
     # Initialise the cache
     if cache_path is None:
         cache = None
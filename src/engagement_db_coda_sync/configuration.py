@@ -71,7 +71,7 @@ class CodaDatasetConfiguration:
 
 class CodaSyncConfiguration:
     def __init__(self, dataset_configurations, ws_correct_dataset_code_scheme, set_dataset_from_ws_string_value=False,
-                 default_ws_dataset=None, project_users_file_url=None):
+                 default_ws_dataset=None, project_users_file_url=None, record_full_coda_message_in_history=False):
         """
         Configuration for bidirectional sync between an engagement database and a Coda instance.
 
@@ -128,12 +128,20 @@ class CodaSyncConfiguration:
                                        If a dataset_configuration has its `dataset_users_file_url` property set,
                                        the users will be updated from that file instead of the one referenced here.
         :type project_users_file_url: str | None
+        :param record_full_coda_message_in_history: Whether to record the entire Coda message, including its full
+                                                    label history, in the origin details of each engagement db
+                                                    history entry written when syncing labels from Coda.
+                                                    If False, only the Coda dataset, message id, last_updated
+                                                    timestamp and a hash of the message's labels are recorded, which
+                                                    keeps history entries for heavily relabelled messages small.
+        :type record_full_coda_message_in_history: bool
         """
         self.dataset_configurations = dataset_configurations
         self.ws_correct_dataset_code_scheme = ws_correct_dataset_code_scheme
         self.set_dataset_from_ws_string_value = set_dataset_from_ws_string_value
         self.default_ws_dataset = default_ws_dataset
         self.project_users_file_url = project_users_file_url
+        self.record_full_coda_message_in_history = record_full_coda_message_in_history
 
         # self.validate()
 
@@ -148,6 +156,19 @@ class CodaSyncConfiguration:
                                f"ws_correct_dataset_code_scheme. Add this code to the ws_correct_dataset_code_scheme "
                                f"or remove this dataset_configuration") from e
 
+    def compile(self):
+        """
+        Compiles this configuration into a `CompiledCodaSyncConfiguration`, which supports constant-time look-ups of
+        dataset configurations and codes.
+
+        Compile once per run, after the configuration has been fully constructed, and pass the compiled configuration
+        to the sync functions.
+
+        :return: Compiled version of this configuration.
+        :rtype: CompiledCodaSyncConfiguration
+        """
+        return CompiledCodaSyncConfiguration(self)
+
     def get_dataset_config_by_engagement_db_dataset(self, dataset):
         for config in self.dataset_configurations:
             if config.engagement_db_dataset == dataset:
@@ -161,3 +182,148 @@ class CodaSyncConfiguration:
                     return config
         raise ValueError(f"Coda configuration does not contain a dateset_configuration with a ws_code_match_value "
                          f"in '{ws_code_match_values}'")
+
+
+class CompiledCodaSyncConfiguration(CodaSyncConfiguration):
+    def __init__(self, coda_config):
+        """
+        A `CodaSyncConfiguration` with look-up tables precomputed from its dataset and code scheme configurations,
+        so that the look-ups made for every message and label in the Coda sync are hash-map look-ups rather than
+        linear scans over the configuration.
+
+        The look-up tables are built from the state of `coda_config` at construction, so the configuration must not be
+        modified after compiling. Prefer constructing this via `CodaSyncConfiguration.compile`.
+
+        :param coda_config: Configuration to compile.
+        :type coda_config: CodaSyncConfiguration
+        """
+        super().__init__(
+            coda_config.dataset_configurations, coda_config.ws_correct_dataset_code_scheme,
+            coda_config.set_dataset_from_ws_string_value, coda_config.default_ws_dataset,
+            coda_config.project_users_file_url, coda_config.record_full_coda_message_in_history
+        )
+
+        # Where multiple dataset configurations match, the first one wins, consistent with the linear searches in
+        # CodaSyncConfiguration.
+        self._engagement_db_dataset_to_dataset_config = dict()  # of engagement db dataset -> CodaDatasetConfiguration
+        self._ws_code_match_value_to_dataset_config_index = dict()  # of ws code match value -> index of config
+        for i, dataset_config in enumerate(self.dataset_configurations):
+            self._engagement_db_dataset_to_dataset_config.setdefault(dataset_config.engagement_db_dataset, dataset_config)
+            self._ws_code_match_value_to_dataset_config_index.setdefault(dataset_config.ws_code_match_value, i)
+
+        self._ws_code_id_to_code = {code.code_id: code for code in self.ws_correct_dataset_code_scheme.codes}
+
+        # of engagement db dataset -> (dict of scheme id -> CodeScheme), and of engagement db dataset ->
+        # (dict of scheme id -> (dict of code id -> Code)), both including the WS scheme.
+        self._engagement_db_dataset_to_code_schemes = dict()
+        self._engagement_db_dataset_to_code_luts = dict()
+        for dataset_config in self.dataset_configurations:
+            if dataset_config.engagement_db_dataset in self._engagement_db_dataset_to_code_luts:
+                continue
+            code_schemes = [c.code_scheme for c in dataset_config.code_scheme_configurations]
+            code_schemes.append(self.ws_correct_dataset_code_scheme)
+            self._engagement_db_dataset_to_code_schemes[dataset_config.engagement_db_dataset] = {
+                code_scheme.scheme_id: code_scheme for code_scheme in code_schemes
+            }
+            self._engagement_db_dataset_to_code_luts[dataset_config.engagement_db_dataset] = {
+                code_scheme.scheme_id: {code.code_id: code for code in code_scheme.codes}
+                for code_scheme in code_schemes
+            }
+
+        # Cache of (engagement db dataset, label scheme id) -> (CodeScheme, dict of code id -> Code), filled on demand
+        # because label scheme ids may have duplicate-scheme suffixes e.g. '-2'.
+        self._label_scheme_id_to_code_scheme_cache = dict()
+
+    def compile(self):
+        return self
+
+    def get_dataset_config_by_engagement_db_dataset(self, dataset):
+        try:
+            return self._engagement_db_dataset_to_dataset_config[dataset]
+        except KeyError:
+            raise ValueError(f"Coda configuration does not contain a dataset_configuration with dataset '{dataset}'")
+
+    def get_dataset_config_by_ws_code_match_value(self, ws_code_match_values):
+        matching_indices = [
+            self._ws_code_match_value_to_dataset_config_index[value] for value in ws_code_match_values
+            if value in self._ws_code_match_value_to_dataset_config_index
+        ]
+        if len(matching_indices) == 0:
+            raise ValueError(f"Coda configuration does not contain a dateset_configuration with a ws_code_match_value "
+                             f"in '{ws_code_match_values}'")
+        return self.dataset_configurations[min(matching_indices)]
+
+    def get_code_luts(self, dataset_config):
+        """
+        Gets the codes that are valid for the given dataset, indexed by scheme id and code id.
+
+        :param dataset_config: Dataset configuration to get the codes of.
+        :type dataset_config: CodaDatasetConfiguration
+        :return: Dictionary of scheme id -> (dictionary of code id -> Code), for each of the normal code schemes in this
+                 dataset and the WS - Correct Dataset code scheme.
+        :rtype: dict of str -> (dict of str -> core_data_modules.data_models.Code)
+        """
+        return self._engagement_db_dataset_to_code_luts[dataset_config.engagement_db_dataset]
+
+    def get_code_scheme(self, dataset_config, scheme_id):
+        """
+        Gets the code scheme with the given id from the code schemes that are valid for the given dataset.
+
+        :param dataset_config: Dataset configuration to get the code scheme of.
+        :type dataset_config: CodaDatasetConfiguration
+        :param scheme_id: Id of the code scheme to get. Must be one of the scheme ids returned by `get_code_luts`.
+        :type scheme_id: str
+        :return: Code scheme with id `scheme_id`.
+        :rtype: core_data_modules.data_models.CodeScheme
+        """
+        return self._engagement_db_dataset_to_code_schemes[dataset_config.engagement_db_dataset][scheme_id]
+
+    def get_ws_code(self, code_id):
+        """
+        Gets the code with the given id from the WS - Correct Dataset code scheme.
+
+        :param code_id: Id of the code to get.
+        :type code_id: str
+        :return: Code with id `code_id`.
+        :rtype: core_data_modules.data_models.Code
+        """
+        code = self._ws_code_id_to_code.get(code_id)
+        if code is None:
+            return self.ws_correct_dataset_code_scheme.get_code_with_code_id(code_id)
+        return code
+
+    def get_code_for_label(self, dataset_config, label):
+        """
+        Gets the code for the given label from the normal code schemes of the given dataset.
+
+        Handles duplicated scheme ids (i.e. schemes ending in '-1', '-2' etc.).
+        Raises a ValueError if the label isn't for any of the dataset's normal code schemes.
+
+        :param dataset_config: Dataset configuration containing the code schemes to check for the given label.
+        :type dataset_config: CodaDatasetConfiguration
+        :param label: Label to get the code for.
+        :type label: core_data_modules.data_models.Label
+        :return: Code for the label.
+        :rtype: core_data_modules.data_models.Code
+        """
+        cache_key = (dataset_config.engagement_db_dataset, label.scheme_id)
+        if cache_key not in self._label_scheme_id_to_code_scheme_cache:
+            code_schemes = [c.code_scheme for c in dataset_config.code_scheme_configurations]
+            matching_code_scheme = None
+            for code_scheme in code_schemes:
+                if label.scheme_id.startswith(code_scheme.scheme_id):
+                    matching_code_scheme = code_scheme
+                    break
+
+            if matching_code_scheme is None:
+                raise ValueError(f"Label's scheme id '{label.scheme_id}' is not in any of the given `code_schemes` "
+                                 f"(these have ids {[scheme.scheme_id for scheme in code_schemes]})")
+
+            self._label_scheme_id_to_code_scheme_cache[cache_key] = \
+                (matching_code_scheme, {code.code_id: code for code in matching_code_scheme.codes})
+
+        code_scheme, code_id_to_code = self._label_scheme_id_to_code_scheme_cache[cache_key]
+        code = code_id_to_code.get(label.code_id)
+        if code is None:
+            return code_scheme.get_code_with_code_id(label.code_id)
+        return code
@@ -12,7 +12,8 @@ log = Logger(__name__)
 
 
 @firestore.transactional
-def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, coda_config, dataset_config, last_seen_message, dry_run=False):
+def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, coda_config, dataset_config, last_seen_message,
+                                             dry_run=False, coda_messages_map=None):
     """
     Syncs a message from an engagement database to Coda.
 
@@ -29,7 +30,7 @@ def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, c
     :param coda: Coda instance to sync the message to.
     :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
     :param coda_config: Coda sync configuration.
-    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :type coda_config: src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :param dataset_config: Configuration for the dataset to sync.
     :type dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
     :param last_seen_message: Last seen message, downloaded from the database in a previous call, or None.
@@ -38,6 +39,11 @@ def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, c
     :type last_seen_message: engagement_database.data_models.Message | None
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :param coda_messages_map: Dictionary of coda message id -> Coda message, containing every message in this
+                              dataset's Coda dataset. If provided, messages are looked-up in this map instead of
+                              being fetched from Coda one at a time, and any messages added to Coda are added to this
+                              map. If None, each message is fetched from Coda.
+    :type coda_messages_map: (dict of str -> core_data_modules.data_models.Message) | None
     :return: A tuple of:
              1. The engagement database message that was synced. If there was no new message to sync, returns None.
              2. Sync stats.
@@ -98,7 +104,10 @@ def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, c
     assert engagement_db_message.coda_id == SHAUtils.sha_string(engagement_db_message.text)
 
     # Look-up this message in Coda
-    coda_message = coda.get_dataset_message(dataset_config.coda_dataset_id, engagement_db_message.coda_id)
+    if coda_messages_map is None:
+        coda_message = coda.get_dataset_message(dataset_config.coda_dataset_id, engagement_db_message.coda_id)
+    else:
+        coda_message = coda_messages_map.get(engagement_db_message.coda_id)
 
     # If the message exists in Coda, update the database message based on the labels assigned in Coda
     if coda_message is not None:
@@ -112,12 +121,15 @@ def _sync_next_engagement_db_message_to_coda(transaction, engagement_db, coda, c
 
     # The message isn't in Coda, so add it
     sync_stats.add_event(CodaSyncEvents.ADD_MESSAGE_TO_CODA)
-    _add_message_to_coda(coda, dataset_config, coda_config.ws_correct_dataset_code_scheme, engagement_db_message, dry_run)
+    coda_message = _add_message_to_coda(coda, coda_config, dataset_config, engagement_db_message, dry_run)
+    if coda_messages_map is not None and not dry_run:
+        coda_messages_map[coda_message.message_id] = coda_message
 
     return engagement_db_message, sync_stats
 
 
-def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, dataset_config, cache, dry_run=False):
+def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, dataset_config, cache, dry_run=False,
+                                        coda_messages_map=None):
     """
     Syncs messages from one engagement database dataset to Coda.
 
@@ -126,13 +138,16 @@ def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, datase
     :param coda: Coda instance to sync the message to.
     :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
     :param coda_config: Coda sync configuration.
-    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :type coda_config: src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :param dataset_config: Configuration for the dataset to sync.
     :type dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
     :param cache: Coda sync cache.
     :type cache: src.engagement_db_coda_sync.cache.CodaSyncCache | None
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :param coda_messages_map: Dictionary of coda message id -> Coda message for every message in this dataset's Coda
+                              dataset, or None. See `_sync_next_engagement_db_message_to_coda` for details.
+    :type coda_messages_map: (dict of str -> core_data_modules.data_models.Message) | None
     :return: Sync stats for the update.
     :rtype: src.engagement_db_coda_sync.sync_stats.EngagementDBToCodaSyncStats
     """
@@ -147,7 +162,8 @@ def _sync_engagement_db_dataset_to_coda(engagement_db, coda, coda_config, datase
         first_run = False
 
         last_seen_message, message_sync_stats = _sync_next_engagement_db_message_to_coda(
-            engagement_db.transaction(), engagement_db, coda, coda_config, dataset_config, last_seen_message, dry_run
+            engagement_db.transaction(), engagement_db, coda, coda_config, dataset_config, last_seen_message, dry_run,
+            coda_messages_map
         )
         sync_stats.add_stats(message_sync_stats)
 
@@ -185,6 +201,8 @@ def sync_engagement_db_to_coda(engagement_db, coda, coda_config, cache_path=None
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
     """
+    coda_config = coda_config.compile()
+
     # Initialise the cache
     if cache_path is None:
         cache = None
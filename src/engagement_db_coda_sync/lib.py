@@ -6,7 +6,7 @@ from core_data_modules.cleaners.cleaning_utils import CleaningUtils
 from core_data_modules.data_models import Message as CodaMessage, Label, Origin
 from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata
-from core_data_modules.util import TimeUtils
+from core_data_modules.util import TimeUtils, SHAUtils
 from engagement_database.data_models import HistoryEntryOrigin
 from google.cloud import firestore
 from storage.google_cloud import google_cloud_utils
@@ -114,7 +114,7 @@ def ensure_coda_users_and_code_schemes_up_to_date(coda, coda_config, google_clou
             log.info(f"Code schemes are up to date")
 
 
-def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_scheme, engagement_db_message, dry_run=False):
+def _add_message_to_coda(coda, coda_config, coda_dataset_config, engagement_db_message, dry_run=False):
     """
     Adds a message to Coda.
 
@@ -124,15 +124,16 @@ def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_sche
 
     :param coda: Coda instance to add the message to.
     :type coda: coda_v2_python_client.firebase_client_wrapper.CodaV2Client
+    :param coda_config: Compiled Coda sync configuration, used to validate any existing labels, where applicable.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :param coda_dataset_config: Configuration for adding the message.
     :type coda_dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
-    :param ws_correct_dataset_code_scheme: WS Correct Dataset code scheme for the Coda dataset, used to validate any
-                                           existing labels, where applicable.
-    :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
     :param engagement_db_message: Message to add to Coda.
     :type engagement_db_message: engagement_database.data_models.Message
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :return: The Coda message that was added to Coda.
+    :rtype: core_data_modules.data_models.Message
     """
     log.debug("Adding message to Coda")
 
@@ -148,15 +149,12 @@ def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_sche
         # Ensure the existing labels are valid under the code schemes being copied to, by checking the label's scheme id
         # exists in this dataset's code schemes or the ws correct dataset scheme, and that the code id is in the
         # code scheme.
-        valid_code_schemes = [c.code_scheme for c in coda_dataset_config.code_scheme_configurations]
-        valid_code_schemes.append(ws_correct_dataset_code_scheme)
-        valid_code_schemes_lut = {code_scheme.scheme_id: code_scheme for code_scheme in valid_code_schemes}
+        valid_code_luts = coda_config.get_code_luts(coda_dataset_config)
         for label in engagement_db_message.labels:
-            assert label.scheme_id in valid_code_schemes_lut.keys(), \
+            assert label.scheme_id in valid_code_luts, \
                 f"Scheme id {label.scheme_id} not valid for Coda dataset {coda_dataset_config.coda_dataset_id}"
-            code_scheme = valid_code_schemes_lut[label.scheme_id]
-            valid_codes = code_scheme.codes
-            valid_code_ids = [code.code_id for code in valid_codes]
+            code_scheme = coda_config.get_code_scheme(coda_dataset_config, label.scheme_id)
+            valid_code_ids = valid_code_luts[label.scheme_id]
             assert label.code_id == "SPECIAL-MANUALLY_UNCODED" or label.code_id in valid_code_ids, \
                 f"Code ID {label.code_id} not found in Scheme {code_scheme.name} (id {label.scheme_id})"
 
@@ -176,30 +174,10 @@ def _add_message_to_coda(coda, coda_dataset_config, ws_correct_dataset_code_sche
     if not dry_run:
         coda.add_message_to_dataset(coda_dataset_config.coda_dataset_id, coda_message)
 
+    return coda_message
 
-def _code_for_label(label, code_schemes):
-    """
-    Returns the code for the given label.
-
-    Handles duplicated scheme ids (i.e. schemes ending in '-1', '-2' etc.).
-    Raises a ValueError if the label isn't for any of the given code schemes.
 
-    :param label: Label to get the code for.
-    :type label: core_data_modules.data_models.Label
-    :param code_schemes: Code schemes to check for the given label.
-    :type code_schemes: list of core_data_modules.data_models.CodeScheme
-    :return: Code for the label.
-    :rtype: core_data_modules.data_models.Code
-    """
-    for code_scheme in code_schemes:
-        if label.scheme_id.startswith(code_scheme.scheme_id):
-            return code_scheme.get_code_with_code_id(label.code_id)
-
-    raise ValueError(f"Label's scheme id '{label.scheme_id}' is not in any of the given `code_schemes` "
-                     f"(these have ids {[scheme.scheme_id for scheme in code_schemes]})")
-
-
-def _get_ws_code(coda_message, coda_dataset_config, ws_correct_dataset_code_scheme):
+def _get_ws_code(coda_message, coda_dataset_config, coda_config):
     """
     Gets the WS code assigned to a Coda message, if it exists, otherwise returns None.
 
@@ -207,13 +185,12 @@ def _get_ws_code(coda_message, coda_dataset_config, ws_correct_dataset_code_sche
     :type coda_message: core_data_modules.data_models.Message
     :param coda_dataset_config: Dataset configuration to use to interpret this message's labels.
     :type coda_dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
-    :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
-    :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
+    :param coda_config: Compiled Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :return: WS code assigned to this message, if it exists.
     :rtype: core_data_modules.data_models.Code | None
     """
-    normal_code_schemes = [c.code_scheme for c in coda_dataset_config.code_scheme_configurations]
-    ws_code_scheme = ws_correct_dataset_code_scheme
+    ws_code_scheme = coda_config.ws_correct_dataset_code_scheme
 
     # Check for a WS code in any of the normal code schemes
     ws_code_in_normal_scheme = False
@@ -222,7 +199,7 @@ def _get_ws_code(coda_message, coda_dataset_config, ws_correct_dataset_code_sche
             continue
 
         if label.scheme_id != ws_code_scheme.scheme_id:
-            code = _code_for_label(label, normal_code_schemes)
+            code = coda_config.get_code_for_label(coda_dataset_config, label)
             if code.control_code == Codes.WRONG_SCHEME:
                 ws_code_in_normal_scheme = True
 
@@ -235,7 +212,7 @@ def _get_ws_code(coda_message, coda_dataset_config, ws_correct_dataset_code_sche
 
         if label.scheme_id == ws_code_scheme.scheme_id:
             code_in_ws_scheme = True
-            ws_code = ws_code_scheme.get_code_with_code_id(label.code_id)
+            ws_code = coda_config.get_ws_code(label.code_id)
 
     # Ensure there is a WS code in a normal scheme and a code in the WS scheme.
     # If there isn't, don't attempt any redirect, so we can impute a CE code later.
@@ -339,6 +316,37 @@ def _fix_ws_cycle(engagement_db, coda, engagement_db_message, coda_config, trans
     log.info(f"Fixed WS cycle for engagement_db message '{engagement_db_message.message_id}'")
 
 
+def _get_history_origin_details(coda_config, coda_dataset_config, coda_message):
+    """
+    Gets the details to record in the HistoryEntryOrigin of an engagement database update made from a Coda message.
+
+    If `coda_config.record_full_coda_message_in_history` is set, the details contain the entire serialized Coda
+    message, including its full label history. Otherwise, the details only identify the version of the Coda message
+    that was synced, by recording its dataset, message id, last_updated timestamp and a hash of its labels.
+
+    :param coda_config: Coda sync configuration.
+    :type coda_config: src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param coda_dataset_config: Configuration for the Coda dataset the message is being synced from.
+    :type coda_dataset_config: src.engagement_db_coda_sync.configuration.CodaDatasetConfiguration
+    :param coda_message: Coda message the update is being made from.
+    :type coda_message: core_data_modules.data_models.Message
+    :return: HistoryEntryOrigin details.
+    :rtype: dict
+    """
+    if coda_config.record_full_coda_message_in_history:
+        return {"coda_dataset": coda_dataset_config.coda_dataset_id,
+                "coda_message": coda_message.to_dict(serialize_datetimes_to_str=True)}
+
+    labels_hash = SHAUtils.sha_string(json.dumps([label.to_dict() for label in coda_message.labels], sort_keys=True))
+    return {
+        "coda_dataset": coda_dataset_config.coda_dataset_id,
+        "coda_message_id": coda_message.message_id,
+        "coda_message_last_updated": None if coda_message.last_updated is None else
+                                     TimeUtils.datetime_to_utc_iso_string(coda_message.last_updated),
+        "coda_message_labels_sha": labels_hash
+    }
+
+
 def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagement_db_message, coda_message,
                                                     coda_config, transaction=None, dry_run=False):
     """
@@ -356,8 +364,8 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
     :type engagement_db_message: engagement_database.data_models.Message
     :param coda_message: Coda message to use to update the engagement database message.
     :type coda_message: core_data_modules.data_models.Message
-    :param coda_config: Configuration for the update.
-    :type coda_config:  src.engagement_db_coda_sync.configuration.CodaSyncConfiguration
+    :param coda_config: Compiled configuration for the update.
+    :type coda_config:  src.engagement_db_coda_sync.configuration.CompiledCodaSyncConfiguration
     :param transaction: Transaction in the engagement database to perform the update in.
     :type transaction: google.cloud.firestore.Transaction | None
     :param dry_run: Whether to perform a dry run.
@@ -368,7 +376,7 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
     coda_dataset_config = coda_config.get_dataset_config_by_engagement_db_dataset(engagement_db_message.dataset)
     sync_events = []
 
-    ws_code = _get_ws_code(coda_message, coda_dataset_config, coda_config.ws_correct_dataset_code_scheme)
+    ws_code = _get_ws_code(coda_message, coda_dataset_config, coda_config)
 
     correct_dataset = None
     # If there is a valid ws_code, find the correct_dataset.
@@ -424,8 +432,7 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
         engagement_db_message.previous_datasets.append(engagement_db_message.dataset)
         engagement_db_message.dataset = correct_dataset
 
-        origin_details = {"coda_dataset": coda_dataset_config.coda_dataset_id,
-                          "coda_message": coda_message.to_dict(serialize_datetimes_to_str=True)}
+        origin_details = _get_history_origin_details(coda_config, coda_dataset_config, coda_message)
 
         if not dry_run:
             engagement_db.set_message(
@@ -442,8 +449,7 @@ def _update_engagement_db_message_from_coda_message(engagement_db, coda, engagem
     # message in Coda.
     log.debug("Updating database message labels to match those in Coda")
     engagement_db_message.labels = coda_message.labels
-    origin_details = {"coda_dataset": coda_dataset_config.coda_dataset_id,
-                      "coda_message": coda_message.to_dict(serialize_datetimes_to_str=True)}
+    origin_details = _get_history_origin_details(coda_config, coda_dataset_config, coda_message)
 
     if not dry_run:
         engagement_db.set_message(
@@ -0,0 +1,128 @@
+from core_data_modules.analysis import AnalysisConfiguration
+
+from src.engagement_db_to_analysis.configuration import DatasetTypes
+
+
+class AnalysisConfigIndex:
+    def __init__(self, dataset_configurations):
+        """
+        Index of the analysis dataset configurations, for constant-time look-ups of the configurations, column-view
+        configurations and codes needed when processing each message or column-view TracedData.
+
+        Build one index per run, and pass it to each stage of analysis, rather than having each stage re-derive the
+        configurations it needs for every message or row.
+
+        :param dataset_configurations: Analysis dataset configurations to index.
+        :type dataset_configurations: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+        """
+        self.dataset_configurations = dataset_configurations
+
+        self._engagement_db_dataset_to_dataset_config = dict()  # of engagement db dataset -> AnalysisDatasetConfiguration
+        self._dataset_config_to_column_configs = dict()  # of AnalysisDatasetConfiguration -> list of column configs
+        self._dataset_name_to_column_config = dict()  # of column-view dataset name -> column config
+        self._codes = dict()  # of (scheme id, code id) -> Code
+        self._matrix_columns = dict()  # of id(column config) -> list of (code id, analysis file header)
+
+        self.column_configs = []
+        self.rqa_column_configs = []
+        self.demog_column_configs = []
+        for dataset_config in dataset_configurations:
+            for engagement_db_dataset in dataset_config.engagement_db_datasets:
+                # If more than one configuration includes this dataset, use the first.
+                if engagement_db_dataset not in self._engagement_db_dataset_to_dataset_config:
+                    self._engagement_db_dataset_to_dataset_config[engagement_db_dataset] = dataset_config
+
+            column_configs = []
+            for coding_config in dataset_config.coding_configs:
+                column_config = AnalysisConfiguration(
+                    dataset_name=coding_config.analysis_dataset,
+                    raw_field=dataset_config.raw_dataset,
+                    coded_field=f"{coding_config.analysis_dataset}_labels",
+                    code_scheme=coding_config.code_scheme
+                )
+                column_configs.append(column_config)
+                if column_config.dataset_name not in self._dataset_name_to_column_config:
+                    self._dataset_name_to_column_config[column_config.dataset_name] = column_config
+
+                matrix_columns = []
+                for code in column_config.code_scheme.codes:
+                    self._codes[(column_config.code_scheme.scheme_id, code.code_id)] = code
+                    matrix_columns.append((code.code_id, f"{column_config.dataset_name}:{code.string_value}"))
+                self._matrix_columns[id(column_config)] = matrix_columns
+
+            self._dataset_config_to_column_configs[dataset_config] = column_configs
+            self.column_configs.extend(column_configs)
+            if dataset_config.dataset_type == DatasetTypes.RESEARCH_QUESTION_ANSWER:
+                self.rqa_column_configs.extend(column_configs)
+            if dataset_config.dataset_type == DatasetTypes.DEMOGRAPHIC:
+                self.demog_column_configs.extend(column_configs)
+
+    def get_dataset_config_for_message(self, message):
+        """
+        Gets the analysis dataset configuration to use to process this message, by looking-up the configuration that
+        refers to this message's engagement db "dataset" property.
+
+        :param message: Message to retrieve the analysis dataset configuration for.
+        :type message: engagement_database.data_models.Message
+        :return: Analysis dataset configuration to use for this message.
+        :rtype: src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+        """
+        dataset_config = self._engagement_db_dataset_to_dataset_config.get(message.dataset)
+        if dataset_config is None:
+            raise ValueError(f"No analysis dataset configuration found for message '{message.message_id}', which has "
+                             f"engagement db dataset {message.dataset}")
+        return dataset_config
+
+    def get_dataset_config_for_engagement_db_dataset(self, engagement_db_dataset):
+        """
+        :param engagement_db_dataset: Engagement db dataset to get the analysis dataset configuration of.
+        :type engagement_db_dataset: str
+        :return: Analysis dataset configuration that includes the given engagement db dataset, or None if there is no
+                 such configuration.
+        :rtype: src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration | None
+        """
+        return self._engagement_db_dataset_to_dataset_config.get(engagement_db_dataset)
+
+    def get_column_configs_for_dataset_config(self, dataset_config):
+        """
+        :param dataset_config: Indexed analysis dataset configuration to get the column-view configurations of.
+        :type dataset_config: src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+        :return: Column-view configurations for the given analysis dataset configuration. These are shared, so must not
+                 be modified.
+        :rtype: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        """
+        return self._dataset_config_to_column_configs[dataset_config]
+
+    def get_column_config_for_dataset_name(self, dataset_name):
+        """
+        :param dataset_name: Column-view dataset name to get the configuration of e.g. "age", "s01e01".
+        :type dataset_name: str
+        :return: Column-view configuration with the given dataset name.
+        :rtype: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        """
+        return self._dataset_name_to_column_config[dataset_name]
+
+    def get_code(self, code_scheme, code_id):
+        """
+        Gets the code with the given id from an indexed code scheme.
+
+        :param code_scheme: Code scheme to get the code from.
+        :type code_scheme: core_data_modules.data_models.CodeScheme
+        :param code_id: Id of the code to get.
+        :type code_id: str
+        :return: Code with id `code_id` in `code_scheme`.
+        :rtype: core_data_modules.data_models.Code
+        """
+        return self._codes[(code_scheme.scheme_id, code_id)]
+
+    def get_matrix_columns(self, column_config):
+        """
+        Gets the matrix-format analysis file columns for the labels of a column-view configuration.
+
+        :param column_config: Indexed column-view configuration to get the matrix columns of.
+        :type column_config: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        :return: List of (code id, analysis file header) for each code in the configuration's code scheme, in code
+                 scheme order e.g. [("code-abc", "age:25"), ...]
+        :rtype: list of (str, str)
+        """
+        return self._matrix_columns[id(column_config)]
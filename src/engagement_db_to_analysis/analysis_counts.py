@@ -0,0 +1,378 @@
+# TODO: Move this file to CoreDataModules once stable.
+
+import csv
+from collections import OrderedDict
+
+from core_data_modules.analysis import analysis_utils
+from core_data_modules.cleaners import Codes
+
+
+def _percentage_str(x, y):
+    """
+    :param x: Numerator.
+    :type x: int
+    :param y: Denominator.
+    :type y: int
+    :return: `x` as a percentage of `y`, to 1 decimal place, or "-" if `y` is 0.
+    :rtype: str
+    """
+    if y == 0:
+        return "-"
+    return f"{x / y * 100:0.1f}"
+
+
+class _ColumnStatus:
+    def __init__(self, row, consent_withdrawn_field, column_config):
+        """
+        How a message or participant engaged with one column-view dataset.
+
+        This is read once per row and column-view dataset, and shared by every counter that needs it.
+
+        :param row: Message or participant column-view values.
+        :type row: dict
+        :param consent_withdrawn_field: Field in `row` that records whether the participant withdrew consent.
+        :type consent_withdrawn_field: str
+        :param column_config: Configuration of the column-view dataset.
+        :type column_config: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        """
+        self.opt_in = analysis_utils.opt_in(row, consent_withdrawn_field, column_config)
+        self.labelled = analysis_utils.labelled(row, consent_withdrawn_field, column_config)
+        self.relevant = analysis_utils.relevant(row, consent_withdrawn_field, column_config)
+        self.codes = analysis_utils.get_codes_from_td(row, column_config)
+        self.normal_codes = analysis_utils.normal_codes(self.codes) if self.relevant else []
+
+
+class EngagementCounts:
+    def __init__(self, rqa_column_configs):
+        """
+        Counts of the messages and participants that opted in, were labelled and were relevant to each RQA dataset.
+
+        :param rqa_column_configs: Configurations of the RQA column-view datasets to count.
+        :type rqa_column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        """
+        self.rqa_column_configs = rqa_column_configs
+
+        # Counts for each RQA dataset, and for all the RQA datasets together under "Total"
+        self.counts = OrderedDict()  # of dataset name -> (dict of count name -> int)
+        for column_config in rqa_column_configs + [None]:
+            self.counts["Total" if column_config is None else column_config.dataset_name] = {
+                "Messages": 0,
+                "Messages with Opt-Ins": 0,
+                "Labelled Messages": 0,
+                "Relevant Messages": 0,
+                "Participants": 0,
+                "Participants with Opt-Ins": 0,
+                "Relevant Participants": 0
+            }
+
+    def add_message(self, statuses):
+        """
+        :param statuses: How the message engaged with each column-view dataset.
+        :type statuses: dict of str -> _ColumnStatus
+        """
+        totals = self.counts["Total"]
+        totals["Messages"] += 1
+        for count_name, attribute in [("Messages with Opt-Ins", "opt_in"), ("Labelled Messages", "labelled"),
+                                      ("Relevant Messages", "relevant")]:
+            matched = False
+            for column_config in self.rqa_column_configs:
+                if getattr(statuses[column_config.dataset_name], attribute):
+                    self.counts[column_config.dataset_name][count_name] += 1
+                    matched = True
+            if matched:
+                totals[count_name] += 1
+
+    def add_participant(self, statuses):
+        """
+        :param statuses: How the participant engaged with each column-view dataset.
+        :type statuses: dict of str -> _ColumnStatus
+        """
+        totals = self.counts["Total"]
+        totals["Participants"] += 1
+        for count_name, attribute in [("Participants with Opt-Ins", "opt_in"), ("Relevant Participants", "relevant")]:
+            matched = False
+            for column_config in self.rqa_column_configs:
+                if getattr(statuses[column_config.dataset_name], attribute):
+                    self.counts[column_config.dataset_name][count_name] += 1
+                    matched = True
+            if matched:
+                totals[count_name] += 1
+
+    def export_csv(self, f):
+        """
+        Exports the engagement counts to a CSV, with one row for each RQA dataset then a "Total" row.
+
+        The total number of messages and participants is only given in the "Total" row.
+
+        :param f: File to write the CSV to.
+        :type f: file-like
+        """
+        headers = ["Dataset", "Messages", "Messages with Opt-Ins", "Labelled Messages", "Relevant Messages",
+                   "Participants", "Participants with Opt-Ins", "Relevant Participants"]
+        writer = csv.DictWriter(f, fieldnames=headers, lineterminator="\n")
+        writer.writeheader()
+        for dataset_name, counts in self.counts.items():
+            row = {"Dataset": dataset_name}
+            row.update(counts)
+            if dataset_name != "Total":
+                row["Messages"] = "-"
+                row["Participants"] = "-"
+            writer.writerow(row)
+
+
+class RepeatParticipations:
+    def __init__(self, rqa_column_configs):
+        """
+        Histogram of the number of RQA datasets each participant opted in to.
+
+        :param rqa_column_configs: Configurations of the RQA column-view datasets to count.
+        :type rqa_column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        """
+        self.rqa_column_configs = rqa_column_configs
+        self.participations = OrderedDict()  # of number of datasets participated in -> number of participants
+        for i in range(1, len(rqa_column_configs) + 1):
+            self.participations[i] = 0
+        self.participants_with_opt_ins = 0
+
+    def add_participant(self, statuses):
+        """
+        :param statuses: How the participant engaged with each column-view dataset.
+        :type statuses: dict of str -> _ColumnStatus
+        """
+        datasets_participated_in = sum(
+            1 for column_config in self.rqa_column_configs if statuses[column_config.dataset_name].opt_in
+        )
+        if datasets_participated_in > 0:
+            self.participations[datasets_participated_in] += 1
+            self.participants_with_opt_ins += 1
+
+    def export_csv(self, f):
+        """
+        :param f: File to write the CSV to.
+        :type f: file-like
+        """
+        headers = ["Number of Datasets Participated In", "Number of Participants with Opt-Ins",
+                   "% of Participants with Opt-Ins"]
+        writer = csv.DictWriter(f, fieldnames=headers, lineterminator="\n")
+        writer.writeheader()
+        for datasets_participated_in, participants in self.participations.items():
+            writer.writerow({
+                "Number of Datasets Participated In": datasets_participated_in,
+                "Number of Participants with Opt-Ins": participants,
+                "% of Participants with Opt-Ins": _percentage_str(participants, self.participants_with_opt_ins)
+            })
+
+
+class ThemeDistributions:
+    def __init__(self, theme_column_configs, breakdown_column_configs):
+        """
+        Number of relevant participants with each theme of each dataset, broken down by the codes of other datasets.
+
+        :param theme_column_configs: Configurations of the column-view datasets to count the themes of.
+        :type theme_column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        :param breakdown_column_configs: Configurations of the column-view datasets to break each theme's count down by.
+        :type breakdown_column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        """
+        self.theme_column_configs = theme_column_configs
+        self.breakdown_column_configs = breakdown_column_configs
+
+        self.breakdown_keys = []
+        for column_config in breakdown_column_configs:
+            for code in column_config.code_scheme.codes:
+                if code.control_code == Codes.STOP:
+                    continue
+                self.breakdown_keys.append(self._breakdown_key(column_config, code))
+
+        # The first theme of each dataset, "Total Relevant Participants", counts every relevant participant.
+        self.distributions = OrderedDict()  # of dataset name -> (OrderedDict of theme -> (dict of breakdown -> int))
+        for column_config in theme_column_configs:
+            themes = OrderedDict()
+            themes["Total Relevant Participants"] = self._make_breakdowns()
+            for code in analysis_utils.normal_codes(column_config.code_scheme.codes):
+                themes[code.string_value] = self._make_breakdowns()
+            self.distributions[column_config.dataset_name] = themes
+
+    @staticmethod
+    def _breakdown_key(column_config, code):
+        return f"{column_config.dataset_name}:{code.string_value}"
+
+    def _make_breakdowns(self):
+        breakdowns = {"Total Participants": 0}
+        for breakdown_key in self.breakdown_keys:
+            breakdowns[breakdown_key] = 0
+        return breakdowns
+
+    def add_participant(self, statuses):
+        """
+        :param statuses: How the participant engaged with each column-view dataset.
+        :type statuses: dict of str -> _ColumnStatus
+        """
+        theme_column_configs = [
+            column_config for column_config in self.theme_column_configs
+            if statuses[column_config.dataset_name].relevant
+        ]
+        if len(theme_column_configs) == 0:
+            return
+
+        # The participant's breakdowns are the same for every theme they are counted under, so find them once.
+        breakdown_keys = ["Total Participants"]
+        for column_config in self.breakdown_column_configs:
+            for code in statuses[column_config.dataset_name].codes:
+                if code.control_code != Codes.STOP:
+                    breakdown_keys.append(self._breakdown_key(column_config, code))
+
+        for column_config in theme_column_configs:
+            themes = self.distributions[column_config.dataset_name]
+            breakdowns_to_update = [themes["Total Relevant Participants"]]
+            breakdowns_to_update.extend(
+                themes[code.string_value] for code in statuses[column_config.dataset_name].normal_codes
+            )
+            for breakdowns in breakdowns_to_update:
+                for breakdown_key in breakdown_keys:
+                    breakdowns[breakdown_key] += 1
+
+    def export_csv(self, f):
+        """
+        Exports the theme distributions to a CSV, with one row for each theme of each dataset. Each count is followed by
+        its percentage of the same count for all the dataset's relevant participants.
+
+        :param f: File to write the CSV to.
+        :type f: file-like
+        """
+        headers = ["Dataset", "Theme"]
+        for breakdown_key in ["Total Participants"] + self.breakdown_keys:
+            headers.extend([breakdown_key, f"{breakdown_key} %"])
+        writer = csv.DictWriter(f, fieldnames=headers, lineterminator="\n")
+        writer.writeheader()
+        for dataset_name, themes in self.distributions.items():
+            totals = themes["Total Relevant Participants"]
+            for theme, breakdowns in themes.items():
+                row = {"Dataset": dataset_name, "Theme": theme}
+                for breakdown_key, count in breakdowns.items():
+                    row[breakdown_key] = count
+                    row[f"{breakdown_key} %"] = _percentage_str(count, totals[breakdown_key])
+                writer.writerow(row)
+
+
+class CrossTabs:
+    def __init__(self, column_config_1, column_config_2):
+        """
+        Number of participants relevant to two datasets with each pair of their themes.
+
+        :param column_config_1: Configuration of the column-view dataset to give each row of the cross-tabs.
+        :type column_config_1: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        :param column_config_2: Configuration of the column-view dataset to give each column of the cross-tabs.
+        :type column_config_2: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+        """
+        self.column_config_1 = column_config_1
+        self.column_config_2 = column_config_2
+        self.themes_2 = [code.string_value for code in analysis_utils.normal_codes(column_config_2.code_scheme.codes)]
+        self.counts = OrderedDict()  # of theme 1 -> (dict of theme 2 -> number of participants)
+        for code in analysis_utils.normal_codes(column_config_1.code_scheme.codes):
+            self.counts[code.string_value] = {theme_2: 0 for theme_2 in self.themes_2}
+
+    def add_participant(self, statuses):
+        """
+        :param statuses: How the participant engaged with each column-view dataset.
+        :type statuses: dict of str -> _ColumnStatus
+        """
+        status_1 = statuses[self.column_config_1.dataset_name]
+        status_2 = statuses[self.column_config_2.dataset_name]
+        if not (status_1.relevant and status_2.relevant):
+            return
+
+        for code_1 in status_1.normal_codes:
+            for code_2 in status_2.normal_codes:
+                self.counts[code_1.string_value][code_2.string_value] += 1
+
+    def export_csv(self, f):
+        """
+        :param f: File to write the CSV to.
+        :type f: file-like
+        """
+        headers = [self.column_config_1.dataset_name] + self.themes_2
+        writer = csv.DictWriter(f, fieldnames=headers, lineterminator="\n")
+        writer.writeheader()
+        for theme_1, counts in self.counts.items():
+            row = {self.column_config_1.dataset_name: theme_1}
+            row.update(counts)
+            writer.writerow(row)
+
+
+class AnalysisCounts:
+    def __init__(self, config_index, consent_withdrawn_field, cross_tabs=None):
+        """
+        Counts for the engagement counts, repeat participations, theme distributions, demographic distributions and
+        cross-tabs analyses, filled in a single pass over the messages and participants.
+
+        Each message and participant is read once, and how it engaged with each column-view dataset is shared between
+        all the counters, so configuring another cross-tab adds another counter rather than another pass over the data.
+
+        :param config_index: Index of the analysis dataset configurations.
+        :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+        :param consent_withdrawn_field: Field in each message and participant that records whether the participant
+                                        withdrew consent.
+        :type consent_withdrawn_field: str
+        :param cross_tabs: Pairs of column-view dataset names to count the cross-tabs of, or None to count none.
+        :type cross_tabs: list of (str, str) | None
+        """
+        self.consent_withdrawn_field = consent_withdrawn_field
+        rqa_column_configs = config_index.rqa_column_configs
+        demog_column_configs = config_index.demog_column_configs
+
+        self.engagement_counts = EngagementCounts(rqa_column_configs)
+        self.repeat_participations = RepeatParticipations(rqa_column_configs)
+        self.theme_distributions = ThemeDistributions(rqa_column_configs, demog_column_configs)
+        self.demographic_distributions = ThemeDistributions(demog_column_configs, [])
+        self.cross_tabs = OrderedDict()  # of (dataset name 1, dataset name 2) -> CrossTabs
+        for (dataset_name_1, dataset_name_2) in ([] if cross_tabs is None else cross_tabs):
+            self.cross_tabs[(dataset_name_1, dataset_name_2)] = CrossTabs(
+                config_index.get_column_config_for_dataset_name(dataset_name_1),
+                config_index.get_column_config_for_dataset_name(dataset_name_2)
+            )
+
+        self._message_column_configs = rqa_column_configs
+        self._participant_column_configs = list(rqa_column_configs) + list(demog_column_configs)
+        for cross_tab in self.cross_tabs.values():
+            for column_config in [cross_tab.column_config_1, cross_tab.column_config_2]:
+                if column_config not in self._participant_column_configs:
+                    self._participant_column_configs.append(column_config)
+
+    def _get_statuses(self, row, column_configs):
+        return {
+            column_config.dataset_name: _ColumnStatus(row, self.consent_withdrawn_field, column_config)
+            for column_config in column_configs
+        }
+
+    def add_messages(self, messages_by_column):
+        """
+        :param messages_by_column: Messages column-view data.
+        :type messages_by_column: iterable of dict | iterable of core_data_modules.traced_data.TracedData
+        """
+        for message in messages_by_column:
+            self.engagement_counts.add_message(self._get_statuses(message, self._message_column_configs))
+
+    def add_participants(self, participants_by_column):
+        """
+        :param participants_by_column: Participants column-view data.
+        :type participants_by_column: iterable of dict | iterable of core_data_modules.traced_data.TracedData
+        """
+        for participant in participants_by_column:
+            statuses = self._get_statuses(participant, self._participant_column_configs)
+            self.engagement_counts.add_participant(statuses)
+            self.repeat_participations.add_participant(statuses)
+            self.theme_distributions.add_participant(statuses)
+            self.demographic_distributions.add_participant(statuses)
+            for cross_tab in self.cross_tabs.values():
+                cross_tab.add_participant(statuses)
+
+    def get_cross_tabs(self, dataset_name_1, dataset_name_2):
+        """
+        :param dataset_name_1: Name of the column-view dataset that gives each row of the cross-tabs.
+        :type dataset_name_1: str
+        :param dataset_name_2: Name of the column-view dataset that gives each column of the cross-tabs.
+        :type dataset_name_2: str
+        :return: Cross-tabs counter for the given pair of datasets.
+        :rtype: CrossTabs
+        """
+        return self.cross_tabs[(dataset_name_1, dataset_name_2)]
@@ -5,7 +5,7 @@ from core_data_modules.logging import Logger
 from core_data_modules.traced_data.io import TracedDataCSVIO
 from core_data_modules.util import IOUtils
 
-from src.engagement_db_to_analysis.column_view_conversion import analysis_dataset_configs_to_column_configs
+from src.engagement_db_to_analysis.analysis_config_index import AnalysisConfigIndex
 
 log = Logger(__name__)
 
@@ -31,7 +31,7 @@ def export_production_file(traced_data_iterable, analysis_config, export_path):
 
 
 
-def _get_analysis_file_headers(pipeline_config, export_timestamps=False):
+def _get_analysis_file_headers(pipeline_config, config_index, export_timestamps=False):
     """
     Gets the headers for an analysis file.
 
@@ -44,6 +44,8 @@ def _get_analysis_file_headers(pipeline_config, export_timestamps=False):
     
     :param pipeline_config: Pipeline configuration to derive the headers from.
     :type pipeline_config: PipelineConfiguration
+    :param config_index: Index of the pipeline's analysis dataset configurations.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
     :return: Analysis file headers.
     :rtype: list of str
 
@@ -56,11 +58,10 @@ def _get_analysis_file_headers(pipeline_config, export_timestamps=False):
         for membership_group in pipeline_config.analysis.membership_group_configuration.membership_group_csv_urls.keys():
             headers.append(membership_group)
     
-    column_configs = analysis_dataset_configs_to_column_configs(pipeline_config.analysis.dataset_configurations)
-    for config in column_configs:
+    for config in config_index.column_configs:
         # Add headers for each label in this column's code scheme, in matrix format e.g. "age:25", "s01e01:healthcare"
-        for code in config.code_scheme.codes:
-            headers.append(f"{config.dataset_name}:{code.string_value}")
+        for code_id, header in config_index.get_matrix_columns(config):
+            headers.append(header)
 
         # Add the raw field to the headers.
         # If we've already seen this raw_field, move it to the end of the headers added so far so that the raw fields
@@ -72,7 +73,7 @@ def _get_analysis_file_headers(pipeline_config, export_timestamps=False):
     return headers
 
 
-def _get_analysis_file_row(column_view_td, pipeline_config, export_timestamps=False):
+def _get_analysis_file_row(column_view_td, pipeline_config, config_index, export_timestamps=False):
     """
     Gets a row of an analysis file from a Traced Data object in column-view format
 
@@ -80,12 +81,11 @@ def _get_analysis_file_row(column_view_td, pipeline_config, export_timestamps=Fa
     :type column_view_td: core_data_modules.traced_data.TracedData
     :param pipeline_config: Pipeline configuration.
     :type pipeline_config: PipelineConfiguration
+    :param config_index: Index of the pipeline's analysis dataset configurations.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
     :return: Dictionary representing a row of an analysis file
     :rtype: dict
     """
-    
-    column_configs = analysis_dataset_configs_to_column_configs(pipeline_config.analysis.dataset_configurations)
-
     row = {
         "participant_uuid": column_view_td["participant_uuid"],
         "consent_withdrawn": column_view_td["consent_withdrawn"]
@@ -98,42 +98,129 @@ def _get_analysis_file_row(column_view_td, pipeline_config, export_timestamps=Fa
     if export_timestamps:
         row["timestamp"] = column_view_td["timestamp"]
 
-    for config in column_configs:
+    for config in config_index.column_configs:
         # Raw field
         row[config.raw_field] = column_view_td[config.raw_field]
 
         # Labels, in matrix config
-        td_code_ids = [label["CodeID"] for label in column_view_td[config.coded_field]]
-        for code in config.code_scheme.codes:
-            if code.code_id in td_code_ids:
-                row[f"{config.dataset_name}:{code.string_value}"] = Codes.MATRIX_1
+        td_code_ids = {label["CodeID"] for label in column_view_td[config.coded_field]}
+        for code_id, header in config_index.get_matrix_columns(config):
+            if code_id in td_code_ids:
+                row[header] = Codes.MATRIX_1
             else:
-                row[f"{config.dataset_name}:{code.string_value}"] = Codes.MATRIX_0
+                row[header] = Codes.MATRIX_0
 
     return row
 
 
-def export_analysis_file(traced_data_iterable, pipeline_config, export_path, export_timestamps=False):
+def _get_analysis_file_row_layout(headers, pipeline_config, config_index, export_timestamps=False):
+    """
+    Gets the layout of the rows of an analysis file, for building the rows column-wise by position rather than by
+    header name.
+
+    :param headers: Analysis file headers. These must be unique. See `_get_analysis_file_headers`.
+    :type headers: list of str
+    :param pipeline_config: Pipeline configuration.
+    :type pipeline_config: PipelineConfiguration
+    :param config_index: Index of the pipeline's analysis dataset configurations.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+    :return: Tuple of:
+              - Template row, with every matrix column set to Codes.MATRIX_0.
+              - List of (column-view field, position) for each column that's copied from the column-view TracedData.
+              - List of (column-view coded field, dictionary of code id -> position) for each matrix-coded column.
+    :rtype: (list, list of (str, int), list of (str, dict of str -> int))
+    """
+    header_positions = {header: i for i, header in enumerate(headers)}
+
+    copied_fields = ["participant_uuid", "consent_withdrawn"]
+    if pipeline_config.analysis.membership_group_configuration is not None:
+        copied_fields.extend(pipeline_config.analysis.membership_group_configuration.membership_group_csv_urls.keys())
+    if export_timestamps:
+        copied_fields.append("timestamp")
+
+    template_row = [None] * len(headers)
+    coded_field_positions = []
+    for config in config_index.column_configs:
+        copied_fields.append(config.raw_field)
+
+        code_id_positions = dict()
+        for code_id, header in config_index.get_matrix_columns(config):
+            template_row[header_positions[header]] = Codes.MATRIX_0
+            code_id_positions[code_id] = header_positions[header]
+        coded_field_positions.append((config.coded_field, code_id_positions))
+
+    copied_field_positions = [(field, header_positions[field]) for field in copied_fields]
+
+    return template_row, copied_field_positions, coded_field_positions
+
+
+def _get_analysis_file_row_values(column_view_td, row_layout):
+    """
+    Gets a row of an analysis file from a Traced Data object in column-view format, as a list of values in header order.
+
+    :param column_view_td: Traced Data object to produce the row for.
+    :type column_view_td: core_data_modules.traced_data.TracedData
+    :param row_layout: Layout of the analysis file rows. See `_get_analysis_file_row_layout`.
+    :type row_layout: (list, list of (str, int), list of (str, dict of str -> int))
+    :return: Values of the row, in header order.
+    :rtype: list
+    """
+    template_row, copied_field_positions, coded_field_positions = row_layout
+
+    row = list(template_row)
+    for field, position in copied_field_positions:
+        row[position] = column_view_td[field]
+
+    # Labels, in matrix format. Only the columns for the codes that were assigned need updating from the template.
+    for coded_field, code_id_positions in coded_field_positions:
+        for label in column_view_td[coded_field]:
+            position = code_id_positions.get(label["CodeID"])
+            if position is not None:
+                row[position] = Codes.MATRIX_1
+
+    return row
+
+
+def export_analysis_file(traced_data_iterable, pipeline_config, export_path, export_timestamps=False, config_index=None):
     """
     Exports a column-view TracedData to a csv for analysis.
 
     This csv contains the participant uuids, raw responses, and assigned labels in matrix format.
 
+    The rows are built column-wise from a template row, setting only the positions of the fields and assigned labels
+    of each TracedData, and are written with a plain csv writer. This produces the same file as building and writing a
+    dictionary for each row, which is only done if the headers aren't unique.
+
     :param traced_data_iterable: Data to export.
     :type traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
     :pipeline_config: pipeline configuration module
     :type PipelineConfiguration:
     :param export_path: Path to export the file to.
     :type export_path: str
+    :param config_index: Index of the pipeline's analysis dataset configurations. If None, a new index is built.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex | None
     """
     log.info(f"Exporting analysis file to '{export_path}'...")
+    if config_index is None:
+        config_index = AnalysisConfigIndex(pipeline_config.analysis.dataset_configurations)
 
     IOUtils.ensure_dirs_exist_for_file(export_path)
     with open(export_path, "w") as f:
-        headers = _get_analysis_file_headers(pipeline_config, export_timestamps)
-        writer = csv.DictWriter(f, fieldnames=headers)
-        writer.writeheader()
-
-        for td in traced_data_iterable:
-            row = _get_analysis_file_row(td, pipeline_config, export_timestamps)
-            writer.writerow(row)
+        headers = _get_analysis_file_headers(pipeline_config, config_index, export_timestamps)
+
+        if len(set(headers)) != len(headers):
+            # Rows can't be built by position if the headers aren't unique, so write each row as a dictionary, which
+            # writes the last value set for a repeated header to every column with that header.
+            log.warning(f"Analysis file headers are not unique; exporting rows one dictionary at a time")
+            writer = csv.DictWriter(f, fieldnames=headers)
+            writer.writeheader()
+
+            for td in traced_data_iterable:
+                row = _get_analysis_file_row(td, pipeline_config, config_index, export_timestamps)
+                writer.writerow(row)
+            return
+
+        row_layout = _get_analysis_file_row_layout(headers, pipeline_config, config_index, export_timestamps)
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        writer.writerows(_get_analysis_file_row_values(td, row_layout) for td in traced_data_iterable)
@@ -1,14 +1,14 @@
-from core_data_modules.analysis import (engagement_counts, repeat_participations, theme_distributions, sample_messages,
-                                        AnalysisConfiguration, traffic_analysis, cross_tabs)
-from core_data_modules.analysis.mapping import participation_maps, kenya_mapper, somalia_mapper, mapping_utils
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from core_data_modules.analysis import sample_messages, traffic_analysis
 from core_data_modules.logging import Logger
 from core_data_modules.util import IOUtils
 
-from src.engagement_db_to_analysis.column_view_conversion import (analysis_dataset_configs_to_rqa_column_configs,
-                                                                  analysis_dataset_configs_to_demog_column_configs,
-                                                                  analysis_dataset_configs_to_column_configs)
-
-from src.engagement_db_to_analysis.configuration import AnalysisLocations, MapConfiguration
+from src.engagement_db_to_analysis.analysis_config_index import AnalysisConfigIndex
+from src.engagement_db_to_analysis.analysis_counts import AnalysisCounts
+from src.engagement_db_to_analysis.map_rendering import export_participation_maps
 from src.engagement_db_to_analysis.regression_analysis.complete_case_regression_analysis import \
     export_all_complete_case_regression_analysis_txt
 from src.engagement_db_to_analysis.regression_analysis.multiple_imputation_regression_analysis import \
@@ -16,156 +16,259 @@ from src.engagement_db_to_analysis.regression_analysis.multiple_imputation_regre
 
 log = Logger(__name__)
 
-MAPPERS = {
-    AnalysisLocations.KENYA_COUNTY: kenya_mapper.export_kenya_counties_map,
-    AnalysisLocations.KENYA_CONSTITUENCY: kenya_mapper.export_kenya_constituencies_map,
-
-    AnalysisLocations.MOGADISHU_SUB_DISTRICT: somalia_mapper.export_mogadishu_sub_district_frequencies_map,
-    AnalysisLocations.SOMALIA_DISTRICT: somalia_mapper.export_somalia_district_frequencies_map,
-    AnalysisLocations.SOMALIA_REGION: somalia_mapper.export_somalia_region_frequencies_map
-}
+def _read_column_view_values(column_traced_data_iterable):
+    """
+    Reads the current values of each column-view TracedData into a plain dictionary.
 
+    Reading a value from a TracedData has to search its history, which is long for column-view TracedData. Each
+    analysis reads every column of every participant or message, so reading the values once and running all the
+    analyses on the plain dictionaries is much faster than having each analysis read the TracedData again.
 
-def _get_column_config_with_dataset_name(dataset_name, column_configs):
-    """
-    Gets the column configuration with the given dataset_name.
-
-    :param dataset_name: Dataset to look-up.
-    :type dataset_name: str
-    :param column_configs: Configurations to search.
-    :type column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
-    :return: Configuration with dataset_name property `dataset_name`.
-    :rtype: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param column_traced_data_iterable: Column-view TracedData to read.
+    :type column_traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
+    :return: The values of each TracedData, in the same order as `column_traced_data_iterable`. The values are shared
+             with the TracedData, so must not be modified.
+    :rtype: list of dict
     """
-    for column_config in column_configs:
-        if column_config.dataset_name == dataset_name:
-            return column_config
-    raise LookupError(dataset_name)
+    return [dict(td) for td in column_traced_data_iterable]
 
 
-def run_automated_analysis(messages_by_column, participants_by_column, analysis_config, export_dir_path, export_large_files=False):
-    """
-    Runs automated analysis and exports the results to disk.
+class _AutomatedAnalysisData:
+    def __init__(self, messages_by_column, participants_by_column, analysis_counts, analysis_config, config_index,
+                 export_dir_path, regression_workers, map_workers, cache, export_large_files):
+        """
+        Data shared by every automated analysis exporter.
+
+        :param messages_by_column: Values of the messages column-view data.
+        :type messages_by_column: list of dict
+        :param participants_by_column: Values of the participants column-view data.
+        :type participants_by_column: list of dict
+        :param analysis_counts: Counts for the engagement counts, repeat participations, theme distributions,
+                                demographic distributions and cross-tabs analyses.
+        :type analysis_counts: src.engagement_db_to_analysis.analysis_counts.AnalysisCounts
+        :param analysis_config: Configuration for the export.
+        :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+        :param config_index: Index of `analysis_config.dataset_configurations`.
+        :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+        :param export_dir_path: Directory to export the automated analysis files to.
+        :type export_dir_path: str
+        :param regression_workers: Number of worker processes to run the multiple-imputation regression analysis in.
+        :type regression_workers: int
+        :param map_workers: Number of worker processes to draw the participation maps in.
+        :type map_workers: int
+        :param cache: Cache of regression results and participation maps.
+        :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
+        :param export_large_files: Whether to export large files.
+        :type export_large_files: bool
+        """
+        self.messages_by_column = messages_by_column
+        self.participants_by_column = participants_by_column
+        self.analysis_counts = analysis_counts
+        self.analysis_config = analysis_config
+        self.config_index = config_index
+        self.rqa_column_configs = config_index.rqa_column_configs
+        self.demog_column_configs = config_index.demog_column_configs
+        self.export_dir_path = export_dir_path
+        self.regression_workers = regression_workers
+        self.map_workers = map_workers
+        self.cache = cache
+        self.export_large_files = export_large_files
 
-    :param messages_by_column: Messages traced data in column-view format.
-    :type messages_by_column: iterable of core_data_modules.traced_data.TracedData
-    :param participants_by_column: Participants traced data in column-view format.
-    :type participants_by_column: iterable of core_data_modules.traced_data.TracedData
-    :param analysis_config: Configuration for the export.
-    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
-    :param export_dir_path: Directory to export the automated analysis files to.
-    :type export_dir_path: str
-    """
-    log.info(f"Running automated analysis...")
-    all_column_configs = analysis_dataset_configs_to_column_configs(analysis_config.dataset_configurations)
-    rqa_column_configs = analysis_dataset_configs_to_rqa_column_configs(analysis_config.dataset_configurations)
-    demog_column_configs = analysis_dataset_configs_to_demog_column_configs(analysis_config.dataset_configurations)
-    IOUtils.ensure_dirs_exist(export_dir_path)
 
+def _export_engagement_counts(data):
     log.info(f"Exporting engagement counts.csv...")
-    with open(f"{export_dir_path}/engagement_counts.csv", "w") as f:
-        engagement_counts.export_engagement_counts_csv(
-            messages_by_column, participants_by_column, "consent_withdrawn", rqa_column_configs, f
-        )
+    with open(f"{data.export_dir_path}/engagement_counts.csv", "w") as f:
+        data.analysis_counts.engagement_counts.export_csv(f)
+
 
+def _export_repeat_participations(data):
     log.info("Exporting repeat participations...")
-    with open(f"{export_dir_path}/repeat_participations.csv", "w") as f:
-        repeat_participations.export_repeat_participations_csv(
-            participants_by_column, "consent_withdrawn", rqa_column_configs, f
-        )
+    with open(f"{data.export_dir_path}/repeat_participations.csv", "w") as f:
+        data.analysis_counts.repeat_participations.export_csv(f)
+
 
+def _export_theme_distributions(data):
     log.info("Exporting theme distributions...")
-    with open(f"{export_dir_path}/theme_distributions.csv", "w") as f:
-        theme_distributions.export_theme_distributions_csv(
-            participants_by_column, "consent_withdrawn", rqa_column_configs, demog_column_configs, f
-        )
+    with open(f"{data.export_dir_path}/theme_distributions.csv", "w") as f:
+        data.analysis_counts.theme_distributions.export_csv(f)
 
+
+def _export_demographic_distributions(data):
     log.info("Exporting demographic distributions...")
-    with open(f"{export_dir_path}/demographic_distributions.csv", "w") as f:
-        theme_distributions.export_theme_distributions_csv(
-            participants_by_column, "consent_withdrawn", demog_column_configs, [], f
+    with open(f"{data.export_dir_path}/demographic_distributions.csv", "w") as f:
+        data.analysis_counts.demographic_distributions.export_csv(f)
+
+
+def _export_cross_tabs(data, cross_tab_dataset_1, cross_tab_dataset_2):
+    log.info(f"Exporting cross-tabs for {cross_tab_dataset_1} and {cross_tab_dataset_2}...")
+    with open(f"{data.export_dir_path}/cross_tabs_{cross_tab_dataset_1}_vs_{cross_tab_dataset_2}.csv", "w") as f:
+        data.analysis_counts.get_cross_tabs(cross_tab_dataset_1, cross_tab_dataset_2).export_csv(f)
+
+
+def _export_sample_messages(data):
+    log.info("Exporting up to 100 sample messages for each RQA code...")
+    with open(f"{data.export_dir_path}/sample_messages.csv", "w") as f:
+        sample_messages.export_sample_messages_csv(
+            data.messages_by_column, "consent_withdrawn", data.rqa_column_configs, f, limit_per_code=100
         )
 
+
+def _export_traffic_analysis(data):
+    log.info("Exporting traffic analysis...")
+    with open(f"{data.export_dir_path}/traffic_analysis.csv", "w") as f:
+        traffic_analysis.export_traffic_analysis_csv(
+            data.messages_by_column, "consent_withdrawn", data.rqa_column_configs, "timestamp",
+            data.analysis_config.traffic_labels, f
+        )
+
+
+def _export_complete_case_regression(data):
+    log.info(f"Running experimental complete-case regression analysis...")
+    with open(f"{data.export_dir_path}/complete_case_regression.txt", "w") as f:
+        export_all_complete_case_regression_analysis_txt(
+            data.participants_by_column, "consent_withdrawn", data.rqa_column_configs, data.demog_column_configs, f,
+            cache=data.cache
+        )
+
+
+def _export_multiple_imputation_regression(data):
+    log.info(f"Running experimental multiple-imputation regression analysis...")
+    with open(f"{data.export_dir_path}/multiple_imputation_regression.txt", "w") as f:
+        export_all_multiple_imputation_regression_analysis_txt(
+            data.participants_by_column, "consent_withdrawn", data.rqa_column_configs, data.demog_column_configs, f,
+            workers=data.regression_workers, cache=data.cache
+        )
+
+
+def _export_participation_maps(data):
+    log.info(f"Exporting participation maps for each location dataset...")
+    export_participation_maps(
+        data.participants_by_column, data.analysis_config, data.config_index, data.export_dir_path,
+        workers=data.map_workers, cache=data.cache
+    )
+
+
+def _get_exporters(analysis_config, export_large_files):
+    """
+    :param analysis_config: Configuration for the export.
+    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+    :param export_large_files: Whether to export large files.
+    :type export_large_files: bool
+    :return: The exporters to run for this configuration. Each exporter writes different files, so they can be run in
+             any order.
+    :rtype: list of (func of _AutomatedAnalysisData)
+    """
+    exporters = [
+        _export_engagement_counts,
+        _export_repeat_participations,
+        _export_theme_distributions,
+        _export_demographic_distributions
+    ]
+
     if analysis_config.cross_tabs is not None:
-        for cross_tabs_config in analysis_config.cross_tabs:
-            (cross_tab_dataset_1, cross_tab_dataset_2) = cross_tabs_config
-            log.info(f"Exporting cross-tabs for {cross_tab_dataset_1} and {cross_tab_dataset_2}...")
-            cross_tab_column_config_1 = _get_column_config_with_dataset_name(cross_tab_dataset_1, all_column_configs)
-            cross_tab_column_config_2 = _get_column_config_with_dataset_name(cross_tab_dataset_2, all_column_configs)
-            with open(f"{export_dir_path}/cross_tabs_{cross_tab_dataset_1}_vs_{cross_tab_dataset_2}.csv", "w") as f:
-                cross_tabs.export_cross_tabs_csv(
-                    participants_by_column, "consent_withdrawn", cross_tab_column_config_1, cross_tab_column_config_2, f
-                )
+        for (cross_tab_dataset_1, cross_tab_dataset_2) in analysis_config.cross_tabs:
+            exporters.append(partial(_export_cross_tabs, cross_tab_dataset_1=cross_tab_dataset_1,
+                                     cross_tab_dataset_2=cross_tab_dataset_2))
     else:
         log.debug(f"Not exporting any cross-tabs because `analysis_config.cross_tabs` was None")
 
-    log.info("Exporting up to 100 sample messages for each RQA code...")
-    with open(f"{export_dir_path}/sample_messages.csv", "w") as f:
-        sample_messages.export_sample_messages_csv(
-            messages_by_column, "consent_withdrawn", rqa_column_configs, f, limit_per_code=100
-        )
+    exporters.append(_export_sample_messages)
 
     if analysis_config.traffic_labels is not None:
-        log.info("Exporting traffic analysis...")
-        with open(f"{export_dir_path}/traffic_analysis.csv", "w") as f:
-            traffic_analysis.export_traffic_analysis_csv(
-                messages_by_column, "consent_withdrawn", rqa_column_configs, "timestamp",
-                analysis_config.traffic_labels, f
-            )
+        exporters.append(_export_traffic_analysis)
     else:
         log.debug("Not running any traffic analysis because analysis_configuration.traffic_labels is None")
 
     if analysis_config.enable_experimental_regression_analysis:
-        log.info(f"Running experimental complete-case regression analysis...")
-        with open(f"{export_dir_path}/complete_case_regression.txt", "w") as f:
-            export_all_complete_case_regression_analysis_txt(
-                participants_by_column, "consent_withdrawn", rqa_column_configs, demog_column_configs, f
-            )
-
-        log.info(f"Running experimental multiple-imputation regression analysis...")
-        with open(f"{export_dir_path}/multiple_imputation_regression.txt", "w") as f:
-            export_all_multiple_imputation_regression_analysis_txt(
-                participants_by_column, "consent_withdrawn", rqa_column_configs, demog_column_configs, f
-            )
+        exporters.append(_export_complete_case_regression)
+        exporters.append(_export_multiple_imputation_regression)
 
     if export_large_files:
-        log.info(f"Exporting participation maps for each location dataset...")
-        mappers = {
-            AnalysisLocations.KENYA_COUNTY: kenya_mapper.export_kenya_counties_map,
-            AnalysisLocations.KENYA_CONSTITUENCY: kenya_mapper.export_kenya_constituencies_map,
-
-            AnalysisLocations.MOGADISHU_SUB_DISTRICT: somalia_mapper.export_mogadishu_sub_district_frequencies_map,
-            AnalysisLocations.SOMALIA_DISTRICT: somalia_mapper.export_somalia_district_frequencies_map,
-            AnalysisLocations.SOMALIA_REGION: somalia_mapper.export_somalia_region_frequencies_map
-        }
-        
-        map_configurations = analysis_config.maps
-        if map_configurations is None:
-            map_configurations = []
-            for analysis_dataset_config in analysis_config.dataset_configurations:
-                for coding_config in analysis_dataset_config.coding_configs:
-                    if coding_config.analysis_location in MAPPERS:
-                        map_configurations.append(MapConfiguration(coding_config.analysis_location))
-
-        log.info(f"Exporting participation maps for locations "
-                f"{[config.analysis_location for config in map_configurations]}...")
-
-        for map_config in map_configurations:
-            dataset_config, coding_config = analysis_config.get_configurations_for_analysis_location(
-                map_config.analysis_location
-            )
-
-            column_config = AnalysisConfiguration(
-                dataset_name=coding_config.analysis_dataset,
-                raw_field=dataset_config.raw_dataset,
-                coded_field=f"{coding_config.analysis_dataset}_labels",
-                code_scheme=coding_config.code_scheme
-            )
-
-            participation_maps.export_participation_maps(
-                participants_by_column, "consent_withdrawn", rqa_column_configs, column_config,
-                lambda x, y: (MAPPERS[coding_config.analysis_location](
-                    x, y, region_filter=map_config.region_filter, legend_position=map_config.legend_position)
-                ),
-                f"{export_dir_path}/maps/{column_config.dataset_name}/{column_config.dataset_name}_"
-            )
+        exporters.append(_export_participation_maps)
+
+    return exporters
+
+
+# Data and exporters shared by every exporter run in a worker process. These are set once per worker by
+# `_init_worker`, so that the column-view data only needs to be sent to each worker once, rather than once per exporter.
+_worker_data = None
+_worker_exporters = None
+
+
+def _init_worker(data, exporters):
+    global _worker_data, _worker_exporters
+    _worker_data = data
+    _worker_exporters = exporters
+
+
+def _run_exporter_in_worker(exporter_index):
+    _worker_exporters[exporter_index](_worker_data)
+
+
+def run_automated_analysis(messages_by_column, participants_by_column, analysis_config, export_dir_path, export_large_files=False,
+                           config_index=None, regression_workers=1, cache=None, map_workers=1, export_workers=1):
+    """
+    Runs automated analysis and exports the results to disk.
+
+    The column-view data is read once, in a single pass over the messages and participants. A second pass over the
+    values that were read fills the counts for the engagement counts, repeat participations, theme distributions,
+    demographic distributions and every cross-tab at once, and those files are then written from the counts. The other
+    analyses are run on the values that were read.
+
+    Each analysis exports to different files, so when `export_workers` > 1 the analyses are run concurrently, each in
+    one of a pool of worker processes, and export the same files as when run one after another.
+
+    :param messages_by_column: Messages traced data in column-view format.
+    :type messages_by_column: iterable of core_data_modules.traced_data.TracedData
+    :param participants_by_column: Participants traced data in column-view format.
+    :type participants_by_column: iterable of core_data_modules.traced_data.TracedData
+    :param analysis_config: Configuration for the export.
+    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+    :param export_dir_path: Directory to export the automated analysis files to.
+    :type export_dir_path: str
+    :param config_index: Index of `analysis_config.dataset_configurations`. If None, a new index is built.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex | None
+    :param regression_workers: Number of worker processes to run the multiple-imputation regression analysis in.
+    :type regression_workers: int
+    :param cache: Cache to read and write regression results and participation maps in, so that regressions and maps
+                  of unchanged data are not re-computed. If None, everything is computed and nothing is cached.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
+    :param map_workers: Number of worker processes to draw the participation maps in.
+    :type map_workers: int
+    :param export_workers: Number of worker processes to run the analyses in. If 1, runs every analysis in this
+                           process, one after another.
+    :type export_workers: int
+    """
+    log.info(f"Running automated analysis...")
+    if config_index is None:
+        config_index = AnalysisConfigIndex(analysis_config.dataset_configurations)
+    IOUtils.ensure_dirs_exist(export_dir_path)
+
+    log.info(f"Reading the column-view data to analyse...")
+    messages_by_column = _read_column_view_values(messages_by_column)
+    participants_by_column = _read_column_view_values(participants_by_column)
+
+    log.info(f"Counting engagement, repeat participations, theme distributions and cross-tabs...")
+    analysis_counts = AnalysisCounts(config_index, "consent_withdrawn", analysis_config.cross_tabs)
+    analysis_counts.add_messages(messages_by_column)
+    analysis_counts.add_participants(participants_by_column)
+
+    data = _AutomatedAnalysisData(
+        messages_by_column, participants_by_column, analysis_counts, analysis_config, config_index, export_dir_path,
+        regression_workers, map_workers, cache, export_large_files
+    )
+    exporters = _get_exporters(analysis_config, export_large_files)
+
+    if export_workers == 1:
+        for exporter in exporters:
+            exporter(data)
+        return
+
+    # Start the workers with "fork", so that the column-view data and configuration are inherited by the workers rather
+    # than pickled, because the configuration may contain lambdas e.g. in a `MapConfiguration.region_filter`.
+    log.info(f"Running {len(exporters)} automated analysis exporters in {export_workers} worker processes...")
+    with ProcessPoolExecutor(max_workers=export_workers, mp_context=multiprocessing.get_context("fork"),
+                             initializer=_init_worker, initargs=(data, exporters)) as executor:
+        futures = [executor.submit(_run_exporter_in_worker, i) for i in range(len(exporters))]
+        for future in futures:
+            future.result()
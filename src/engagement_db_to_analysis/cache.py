@@ -1,10 +1,15 @@
 from os import path
 import json
+import os
+import shutil
 
+from core_data_modules.logging import Logger
 from core_data_modules.util import IOUtils
 
 from src.common.cache import Cache
 
+log = Logger(__name__)
+
 
 class AnalysisCache(Cache):
     def _latest_message_timestamp_path(self, engagement_db_dataset):
@@ -32,36 +37,209 @@ class AnalysisCache(Cache):
         """
         self.set_date_time(engagement_db_dataset, latest_timestamp)
 
+    def _synced_uuids_path(self, group_name):
+        return f"{self.cache_dir}/rapid_pro_adverts/{group_name}.jsonl"
+
+    def get_synced_uuids(self, group_name):
+        """
+        Gets the participants_uuids that have been synced to the given rapid pro group.
+
+        If the last line of the journal is incomplete, because a previous run stopped part-way through appending to it,
+        that line is ignored. Compact the journal with `set_synced_uuids` before appending to it again.
+
+        :param group_name: name of the rapid pro group.
+        :type group_name: str
+        :return: participants uuids synced to the given rapid pro group, or an empty set if there are none.
+        :rtype: set of str
+        """
+        participants_uuids = set()
+        try:
+            with open(self._synced_uuids_path(group_name)) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return participants_uuids
+
+        # The file is an append-only journal of one uuid per line. Files written by earlier versions of this cache
+        # contain a single line with a list of all the synced uuids instead.
+        for i, line in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                if i != len(lines) - 1:
+                    raise
+                log.warning(f"Ignoring incomplete last line in the synced uuids journal for group '{group_name}': "
+                            f"{repr(line)}")
+                continue
+
+            if isinstance(entry, list):
+                participants_uuids.update(entry)
+            else:
+                participants_uuids.add(entry["participant_uuid"])
+
+        return participants_uuids
+
     def set_synced_uuids(self, group_name, participants_uuids):
         """
-        Sets a set of participants_uuids for the given rapid pro group.
+        Replaces all the participants_uuids synced to the given rapid pro group with the given uuids.
+
+        Use this to compact the journal written by `add_synced_uuids`.
 
         :param group_name: name of the rapid pro group.
         :type group_name: str
         :param participants_uuids: participants uuids to set, for the given rapid pro group.
-        :type participants_uuids: list of participants uuids
+        :type participants_uuids: iterable of str
         """
-        export_file_path = path.join(f"{self.cache_dir}/rapid_pro_adverts/{group_name}.jsonl")
-        IOUtils.ensure_dirs_exist_for_file(export_file_path)
-        with open(export_file_path, "w") as f:
-            f.write(json.dumps(participants_uuids))
+        export_path = self._synced_uuids_path(group_name)
+        temp_path = f"{self.cache_dir}/rapid_pro_adverts/.{group_name}_temp.jsonl"
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        with open(temp_path, "w") as f:
+            for participant_uuid in sorted(participants_uuids):
+                f.write(json.dumps({"participant_uuid": participant_uuid}))
+                f.write("\n")
+        os.replace(temp_path, export_path)
 
-    def get_synced_uuids(self, group_name):
+    def add_synced_uuids(self, group_name, participants_uuids):
         """
-        Gets a set of participants_uuids for the given rapid pro group.
+        Appends the given participants_uuids to the uuids synced to the given rapid pro group.
 
         :param group_name: name of the rapid pro group.
         :type group_name: str
-        :retun participants_uuids: participants uuids for the given rapid pro group or none if not found.
-        :rtype participants_uuids: list of participants uuids | None
+        :param participants_uuids: participants uuids just synced to the given rapid pro group.
+        :type participants_uuids: iterable of str
+        """
+        export_path = self._synced_uuids_path(group_name)
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        with open(export_path, "a") as f:
+            for participant_uuid in participants_uuids:
+                f.write(json.dumps({"participant_uuid": participant_uuid}))
+                f.write("\n")
+
+    def _delete_cached_files_except(self, dir_path, file_extension, cache_keys, cache_key_prefix=""):
         """
+        Deletes the files cached in `dir_path` under keys starting with `cache_key_prefix`, other than those cached under
+        `cache_keys`.
 
-        previous_export_file_path = path.join(f"{self.cache_dir}/rapid_pro_adverts/{group_name}.jsonl")
+        :return: Number of files deleted.
+        :rtype: int
+        """
         try:
-            with open(previous_export_file_path) as f:
-                participants_uuids = json.load(f)
+            file_names = os.listdir(dir_path)
+        except FileNotFoundError:
+            return 0
+
+        deleted = 0
+        for file_name in file_names:
+            # Skip temporary files, which start with ".", and files that aren't in this cache.
+            if file_name.startswith(".") or not file_name.endswith(file_extension):
+                continue
+            cache_key = file_name[:-len(file_extension)]
+            if cache_key.startswith(cache_key_prefix) and cache_key not in cache_keys:
+                os.remove(f"{dir_path}/{file_name}")
+                deleted += 1
+        return deleted
+
+    def _regression_results_path(self, cache_key):
+        return f"{self.cache_dir}/regression_results/{cache_key}.json"
+
+    def get_regression_results(self, cache_key):
+        """
+        Gets the regression results that were cached under the given key.
 
+        :param cache_key: Key of the results to get.
+                          See `src.engagement_db_to_analysis.regression_analysis.regression_results_cache`.
+        :type cache_key: str
+        :return: Dictionary of theme -> regression results table, or None if there are no results cached under this key.
+        :rtype: dict of str -> str | None
+        """
+        try:
+            with open(self._regression_results_path(cache_key)) as f:
+                return json.load(f)
         except FileNotFoundError:
-            return []
+            return None
 
-        return participants_uuids
+    def set_regression_results(self, cache_key, results):
+        """
+        Caches regression results under the given key.
+
+        :param cache_key: Key to cache the results under.
+                          See `src.engagement_db_to_analysis.regression_analysis.regression_results_cache`.
+        :type cache_key: str
+        :param results: Dictionary of theme -> regression results table.
+        :type results: dict of str -> str
+        """
+        export_path = self._regression_results_path(cache_key)
+        temp_path = f"{self.cache_dir}/regression_results/.{cache_key}_temp.json"
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        with open(temp_path, "w") as f:
+            json.dump(results, f)
+        os.replace(temp_path, export_path)
+
+    def delete_regression_results_except(self, analysis_name, cache_keys):
+        """
+        Deletes every cached result of the given regression analysis, other than those cached under the given keys.
+
+        Call this at the end of a run with the keys of every result of this analysis used in that run, so that results
+        for data that has since changed don't accumulate in the cache.
+
+        :param analysis_name: Name of the regression analysis to delete results of e.g. "complete_case_regression".
+                              See `src.engagement_db_to_analysis.regression_analysis.regression_results_cache`.
+        :type analysis_name: str
+        :param cache_keys: Keys of the results to keep.
+        :type cache_keys: set of str
+        :return: Number of results deleted.
+        :rtype: int
+        """
+        return self._delete_cached_files_except(
+            f"{self.cache_dir}/regression_results", ".json", cache_keys, f"{analysis_name}_"
+        )
+
+    def _participation_map_path(self, cache_key):
+        return f"{self.cache_dir}/participation_maps/{cache_key}.png"
+
+    def get_participation_map(self, cache_key, export_path):
+        """
+        Copies the participation map that was cached under the given key to `export_path`, if there is one.
+
+        :param cache_key: Key of the map to get. See `src.engagement_db_to_analysis.map_rendering`.
+        :type cache_key: str
+        :param export_path: Path to copy the cached map to.
+        :type export_path: str
+        :return: Whether a map was cached under this key, and so was copied to `export_path`.
+        :rtype: bool
+        """
+        cached_path = self._participation_map_path(cache_key)
+        if not path.exists(cached_path):
+            return False
+
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        shutil.copyfile(cached_path, export_path)
+        return True
+
+    def set_participation_map(self, cache_key, map_path):
+        """
+        Caches a copy of a participation map under the given key.
+
+        :param cache_key: Key to cache the map under. See `src.engagement_db_to_analysis.map_rendering`.
+        :type cache_key: str
+        :param map_path: Path to the map to cache.
+        :type map_path: str
+        """
+        export_path = self._participation_map_path(cache_key)
+        temp_path = f"{self.cache_dir}/participation_maps/.{cache_key}_temp.png"
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        shutil.copyfile(map_path, temp_path)
+        os.replace(temp_path, export_path)
+
+    def delete_participation_maps_except(self, cache_keys):
+        """
+        Deletes every cached participation map, other than those cached under the given keys.
+
+        Call this at the end of a run with the keys of every map used in that run, so that maps of data that has since
+        changed don't accumulate in the cache.
+
+        :param cache_keys: Keys of the maps to keep.
+        :type cache_keys: set of str
+        :return: Number of maps deleted.
+        :rtype: int
+        """
+        return self._delete_cached_files_except(f"{self.cache_dir}/participation_maps", ".png", cache_keys)
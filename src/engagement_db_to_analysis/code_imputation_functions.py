@@ -7,20 +7,19 @@ from core_data_modules.data_models.code_scheme import CodeTypes
 from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata
 from core_data_modules.util import TimeUtils
-from engagement_database.data_models import Message
 
-from src.engagement_db_to_analysis.column_view_conversion import (analysis_dataset_configs_to_column_configs,
-                                                                  analysis_dataset_configs_to_demog_column_configs,
-                                                                  coding_config_to_column_config)
-from src.engagement_db_to_analysis.column_view_conversion import (get_latest_labels_with_code_scheme,
-                                                                  analysis_dataset_config_for_message)
+from src.engagement_db_to_analysis.analysis_config_index import AnalysisConfigIndex
+from src.engagement_db_to_analysis.column_view_conversion import (coding_config_to_column_config,
+                                                                  get_latest_labels_with_code_scheme)
 from src.engagement_db_to_analysis.configuration import AnalysisLocations
+from src.engagement_db_to_analysis.message_view_cache import MessageViewCache
+from src.engagement_db_to_analysis.provenance import StepProvenance
 
 log = Logger(__name__)
 
 
-def _clear_latest_labels(user, message_td, code_schemes):
-    message = Message.from_dict(dict(message_td))
+def _clear_latest_labels(provenance, message_td, code_schemes, message_views):
+    message = message_views.get_message(message_td)
     code_scheme_ids = [code_scheme.scheme_id for code_scheme in code_schemes]
     for label in message.get_latest_labels():
         cleared_label = None
@@ -35,31 +34,34 @@ def _clear_latest_labels(user, message_td, code_schemes):
         assert cleared_label is not None, f"Label to be cleared had scheme_id {label.scheme_id}, but this was not " \
                                           f"present in any of the given code schemes. Do you need to add this code " \
                                           f"scheme to the analysis configuration?"
-        _insert_label_to_message_td(user, message_td, cleared_label)
+        _insert_label_to_message_td(provenance, message_td, cleared_label, message_views)
 
 
-def _insert_label_to_message_td(user, message_traced_data, label):
+def _insert_label_to_message_td(provenance, message_traced_data, label, message_views):
     """
-    Inserts a new label to the list of labels for this message, and writes-back to TracedData.
+    Inserts a new label to the list of labels for this message, writes-back to TracedData, and invalidates the cached
+    typed view of the message.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
+    :param provenance: Provenance of the pipeline step inserting the label.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
     :param message_traced_data: Message TracedData objects to impute age_category.
     :type message_traced_data: TracedData
     :param label: New label to insert to the message_traced_data
     :type: core_data_modules.data_models.Label
+    :param message_views: Cache of typed message views, to invalidate the view of `message_traced_data` in.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache
     """
     label = label.to_dict()
     message_labels = message_traced_data["labels"].copy()
     message_labels.insert(0, label)
     message_traced_data.append_data(
-        {"labels": message_labels},
-        Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+        {"labels": message_labels}, provenance.metadata())
+    message_views.invalidate(message_traced_data)
 
 
-def _impute_not_reviewed_labels(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme):
+def _impute_not_reviewed_labels(provenance, message_td, code_schemes, message_views):
     """
-    Imputes Codes.NOT_REVIEWED label for messages that have not been manually checked in coda.
+    Imputes Codes.NOT_REVIEWED label for a message that has not been manually checked in coda.
 
     A message is considered to be manually checked if it contains only labels which are checked. Messages that fall
     into this case will not be modified.
@@ -68,72 +70,62 @@ def _impute_not_reviewed_labels(user, messages_traced_data, analysis_dataset_con
 
     If a message contains a mix of checked and unchecked labels, the labels will be replaced with Codes.CODING_ERROR.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute not reviewed labels.
-    :type messages_traced_data: list of TracedData
-    :param analysis_dataset_configs: Analysis dataset configuration in pipeline configuration module.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
-    :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
-    :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param message_td: Message TracedData object to impute not reviewed labels for.
+    :type message_td: TracedData
+    :param code_schemes: Code schemes to check and impute under: the normal code schemes for this message's analysis
+                         dataset followed by the WS - Correct Dataset code scheme.
+    :type code_schemes: list of core_data_modules.data_models.CodeScheme
+    :param message_views: Cache of typed message views.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache
+    :return: The control code that was imputed (Codes.NOT_REVIEWED or Codes.CODING_ERROR), or None if the message was
+             not modified.
+    :rtype: str | None
     """
+    message = message_views.get_message(message_td)
 
-    log.info(f"Imputing {Codes.NOT_REVIEWED} labels...")
-    messages_with_nr_imputed = 0
-    messages_with_ce_imputed = 0
-    for message_td in messages_traced_data:
-        message = Message.from_dict(dict(message_td))
-
-        message_analysis_config = analysis_dataset_config_for_message(analysis_dataset_configs, message)
-
-        # Check if the message has a manual label and impute NOT_REVIEWED if it doesn't
-        has_checked_label = False
-        has_unchecked_label = False
-        code_schemes = [c.code_scheme for c in message_analysis_config.coding_configs]
-        code_schemes.append(ws_correct_dataset_code_scheme)
-        for code_scheme in code_schemes:
-            latest_labels_with_code_scheme = get_latest_labels_with_code_scheme(
-                message, code_scheme
-            )
-            for label in latest_labels_with_code_scheme:
-                if label.checked:
-                    has_checked_label = True
-                else:
-                    has_unchecked_label = True
-
-        if has_checked_label and not has_unchecked_label:
-            # Message is exclusively manually reviewed
-            continue
-
-        if has_checked_label and has_unchecked_label:
-            # The message has been partially reviewed. Map this to coding error.
-            _clear_latest_labels(user, message_td, code_schemes)
+    # Check if the message has a manual label and impute NOT_REVIEWED if it doesn't
+    has_checked_label = False
+    has_unchecked_label = False
+    for code_scheme in code_schemes:
+        latest_labels_with_code_scheme = get_latest_labels_with_code_scheme(
+            message, code_scheme
+        )
+        for label in latest_labels_with_code_scheme:
+            if label.checked:
+                has_checked_label = True
+            else:
+                has_unchecked_label = True
 
-            for code_scheme in code_schemes:
-                coding_error_label = CleaningUtils.make_label_from_cleaner_code(
-                    code_scheme, code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
-                    Metadata.get_call_location())
+    if has_checked_label and not has_unchecked_label:
+        # Message is exclusively manually reviewed
+        return None
 
-                # Insert a coding error label to the list of labels for this message, and write-back to TracedData.
-                _insert_label_to_message_td(user, message_td, coding_error_label)
-            messages_with_ce_imputed += 1
-            continue
+    if has_checked_label and has_unchecked_label:
+        # The message has been partially reviewed. Map this to coding error.
+        _clear_latest_labels(provenance, message_td, code_schemes, message_views)
 
-        # Label has not been manually reviewed at all, so replace the codes with Codes.NOT_REVIEWED
-        assert not has_checked_label
-        _clear_latest_labels(user, message_td, code_schemes)
         for code_scheme in code_schemes:
-            not_reviewed_label = CleaningUtils.make_label_from_cleaner_code(
-                code_scheme, code_scheme.get_code_with_control_code(Codes.NOT_REVIEWED),
+            coding_error_label = CleaningUtils.make_label_from_cleaner_code(
+                code_scheme, code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
                 Metadata.get_call_location())
 
-            # Insert not_reviewed_label to the list of labels for this message, and write-back to TracedData.
-            _insert_label_to_message_td(user, message_td, not_reviewed_label)
-        messages_with_nr_imputed += 1
+            # Insert a coding error label to the list of labels for this message, and write-back to TracedData.
+            _insert_label_to_message_td(provenance, message_td, coding_error_label, message_views)
+        return Codes.CODING_ERROR
 
-    log.info(f"Processed {Codes.NOT_REVIEWED} labels for {len(messages_traced_data)} messages traced data. "
-             f"Imputed {Codes.NOT_REVIEWED} labels for {messages_with_nr_imputed} messages, and "
-             f"imputed {Codes.CODING_ERROR} labels for {messages_with_ce_imputed} messages")
+    # Label has not been manually reviewed at all, so replace the codes with Codes.NOT_REVIEWED
+    assert not has_checked_label
+    _clear_latest_labels(provenance, message_td, code_schemes, message_views)
+    for code_scheme in code_schemes:
+        not_reviewed_label = CleaningUtils.make_label_from_cleaner_code(
+            code_scheme, code_scheme.get_code_with_control_code(Codes.NOT_REVIEWED),
+            Metadata.get_call_location())
+
+        # Insert not_reviewed_label to the list of labels for this message, and write-back to TracedData.
+        _insert_label_to_message_td(provenance, message_td, not_reviewed_label, message_views)
+    return Codes.NOT_REVIEWED
 
 
 def _code_for_label(label, code_schemes):
@@ -158,122 +150,120 @@ def _code_for_label(label, code_schemes):
                      f"(these have ids {[scheme.scheme_id for scheme in code_schemes]})")
 
 
-def _impute_ws_coding_errors(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme):
+def _impute_ws_coding_errors(provenance, message_td, normal_code_schemes, ws_correct_dataset_code_scheme,
+                             message_views):
     """
-    Imputes Codes.CODING_ERROR labels for messages that have a coding error in the WS labels that have been applied.
+    Imputes Codes.CODING_ERROR labels for a message that has a coding error in the WS labels that have been applied.
 
     We consider WS labels to have a coding error if either of these conditions holds:
      - There is a WS label applied in a normal code scheme, but there is no label in the WS - Correct Dataset code scheme.
      - There is a label applied in the WS - Correct Dataset code scheme, but no WS code in any of the normal code schemes.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute ws coding errors.
-    :type messages_traced_data: list of TracedData
-    :param analysis_dataset_configs: Analysis dataset configuration in pipeline configuration module.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param message_td: Message TracedData object to impute ws coding errors for.
+    :type message_td: TracedData
+    :param normal_code_schemes: Normal code schemes for this message's analysis dataset.
+    :type normal_code_schemes: list of core_data_modules.data_models.CodeScheme
     :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
     :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
+    :param message_views: Cache of typed message views.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache
+    :return: Whether coding error labels were imputed.
+    :rtype: bool
     """
-    log.info(f"Imputing {Codes.CODING_ERROR} labels for WS codes...")
-    imputed_labels = 0
-    for message_td in messages_traced_data:
-        message = Message.from_dict(dict(message_td))
-
-        message_analysis_config = analysis_dataset_config_for_message(analysis_dataset_configs, message)
-        normal_code_schemes = [c.code_scheme for c in message_analysis_config.coding_configs]
-
-        # Check for a WS code in any of the normal code schemes
-        ws_code_in_normal_scheme = False
-        for label in message.get_latest_labels():
-            if not label.checked:
-                continue
+    message = message_views.get_message(message_td)
 
-            if label.scheme_id != ws_correct_dataset_code_scheme.scheme_id:
-                code = _code_for_label(label, normal_code_schemes)
-                if code.control_code == Codes.WRONG_SCHEME:
-                    ws_code_in_normal_scheme = True
+    # Check for a WS code in any of the normal code schemes
+    ws_code_in_normal_scheme = False
+    for label in message.get_latest_labels():
+        if not label.checked:
+            continue
 
-        # Check for a code in the WS code scheme
-        code_in_ws_scheme = False
-        for label in message.get_latest_labels():
-            if not label.checked:
-                continue
+        if label.scheme_id != ws_correct_dataset_code_scheme.scheme_id:
+            code = _code_for_label(label, normal_code_schemes)
+            if code.control_code == Codes.WRONG_SCHEME:
+                ws_code_in_normal_scheme = True
 
-            if label.scheme_id == ws_correct_dataset_code_scheme.scheme_id:
-                code_in_ws_scheme = True
-
-        if ws_code_in_normal_scheme != code_in_ws_scheme:
-            imputed_labels += 1
-
-            # Clear all existing labels, in preparation for the new coding error labels we'll write afterwards.
-            # (This is because messages store labels in Coda format, so before we write the new labels we need to
-            #  insert special un-coded labels in place of all the existing labels, including labels assigned under
-            #  duplicate schemes, in order to guarantee that no pre-existing label is preserved in the next steps of
-            #  analysis)
-            _clear_latest_labels(user, message_td, normal_code_schemes + [ws_correct_dataset_code_scheme])
-
-            # Append a CE code under every normal + WS code scheme
-            for code_scheme in normal_code_schemes + [ws_correct_dataset_code_scheme]:
-                ce_label = CleaningUtils.make_label_from_cleaner_code(
-                    code_scheme,
-                    code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
-                    Metadata.get_call_location(),
-                    set_checked=True
-                )
-                _insert_label_to_message_td(user, message_td, ce_label)
+    # Check for a code in the WS code scheme
+    code_in_ws_scheme = False
+    for label in message.get_latest_labels():
+        if not label.checked:
+            continue
 
-    log.info(f"Imputed {imputed_labels} {Codes.CODING_ERROR} labels for WS codes")
+        if label.scheme_id == ws_correct_dataset_code_scheme.scheme_id:
+            code_in_ws_scheme = True
+
+    if ws_code_in_normal_scheme == code_in_ws_scheme:
+        return False
+
+    # Clear all existing labels, in preparation for the new coding error labels we'll write afterwards.
+    # (This is because messages store labels in Coda format, so before we write the new labels we need to
+    #  insert special un-coded labels in place of all the existing labels, including labels assigned under
+    #  duplicate schemes, in order to guarantee that no pre-existing label is preserved in the next steps of
+    #  analysis)
+    _clear_latest_labels(
+        provenance, message_td, normal_code_schemes + [ws_correct_dataset_code_scheme], message_views
+    )
+
+    # Append a CE code under every normal + WS code scheme
+    for code_scheme in normal_code_schemes + [ws_correct_dataset_code_scheme]:
+        ce_label = CleaningUtils.make_label_from_cleaner_code(
+            code_scheme,
+            code_scheme.get_code_with_control_code(Codes.CODING_ERROR),
+            Metadata.get_call_location(),
+            set_checked=True
+        )
+        _insert_label_to_message_td(provenance, message_td, ce_label, message_views)
+    return True
 
 
-def _impute_nc_for_empty_messages(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme):
+def _impute_nc_for_empty_message(provenance, message_td, normal_code_schemes, ws_correct_dataset_code_scheme,
+                                 message_views):
     """
-    Imputes Codes.NOT_CODED for messages whose text property is either None or "".
+    Imputes Codes.NOT_CODED for a message if its text property is either None or "".
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute age_category.
-    :type messages_traced_data: list of TracedData
-    :param analysis_dataset_configs: Analysis dataset configuration in pipeline configuration module.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param message_td: Message TracedData object to impute not coded labels for.
+    :type message_td: TracedData
+    :param normal_code_schemes: Normal code schemes for this message's analysis dataset.
+    :type normal_code_schemes: list of core_data_modules.data_models.CodeScheme
     :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
     :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
+    :param message_views: Cache of typed message views.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache
+    :return: Whether not coded labels were imputed.
+    :rtype: bool
     """
-    messages_with_nc_imputed = 0
-    for message_td in messages_traced_data:
-        message = Message.from_dict(dict(message_td))
+    message = message_views.get_message(message_td)
 
-        if not (message.text is None or message.text == ""):
-            continue
-
-        message_analysis_config = analysis_dataset_config_for_message(analysis_dataset_configs, message)
-        normal_code_schemes = [c.code_scheme for c in message_analysis_config.coding_configs]
+    if not (message.text is None or message.text == ""):
+        return False
 
-        _clear_latest_labels(user, message_td, normal_code_schemes + [ws_correct_dataset_code_scheme])
-        for code_scheme in normal_code_schemes:
-            nc_label = CleaningUtils.make_label_from_cleaner_code(
-                code_scheme, code_scheme.get_code_with_control_code(Codes.NOT_CODED),
-                Metadata.get_call_location()
-            )
-            _insert_label_to_message_td(user, message_td, nc_label)
-        messages_with_nc_imputed += 1
-
-    log.info(f"Processed {Codes.NOT_CODED} labels for empty messages: Searched {len(messages_traced_data)} messages and "
-             f"imputed {messages_with_nc_imputed} {Codes.NOT_CODED} labels")
+    _clear_latest_labels(
+        provenance, message_td, normal_code_schemes + [ws_correct_dataset_code_scheme], message_views
+    )
+    for code_scheme in normal_code_schemes:
+        nc_label = CleaningUtils.make_label_from_cleaner_code(
+            code_scheme, code_scheme.get_code_with_control_code(Codes.NOT_CODED),
+            Metadata.get_call_location()
+        )
+        _insert_label_to_message_td(provenance, message_td, nc_label, message_views)
+    return True
 
 
-def _impute_age_category(user, messages_traced_data, analysis_dataset_configs):
+def _get_age_category_imputation_config(analysis_dataset_configs):
     """
-    Imputes age category for age dataset messages.
+    Gets the configuration needed to impute age categories for age dataset messages.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute age_category.
-    :type messages_traced_data: list of TracedData
     :param analysis_dataset_configs: Analysis dataset configuration in pipeline configuration module.
     :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :return: Tuple of (engagement db datasets containing age messages, age coding configuration, age category coding
+             configuration), or None if there is no age category configuration.
+    :rtype: (list of str, src.engagement_db_to_analysis.configuration.CodingConfiguration,
+             src.engagement_db_to_analysis.configuration.CodingConfiguration) | None
     """
-
     # Get the coding configurations for age and age_category analysis datasets
     age_category_coding_config = None
     for analysis_dataset_config in analysis_dataset_configs:
@@ -287,8 +277,8 @@ def _impute_age_category(user, messages_traced_data, analysis_dataset_configs):
             age_category_coding_config = coding_config
 
     if age_category_coding_config is None:
-        log.info(f"No age category configuration found, returning without imputing any age categories")
-        return
+        log.info(f"No age category configuration found, so won't impute any age categories")
+        return None
 
     age_coding_config = None
     age_engagement_db_datasets = None
@@ -301,42 +291,50 @@ def _impute_age_category(user, messages_traced_data, analysis_dataset_configs):
                 age_coding_config = coding_config
                 age_engagement_db_datasets = analysis_dataset_config.engagement_db_datasets
 
-    # Check and impute age_category in age messages only
-    log.info(f"Imputing {age_category_coding_config.analysis_dataset} labels for {age_coding_config.analysis_dataset} messages...")
-    imputed_labels = 0
-    age_messages = 0
-    for message_td in messages_traced_data:
-        if message_td["dataset"] in age_engagement_db_datasets:
-            age_messages += 1
-
-            age_labels = get_latest_labels_with_code_scheme(Message.from_dict(dict(message_td)), age_coding_config.code_scheme)
-            age_code = age_coding_config.code_scheme.get_code_with_code_id(age_labels[0].code_id)
-
-            # Impute age_category for this age_code
-            if age_code.code_type == CodeTypes.NORMAL:
-                age_category = None
-                for age_range, category in age_category_coding_config.age_category_config.categories.items():
-                    if age_range[0] <= age_code.numeric_value <= age_range[1]:
-                        age_category = category
-                assert age_category is not None
-                age_category_code = age_category_coding_config.code_scheme.get_code_with_match_value(age_category)
-            elif age_code.code_type == CodeTypes.META:
-                age_category_code = age_category_coding_config.code_scheme.get_code_with_meta_code(age_code.meta_code)
-            else:
-                assert age_code.code_type == CodeTypes.CONTROL
-                age_category_code = age_category_coding_config.code_scheme.get_code_with_control_code(
-                    age_code.control_code)
-
-            age_category_label = CleaningUtils.make_label_from_cleaner_code(
-                age_category_coding_config.code_scheme, age_category_code, Metadata.get_call_location()
-            )
-
-            # Inserts this age_category_label to the list of labels for this message, and write-back to TracedData.
-            _insert_label_to_message_td(user, message_td, age_category_label)
+    return age_engagement_db_datasets, age_coding_config, age_category_coding_config
+
+
+def _impute_age_category(provenance, message_td, age_coding_config, age_category_coding_config, message_views):
+    """
+    Imputes age category for an age dataset message.
+
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param message_td: Age message TracedData object to impute age_category for.
+    :type message_td: TracedData
+    :param age_coding_config: Coding configuration for the age analysis dataset.
+    :type age_coding_config: src.engagement_db_to_analysis.configuration.CodingConfiguration
+    :param age_category_coding_config: Coding configuration for the age category analysis dataset.
+    :type age_category_coding_config: src.engagement_db_to_analysis.configuration.CodingConfiguration
+    :param message_views: Cache of typed message views.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache
+    """
+    age_labels = get_latest_labels_with_code_scheme(
+        message_views.get_message(message_td), age_coding_config.code_scheme
+    )
+    age_code = age_coding_config.code_scheme.get_code_with_code_id(age_labels[0].code_id)
+
+    # Impute age_category for this age_code
+    if age_code.code_type == CodeTypes.NORMAL:
+        age_category = None
+        for age_range, category in age_category_coding_config.age_category_config.categories.items():
+            if age_range[0] <= age_code.numeric_value <= age_range[1]:
+                age_category = category
+        assert age_category is not None
+        age_category_code = age_category_coding_config.code_scheme.get_code_with_match_value(age_category)
+    elif age_code.code_type == CodeTypes.META:
+        age_category_code = age_category_coding_config.code_scheme.get_code_with_meta_code(age_code.meta_code)
+    else:
+        assert age_code.code_type == CodeTypes.CONTROL
+        age_category_code = age_category_coding_config.code_scheme.get_code_with_control_code(
+            age_code.control_code)
 
-            imputed_labels += 1
+    age_category_label = CleaningUtils.make_label_from_cleaner_code(
+        age_category_coding_config.code_scheme, age_category_code, Metadata.get_call_location()
+    )
 
-    log.info(f"Imputed {imputed_labels} age category labels for {age_messages} age messages")
+    # Inserts this age_category_label to the list of labels for this message, and write-back to TracedData.
+    _insert_label_to_message_td(provenance, message_td, age_category_label, message_views)
 
 
 def _make_location_code(scheme, clean_value):
@@ -346,18 +344,14 @@ def _make_location_code(scheme, clean_value):
         return scheme.get_code_with_match_value(clean_value)
 
 
-def _impute_location_codes_for_dataset(user, messages_traced_data, location_engagement_db_datasets,
-                                       coding_config_cleaner_tuples):
+def _impute_location_codes(provenance, message_td, coding_config_cleaner_tuples, message_views):
     """
-    Imputes location labels for location dataset messages.
+    Imputes location labels for a location dataset message.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute age_category.
-    :type messages_traced_data: list of TracedData
-    :param location_engagement_db_datasets: Engagement db datasets to impute location for. Messages whose dataset is
-                                            in this list will have their locations imputed.
-    :type location_engagement_db_datasets: list of str
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param message_td: Location message TracedData object to impute locations for.
+    :type message_td: TracedData
     :param coding_config_cleaner_tuples: List of tuples of:
                                           (i)  The coding configuration for a location variable
                                           (ii) A function which, given a location code, returns the location code for
@@ -369,86 +363,90 @@ def _impute_location_codes_for_dataset(user, messages_traced_data, location_enga
                                         )
     :type coding_config_cleaner_tuples: list of (
             src.engagement_db_to_analysis.configuration.CodingConfiguration, func of str -> str)
+    :param message_views: Cache of typed message views.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache
+    :return: Tuple of (number of coding errors detected, number of normal labels imputed, number of meta labels
+             imputed, number of control labels imputed).
+    :rtype: (int, int, int, int)
     """
     imputed_normal_labels = 0
     imputed_meta_labels = 0
     imputed_control_labels = 0
     detected_coding_errors = 0
 
-    for message_traced_data in messages_traced_data:
-        message = Message.from_dict(dict(message_traced_data))
-        if message.dataset not in location_engagement_db_datasets:
-            continue
+    message = message_views.get_message(message_td)
+
+    # Up to 1 location code should have been assigned in Coda. Search for that code, ensuring that only 1 has been
+    # assigned or, if multiple have been assigned, that they are non-conflicting control codes.
+    # Multiple normal codes will be converted to Coding Error, even if they were compatible (e.g. langata + nairobi)
+    location_code = None
+    for coding_config, _ in coding_config_cleaner_tuples:
+        latest_coding_config_labels = get_latest_labels_with_code_scheme(message, coding_config.code_scheme)
+
+        if len(latest_coding_config_labels) > 0:
+            latest_coding_config_label = latest_coding_config_labels[0]
+
+            coda_code = coding_config.code_scheme.get_code_with_code_id(latest_coding_config_label.code_id)
+            if location_code is not None:
+                if location_code.code_id != coda_code.code_id:
+                    location_code = coding_config.code_scheme.get_code_with_control_code(
+                        Codes.CODING_ERROR
+                    )
+                    detected_coding_errors += 1
+            else:
+                location_code = coda_code
 
-        # Up to 1 location code should have been assigned in Coda. Search for that code, ensuring that only 1 has been
-        # assigned or, if multiple have been assigned, that they are non-conflicting control codes.
-        # Multiple normal codes will be converted to Coding Error, even if they were compatible (e.g. langata + nairobi)
-        location_code = None
+    # If a control or meta code was found, set all other location keys to that control/meta code,
+    # otherwise convert the provided location to the other locations in the hierarchy.
+    if location_code.code_type == CodeTypes.CONTROL:
         for coding_config, _ in coding_config_cleaner_tuples:
-            latest_coding_config_labels = get_latest_labels_with_code_scheme(message, coding_config.code_scheme)
-
-            if len(latest_coding_config_labels) > 0:
-                latest_coding_config_label = latest_coding_config_labels[0]
-
-                coda_code = coding_config.code_scheme.get_code_with_code_id(latest_coding_config_label.code_id)
-                if location_code is not None:
-                    if location_code.code_id != coda_code.code_id:
-                        location_code = coding_config.code_scheme.get_code_with_control_code(
-                            Codes.CODING_ERROR
-                        )
-                        detected_coding_errors += 1
-                else:
-                    location_code = coda_code
-
-        # If a control or meta code was found, set all other location keys to that control/meta code,
-        # otherwise convert the provided location to the other locations in the hierarchy.
-        if location_code.code_type == CodeTypes.CONTROL:
-            for coding_config, _ in coding_config_cleaner_tuples:
-                control_code_label = CleaningUtils.make_label_from_cleaner_code(
-                    coding_config.code_scheme,
-                    coding_config.code_scheme.get_code_with_control_code(location_code.control_code),
-                    Metadata.get_call_location())
-
-                _insert_label_to_message_td(user, message_traced_data, control_code_label)
-                imputed_control_labels += 1
-        elif location_code.code_type == CodeTypes.META:
-            for coding_config, _ in coding_config_cleaner_tuples:
-                meta_code_label = CleaningUtils.make_label_from_cleaner_code(
-                    coding_config.code_scheme,
-                    coding_config.code_scheme.get_code_with_meta_code(location_code.meta_code),
-                    Metadata.get_call_location())
-
-                _insert_label_to_message_td(user, message_traced_data, meta_code_label)
-                imputed_meta_labels += 1
-        else:
-            location = location_code.match_values[0]
-            for coding_config, cleaner in coding_config_cleaner_tuples:
-                label = CleaningUtils.make_label_from_cleaner_code(
-                    coding_config.code_scheme,
-                    _make_location_code(coding_config.code_scheme, cleaner(location)),
-                    Metadata.get_call_location()
-                )
-                _insert_label_to_message_td(user, message_traced_data, label)
-            imputed_normal_labels += 1
+            control_code_label = CleaningUtils.make_label_from_cleaner_code(
+                coding_config.code_scheme,
+                coding_config.code_scheme.get_code_with_control_code(location_code.control_code),
+                Metadata.get_call_location())
 
-    log.info(f"Detected {detected_coding_errors} coding errors, and imputed {imputed_normal_labels} normal, "
-             f"{imputed_meta_labels} meta, and {imputed_control_labels} control location labels.")
+            _insert_label_to_message_td(provenance, message_td, control_code_label, message_views)
+            imputed_control_labels += 1
+    elif location_code.code_type == CodeTypes.META:
+        for coding_config, _ in coding_config_cleaner_tuples:
+            meta_code_label = CleaningUtils.make_label_from_cleaner_code(
+                coding_config.code_scheme,
+                coding_config.code_scheme.get_code_with_meta_code(location_code.meta_code),
+                Metadata.get_call_location())
+
+            _insert_label_to_message_td(provenance, message_td, meta_code_label, message_views)
+            imputed_meta_labels += 1
+    else:
+        location = location_code.match_values[0]
+        for coding_config, cleaner in coding_config_cleaner_tuples:
+            label = CleaningUtils.make_label_from_cleaner_code(
+                coding_config.code_scheme,
+                _make_location_code(coding_config.code_scheme, cleaner(location)),
+                Metadata.get_call_location()
+            )
+            _insert_label_to_message_td(provenance, message_td, label, message_views)
+        imputed_normal_labels += 1
+
+    return detected_coding_errors, imputed_normal_labels, imputed_meta_labels, imputed_control_labels
 
 
-def _impute_location_codes(user, messages_traced_data, analysis_dataset_configs, analysis_locations_to_cleaners):
+def _get_location_imputation_configs(analysis_dataset_configs, analysis_locations_to_cleaners):
     """
-    Imputes location codes for the given analysis configurations.
+    Gets the configurations needed to impute location codes for the given analysis locations.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute age_category.
-    :type messages_traced_data: list of TracedData
     :param analysis_dataset_configs: Analysis dataset configuration in pipeline configuration module.
     :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
     :param analysis_locations_to_cleaners: Dictionary of AnalysisLocation -> location code cleaner (a function which,
                                            given a location code, returns the location code for this variable)
     :type analysis_locations_to_cleaners: dict of str -> (func of str -> str)
+    :return: List of tuples of (engagement db datasets to impute locations for, coding config cleaner tuples to
+             impute with - see `_impute_location_codes`), one for each analysis dataset configuration that has
+             coding configurations for any of the given analysis locations.
+    :rtype: list of (list of str, list of (src.engagement_db_to_analysis.configuration.CodingConfiguration,
+            func of str -> str))
     """
+    location_imputation_configs = []
+
     # Search each analysis dataset configuration for coding configurations tagged with the analysis locations of
     # interest e.g. the constituencies and counties in Kenya.
     for analysis_dataset_config in analysis_dataset_configs:
@@ -479,59 +477,52 @@ def _impute_location_codes(user, messages_traced_data, analysis_dataset_configs,
             log.warning(f"Searched for locations {list(analysis_locations_to_cleaners.keys())}, "
                         f"but only found {list(locations_dict.keys())}. "
                         f"Proceeding to impute with this subset of the possible locations.")
-        _impute_location_codes_for_dataset(
-            user, messages_traced_data, location_engagement_db_datasets, locations_dict.values()
-        )
+        location_imputation_configs.append((location_engagement_db_datasets, list(locations_dict.values())))
+
+    return location_imputation_configs
 
 
-def _impute_kenya_location_codes(user, messages_traced_data, analysis_dataset_configs):
+def _get_kenya_and_somalia_location_imputation_configs(analysis_dataset_configs):
     """
-    Imputes Kenya location labels for location dataset messages.
+    Gets the configurations needed to impute Kenya then Somalia location labels for location dataset messages.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute age_category.
-    :type messages_traced_data: list of TracedData
     :param analysis_dataset_configs: Analysis dataset configuration in pipeline configuration module.
     :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :return: Location imputation configurations, in the order they should be applied.
+             See `_get_location_imputation_configs`.
+    :rtype: list of (list of str, list of (src.engagement_db_to_analysis.configuration.CodingConfiguration,
+            func of str -> str))
     """
-    analysis_locations_to_cleaners = {
+    kenya_locations_to_cleaners = {
         AnalysisLocations.KENYA_WARD: KenyaLocations.ward_for_location_code,
         AnalysisLocations.KENYA_CONSTITUENCY: KenyaLocations.constituency_for_location_code,
         AnalysisLocations.KENYA_COUNTY: KenyaLocations.county_for_location_code
     }
-    _impute_location_codes(user, messages_traced_data, analysis_dataset_configs, analysis_locations_to_cleaners)
-
-
-def _impute_somalia_location_codes(user, messages_traced_data, analysis_dataset_configs):
-    """
-    Imputes Somalia location labels for location dataset messages.
-
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages TracedData objects to impute age_category.
-    :type messages_traced_data: list of TracedData
-    :param analysis_dataset_configs: Analysis dataset configuration in pipeline configuration module.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
-    """
-    analysis_locations_to_cleaners = {
+    somalia_locations_to_cleaners = {
         AnalysisLocations.MOGADISHU_SUB_DISTRICT: SomaliaLocations.mogadishu_sub_district_for_location_code,
         AnalysisLocations.SOMALIA_DISTRICT: SomaliaLocations.district_for_location_code,
         AnalysisLocations.SOMALIA_REGION: SomaliaLocations.region_for_location_code,
         AnalysisLocations.SOMALIA_STATE: SomaliaLocations.state_for_location_code,
         AnalysisLocations.SOMALIA_ZONE: SomaliaLocations.zone_for_location_code
     }
-    _impute_location_codes(user, messages_traced_data, analysis_dataset_configs, analysis_locations_to_cleaners)
+    return _get_location_imputation_configs(analysis_dataset_configs, kenya_locations_to_cleaners) + \
+        _get_location_imputation_configs(analysis_dataset_configs, somalia_locations_to_cleaners)
 
 
-def impute_codes_by_message(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme):
+def impute_codes_by_message(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme,
+                            message_views=None, full_provenance=False, config_index=None):
     """
     Imputes codes for messages TracedData in-place.
 
-    Runs the following imputations:
+    Runs the following imputations, applying all of them to each message in turn in a single pass over the messages:
      - Imputes Codes.NOT_REVIEWED for messages that have not been manually labelled in coda.
+     - Imputes Codes.CODING_ERROR for messages with inconsistent WS labels.
+     - Imputes Codes.NOT_CODED for empty messages.
      - Imputes Age category labels for age dataset messages.
-     - Imputes Kenya Location labels for location dataset messages.
+     - Imputes Kenya and Somalia Location labels for location dataset messages.
+
+    Each imputation only depends on the message it is imputing labels for, so this produces the same labels as
+    applying each imputation to every message before running the next imputation.
 
     :param user: Identifier of user running the pipeline.
     :type user: str
@@ -541,70 +532,145 @@ def impute_codes_by_message(user, messages_traced_data, analysis_dataset_configs
     :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
     :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
     :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
-    """
-    _impute_not_reviewed_labels(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme)
-    _impute_ws_coding_errors(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme)
-    _impute_nc_for_empty_messages(user, messages_traced_data, analysis_dataset_configs, ws_correct_dataset_code_scheme)
+    :param message_views: Cache of typed message views of `messages_traced_data`, shared between the imputations so
+                          that each message is only deserialized again after it has been updated. Pass the same cache
+                          to later stages that need the typed messages to re-use the views. If None, a new cache is
+                          used.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache | None
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :param config_index: Index of `analysis_dataset_configs`. If None, a new index is built.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex | None
+    """
+    if message_views is None:
+        message_views = MessageViewCache()
+    if config_index is None:
+        config_index = AnalysisConfigIndex(analysis_dataset_configs)
+    provenance = StepProvenance(user, full_provenance)
+
+    # Resolve the configuration for each imputation once, before the pass over the messages.
+    age_category_imputation_config = _get_age_category_imputation_config(analysis_dataset_configs)
+    location_imputation_configs = _get_kenya_and_somalia_location_imputation_configs(analysis_dataset_configs)
+    dataset_to_normal_code_schemes = dict()  # of engagement db dataset -> list of CodeScheme
+
+    log.info(f"Imputing codes for {len(messages_traced_data)} messages traced data...")
+    messages_with_nr_imputed = 0
+    messages_with_ce_imputed = 0
+    messages_with_ws_ce_imputed = 0
+    messages_with_nc_imputed = 0
+    age_messages = 0
+    location_coding_errors = 0
+    imputed_normal_location_labels = 0
+    imputed_meta_location_labels = 0
+    imputed_control_location_labels = 0
+    for message_td in messages_traced_data:
+        # The imputations don't change a message's dataset, so look-up the code schemes for it once.
+        dataset = message_td["dataset"]
+        if dataset not in dataset_to_normal_code_schemes:
+            message_analysis_config = config_index.get_dataset_config_for_message(message_views.get_message(message_td))
+            dataset_to_normal_code_schemes[dataset] = [c.code_scheme for c in message_analysis_config.coding_configs]
+        normal_code_schemes = dataset_to_normal_code_schemes[dataset]
+
+        imputed_code = _impute_not_reviewed_labels(
+            provenance, message_td, normal_code_schemes + [ws_correct_dataset_code_scheme], message_views
+        )
+        if imputed_code == Codes.NOT_REVIEWED:
+            messages_with_nr_imputed += 1
+        elif imputed_code == Codes.CODING_ERROR:
+            messages_with_ce_imputed += 1
+
+        if _impute_ws_coding_errors(
+                provenance, message_td, normal_code_schemes, ws_correct_dataset_code_scheme, message_views):
+            messages_with_ws_ce_imputed += 1
+
+        if _impute_nc_for_empty_message(
+                provenance, message_td, normal_code_schemes, ws_correct_dataset_code_scheme, message_views):
+            messages_with_nc_imputed += 1
+
+        if age_category_imputation_config is not None:
+            age_engagement_db_datasets, age_coding_config, age_category_coding_config = age_category_imputation_config
+            if dataset in age_engagement_db_datasets:
+                age_messages += 1
+                _impute_age_category(
+                    provenance, message_td, age_coding_config, age_category_coding_config, message_views
+                )
+
+        for location_engagement_db_datasets, coding_config_cleaner_tuples in location_imputation_configs:
+            if dataset not in location_engagement_db_datasets:
+                continue
 
-    _impute_age_category(user, messages_traced_data, analysis_dataset_configs)
+            coding_errors, normal_labels, meta_labels, control_labels = _impute_location_codes(
+                provenance, message_td, coding_config_cleaner_tuples, message_views
+            )
+            location_coding_errors += coding_errors
+            imputed_normal_location_labels += normal_labels
+            imputed_meta_location_labels += meta_labels
+            imputed_control_location_labels += control_labels
 
-    _impute_kenya_location_codes(user, messages_traced_data, analysis_dataset_configs)
-    _impute_somalia_location_codes(user, messages_traced_data, analysis_dataset_configs)
+    log.info(f"Processed {Codes.NOT_REVIEWED} labels for {len(messages_traced_data)} messages traced data. "
+             f"Imputed {Codes.NOT_REVIEWED} labels for {messages_with_nr_imputed} messages, and "
+             f"imputed {Codes.CODING_ERROR} labels for {messages_with_ce_imputed} messages")
+    log.info(f"Imputed {messages_with_ws_ce_imputed} {Codes.CODING_ERROR} labels for WS codes")
+    log.info(f"Processed {Codes.NOT_CODED} labels for empty messages: Searched {len(messages_traced_data)} messages and "
+             f"imputed {messages_with_nc_imputed} {Codes.NOT_CODED} labels")
+    if age_category_imputation_config is not None:
+        log.info(f"Imputed {age_messages} age category labels for {age_messages} age messages")
+    log.info(f"Detected {location_coding_errors} location coding errors, and imputed {imputed_normal_location_labels} "
+             f"normal, {imputed_meta_location_labels} meta, and {imputed_control_location_labels} control location "
+             f"labels.")
 
 
-def _impute_true_missing(user, column_traced_data_iterable, analysis_dataset_configs):
+def _impute_true_missing(provenance, td, column_configs):
     """
-    Imputes TRUE_MISSING codes on column-view datasets.
+    Imputes TRUE_MISSING codes on a column-view TracedData.
 
     TRUE_MISSING labels are applied to analysis datasets where the raw dataset doesn't exist in the given TracedData.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param column_traced_data_iterable: Column-view traced data objects to apply the impute function to.
-    :type column_traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
-    :param analysis_dataset_configs: Analysis dataset configurations for the imputation.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param td: Column-view traced data object to apply the impute function to.
+    :type td: core_data_modules.traced_data.TracedData
+    :param column_configs: Column configurations for all the analysis datasets.
+    :type column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :return: Number of TRUE_MISSING codes imputed.
+    :rtype: int
     """
     imputed_codes = 0
-    log.info(f"Imputing {Codes.TRUE_MISSING} codes...")
-
-    column_configs = analysis_dataset_configs_to_column_configs(analysis_dataset_configs)
-
-    for td in column_traced_data_iterable:
-        na_dict = dict()
+    na_dict = dict()
 
-        for column_config in column_configs:
-            if column_config.raw_field in td:
-                continue
+    for column_config in column_configs:
+        if column_config.raw_field in td:
+            continue
 
-            na_dict[column_config.raw_field] = ""
-            na_label = CleaningUtils.make_label_from_cleaner_code(
-                column_config.code_scheme,
-                column_config.code_scheme.get_code_with_control_code(Codes.TRUE_MISSING),
-                Metadata.get_call_location()
-            ).to_dict()
-            na_dict[column_config.coded_field] = [na_label]
-            imputed_codes += 1
+        na_dict[column_config.raw_field] = ""
+        na_label = CleaningUtils.make_label_from_cleaner_code(
+            column_config.code_scheme,
+            column_config.code_scheme.get_code_with_control_code(Codes.TRUE_MISSING),
+            Metadata.get_call_location()
+        ).to_dict()
+        na_dict[column_config.coded_field] = [na_label]
+        imputed_codes += 1
 
-        td.append_data(na_dict, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+    td.append_data(na_dict, provenance.metadata())
 
-    log.info(f"Imputed {imputed_codes} {Codes.TRUE_MISSING} codes for {len(column_traced_data_iterable)} "
-             f"traced data items")
+    return imputed_codes
 
 
-def _demog_has_conflicting_normal_labels(column_traced_data, column_config):
+def _demog_has_conflicting_normal_labels(column_traced_data, column_config, config_index):
     """
     :param column_traced_data: Column-view traced data to check.
     :type column_traced_data: core_data_modules.traced_data.TracedData
     :param column_config: Configuration for the demographic column to analyse.
     :type column_config: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param config_index: Index of the analysis dataset configurations, for looking up codes.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
     :return: Whether there are any conflicting normal labels for `column_traced_data` under `column_config`.
     :rtype: bool
     """
     column_labels = column_traced_data[column_config.coded_field]
     normal_code = None
     for label in column_labels:
-        code = column_config.code_scheme.get_code_with_code_id(label["CodeID"])
+        code = config_index.get_code(column_config.code_scheme, label["CodeID"])
         if code.code_type == CodeTypes.NORMAL:
             if normal_code is None:
                 normal_code = code
@@ -615,27 +681,29 @@ def _demog_has_conflicting_normal_labels(column_traced_data, column_config):
     return False
 
 
-def _get_control_and_meta_labels(column_traced_data, column_config):
+def _get_control_and_meta_labels(column_traced_data, column_config, config_index):
     """
     :param column_traced_data: Column-view traced data to get the control and meta labels from.
     :type column_traced_data: core_data_modules.traced_data.TracedData
     :param column_config: Configuration for the column to get the labels from.
     :type column_config: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param config_index: Index of the analysis dataset configurations, for looking up codes.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
     :return: The labels in `column_traced_data` that have code_type CONTROL or META under `column_config`, serialized.
     :rtype: list of dict
     """
     control_and_meta_labels = []
     column_labels = column_traced_data[column_config.coded_field]
     for label in column_labels:
-        code = column_config.code_scheme.get_code_with_code_id(label["CodeID"])
+        code = config_index.get_code(column_config.code_scheme, label["CodeID"])
         if code.code_type == CodeTypes.CONTROL or code.code_type == CodeTypes.META:
             control_and_meta_labels.append(label)
     return control_and_meta_labels
 
 
-def _impute_nic_demogs(user, column_traced_data_iterable, analysis_dataset_configs):
+def _impute_nic_demogs(provenance, td, demog_column_configs, config_index):
     """
-    Imputes NOT_INTERNALLY_CONSISTENT labels on the demographic columns of column-view datasets.
+    Imputes NOT_INTERNALLY_CONSISTENT labels on the demographic columns of a column-view TracedData.
 
     NOT_INTERNALLY_CONSISTENT labels are applied to demographics where there are multiple, conflicting normal labels.
     For example:
@@ -647,73 +715,74 @@ def _impute_nic_demogs(user, column_traced_data_iterable, analysis_dataset_confi
      - If we have multiple conflicting normal labels, e.g. "20" and "22", as well as some meta/control labels, the
        normal labels will be replaced with NOT_INTERNALLY_CONSISTENT and the meta/control labels will be kept untouched.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param column_traced_data_iterable: Column-view traced data objects to apply the impute function to.
-    :type column_traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
-    :param analysis_dataset_configs: Analysis dataset configurations for the imputation.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param td: Column-view traced data object to apply the impute function to.
+    :type td: core_data_modules.traced_data.TracedData
+    :param demog_column_configs: Column configurations for the demographic analysis datasets.
+    :type demog_column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param config_index: Index of the analysis dataset configurations, for looking up codes.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+    :return: Number of NOT_INTERNALLY_CONSISTENT codes imputed.
+    :rtype: int
     """
     imputed_codes = 0
-    log.info(f"Imputing {Codes.NOT_INTERNALLY_CONSISTENT} codes...")
-
-    demog_column_configs = analysis_dataset_configs_to_demog_column_configs(analysis_dataset_configs)
-    for td in column_traced_data_iterable:
-        for column_config in demog_column_configs:
-            if _demog_has_conflicting_normal_labels(td, column_config):
-                # Replace the conflicting normal labels with a NOT_INTERNALLY_CONSISTENT label,
-                # while keeping any existing control/meta codes.
-                new_labels = _get_control_and_meta_labels(td, column_config)
-                nic_label = CleaningUtils.make_label_from_cleaner_code(
-                    column_config.code_scheme,
-                    column_config.code_scheme.get_code_with_control_code(Codes.NOT_INTERNALLY_CONSISTENT),
-                    Metadata.get_call_location()
-                )
-                new_labels.append(nic_label.to_dict())
+    for column_config in demog_column_configs:
+        if _demog_has_conflicting_normal_labels(td, column_config, config_index):
+            # Replace the conflicting normal labels with a NOT_INTERNALLY_CONSISTENT label,
+            # while keeping any existing control/meta codes.
+            new_labels = _get_control_and_meta_labels(td, column_config, config_index)
+            nic_label = CleaningUtils.make_label_from_cleaner_code(
+                column_config.code_scheme,
+                column_config.code_scheme.get_code_with_control_code(Codes.NOT_INTERNALLY_CONSISTENT),
+                Metadata.get_call_location()
+            )
+            new_labels.append(nic_label.to_dict())
 
-                td.append_data(
-                    {column_config.coded_field: new_labels},
-                    Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
-                )
-                imputed_codes += 1
+            td.append_data({column_config.coded_field: new_labels}, provenance.metadata())
+            imputed_codes += 1
 
-    log.info(f"Imputed {imputed_codes} {Codes.NOT_INTERNALLY_CONSISTENT} codes for {len(column_traced_data_iterable)} "
-             f"traced data items")
+    return imputed_codes
 
 
-def _get_consent_withdrawn_participant_uuids(column_traced_data_iterable, analysis_dataset_configs):
+def _get_consent_withdrawn_participant_uuids(column_traced_data_iterable, column_configs, config_index):
     """
     Gets the participant uuids of participants who withdrew consent.
 
     A participant is considered to have withdrawn consent if any of their labels have control code Codes.STOP in any
-    of the datasets in the given `analysis_dataset_configs`.
+    of the given column configurations.
+
+    Columns whose raw field is missing are skipped, because these will be imputed with TRUE_MISSING. None of the other
+    column-view imputations add or remove STOP labels, so this gives the same result before the other imputations
+    as after them.
 
     :param column_traced_data_iterable: Column-view traced data objects to search for consent withdrawn status.
     :type column_traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
-    :param analysis_dataset_configs: Analysis dataset configurations for the search.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :param column_configs: Column configurations for all the analysis datasets.
+    :type column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param config_index: Index of the analysis dataset configurations, for looking up codes.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
     :return: Uuids of participants who withdrew consent.
     :rtype: set of str
     """
-    column_configs = analysis_dataset_configs_to_column_configs(analysis_dataset_configs)
     consent_withdrawn_uuids = set()
 
     for td in column_traced_data_iterable:
         for column_config in column_configs:
+            if column_config.raw_field not in td:
+                continue
+
             column_labels = td[column_config.coded_field]
             for label in column_labels:
-                if column_config.code_scheme.get_code_with_code_id(label["CodeID"]).control_code == Codes.STOP:
+                if config_index.get_code(column_config.code_scheme, label["CodeID"]).control_code == Codes.STOP:
                     consent_withdrawn_uuids.add(td["participant_uuid"])
 
     return consent_withdrawn_uuids
 
 
-def _impute_consent_withdrawn(user, column_traced_data_iterable, analysis_dataset_configs):
+def _impute_consent_withdrawn(provenance, td, column_configs, consent_withdrawn_uuids):
     """
-    Imputes consent_withdrawn on column-view datasets.
-
-    Searches the given data for participants who are labelled Codes.STOP under any of the given
-    `analysis_dataset_configs`.
+    Imputes consent_withdrawn on a column-view TracedData.
 
     If the participant withdrew consent:
      - Imputes {consent_withdrawn: Codes.TRUE}
@@ -722,50 +791,46 @@ def _impute_consent_withdrawn(user, column_traced_data_iterable, analysis_datase
     If the participant did not withdraw consent:
      - Imputes {consent_withdrawn: Codes.FALSE}
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param column_traced_data_iterable: Column-view traced data objects to apply the impute function to.
-    :type column_traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
-    :param analysis_dataset_configs: Analysis dataset configurations for the imputation.
-    :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param td: Column-view traced data object to apply the impute function to.
+    :type td: core_data_modules.traced_data.TracedData
+    :param column_configs: Column configurations for all the analysis datasets.
+    :type column_configs: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param consent_withdrawn_uuids: Uuids of participants who withdrew consent.
+                                    See `_get_consent_withdrawn_participant_uuids`.
+    :type consent_withdrawn_uuids: set of str
+    :return: Whether the TracedData was marked as consent withdrawn.
+    :rtype: bool
     """
-    log.info("Imputing consent withdrawn...")
-    consent_withdrawn_uuids = _get_consent_withdrawn_participant_uuids(column_traced_data_iterable, analysis_dataset_configs)
-    log.info(f"Found {len(consent_withdrawn_uuids)} participants who withdrew consent")
-
-    column_configs = analysis_dataset_configs_to_column_configs(analysis_dataset_configs)
-    consent_withdrawn_tds = 0
-    for td in column_traced_data_iterable:
-        if td["participant_uuid"] in consent_withdrawn_uuids:
-            consent_withdrawn_dict = {"consent_withdrawn": Codes.TRUE}
-            consent_withdrawn_tds += 1
-            # Overwrite the labels and raw fields with STOP labels/texts.
-            for column_config in column_configs:
-                consent_withdrawn_dict[column_config.coded_field] = [CleaningUtils.make_label_from_cleaner_code(
-                    column_config.code_scheme,
-                    column_config.code_scheme.get_code_with_control_code(Codes.STOP),
-                    Metadata.get_call_location()
-                ).to_dict()]
-                consent_withdrawn_dict[column_config.raw_field] = "STOP"
-        else:
-            consent_withdrawn_dict = {"consent_withdrawn": Codes.FALSE}
-        td.append_data(consent_withdrawn_dict, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+    consent_withdrawn = td["participant_uuid"] in consent_withdrawn_uuids
+    if consent_withdrawn:
+        consent_withdrawn_dict = {"consent_withdrawn": Codes.TRUE}
+        # Overwrite the labels and raw fields with STOP labels/texts.
+        for column_config in column_configs:
+            consent_withdrawn_dict[column_config.coded_field] = [CleaningUtils.make_label_from_cleaner_code(
+                column_config.code_scheme,
+                column_config.code_scheme.get_code_with_control_code(Codes.STOP),
+                Metadata.get_call_location()
+            ).to_dict()]
+            consent_withdrawn_dict[column_config.raw_field] = "STOP"
+    else:
+        consent_withdrawn_dict = {"consent_withdrawn": Codes.FALSE}
+    td.append_data(consent_withdrawn_dict, provenance.metadata())
 
-    log.info(f"Imputed consent withdrawn for {len(column_traced_data_iterable)} traced data items - "
-             f"{len(consent_withdrawn_uuids)} items were marked as consent_withdrawn")
+    return consent_withdrawn
 
 
-def _impute_somalia_zone_from_somalia_operator(user, column_traced_data_iterable, analysis_dataset_configs):
+def _get_somalia_zone_imputation_column_configs(analysis_dataset_configs):
     """
-    Imputes Somalia zone labels that are currently 'NC' by attempting to use the message operator to assign the
-    zone instead.
+    Gets the column configurations needed to impute Somalia zone labels from the Somalia operator.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param column_traced_data_iterable: Column-view traced data objects to apply the impute function to.
-    :type column_traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
     :param analysis_dataset_configs: Analysis dataset configurations for the imputation.
     :type analysis_dataset_configs: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+    :return: Tuple of (Somalia operator column configuration, Somalia zone column configuration), or None if the
+             analysis configurations don't have both.
+    :rtype: (core_data_modules.analysis.analysis_utils.AnalysisConfiguration,
+             core_data_modules.analysis.analysis_utils.AnalysisConfiguration) | None
     """
     # Search for a Somalia operator and Somalia zone configuration in the analysis configs.
     somalia_operator_column_config = None
@@ -787,66 +852,81 @@ def _impute_somalia_zone_from_somalia_operator(user, column_traced_data_iterable
     if somalia_operator_column_config is None or somalia_zone_column_config is None:
         log.debug(f"Not imputing Somalia zone from operator because there were no configurations for both "
                   f"Somalia zone and operator")
-        return
-
-    # Search the column_td for messages with zones that are 'NC' and impute with operator-derived zone codes.
-    log.info(f"Imputing 'NC' Somalia zone labels from operator codes...")
-    imputed_labels = 0
-    for column_td in column_traced_data_iterable:
-        # Get the existing zone labels for this td, and check if they have normal/NC codes
-        zone_labels = column_td[somalia_zone_column_config.coded_field]
-        zone_codes = [somalia_zone_column_config.code_scheme.get_code_with_code_id(l["CodeID"]) for l in zone_labels]
-
-        has_nc_code = False
-        has_normal_code = False
-        for code in zone_codes:
-            if code.control_code == Codes.NOT_CODED:
-                has_nc_code = True
-            if code.code_type == CodeTypes.NORMAL:
-                has_normal_code = True
-
-        # If there is no NC code, then the zone has been usefully labelled as something else e.g. 'nez', 'NR' etc.
-        # Skip this column_td without modifying it.
-        if not has_nc_code:
-            continue
+        return None
 
-        assert not has_normal_code
+    return somalia_operator_column_config, somalia_zone_column_config
 
-        # This column_td has a zone that is labelled as NC only (+ meta codes).
-        # Derive the zone from the operator instead.
-        zone_string = SomaliaLocations.zone_for_operator_code(column_td[somalia_operator_column_config.raw_field])
-        if zone_string == Codes.NOT_CODED:
-            zone_code = somalia_zone_column_config.code_scheme.get_code_with_control_code(Codes.NOT_CODED)
-        else:
-            zone_code = somalia_zone_column_config.code_scheme.get_code_with_match_value(zone_string)
 
-        new_zone_label = CleaningUtils.make_label_from_cleaner_code(
-            somalia_zone_column_config.code_scheme, zone_code, Metadata.get_call_location()
-        )
+def _impute_somalia_zone_from_somalia_operator(provenance, column_td, somalia_operator_column_config,
+                                               somalia_zone_column_config, config_index):
+    """
+    Imputes a Somalia zone label that is currently 'NC' by attempting to use the message operator to assign the
+    zone instead.
 
-        # Replace the nc zone label with the new zone label that was created from the operator
-        new_zone_labels = [
-            label for label in zone_labels
-            if somalia_zone_column_config.code_scheme.get_code_with_code_id(label["CodeID"]).control_code != Codes.NOT_CODED
-        ]
-        new_zone_labels.append(new_zone_label.to_dict())
+    :param provenance: Provenance of the pipeline step running this imputation.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param column_td: Column-view traced data object to apply the impute function to.
+    :type column_td: core_data_modules.traced_data.TracedData
+    :param somalia_operator_column_config: Column configuration for the Somalia operator.
+    :type somalia_operator_column_config: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param somalia_zone_column_config: Column configuration for the Somalia zone.
+    :type somalia_zone_column_config: core_data_modules.analysis.analysis_utils.AnalysisConfiguration
+    :param config_index: Index of the analysis dataset configurations, for looking up codes.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+    :return: Whether a zone label was imputed.
+    :rtype: bool
+    """
+    # Get the existing zone labels for this td, and check if they have normal/NC codes
+    zone_labels = column_td[somalia_zone_column_config.coded_field]
+    zone_codes = [config_index.get_code(somalia_zone_column_config.code_scheme, l["CodeID"]) for l in zone_labels]
 
-        column_td.append_data(
-            {somalia_zone_column_config.coded_field: new_zone_labels},
-            Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
-        )
-        imputed_labels += 1
+    has_nc_code = False
+    has_normal_code = False
+    for code in zone_codes:
+        if code.control_code == Codes.NOT_CODED:
+            has_nc_code = True
+        if code.code_type == CodeTypes.NORMAL:
+            has_normal_code = True
 
-    log.info(f"Imputed {imputed_labels} Somalia zone labels from operator codes for {len(column_traced_data_iterable)} "
-             f"traced data items")
+    # If there is no NC code, then the zone has been usefully labelled as something else e.g. 'nez', 'NR' etc.
+    # Skip this column_td without modifying it.
+    if not has_nc_code:
+        return False
+
+    assert not has_normal_code
+
+    # This column_td has a zone that is labelled as NC only (+ meta codes).
+    # Derive the zone from the operator instead.
+    zone_string = SomaliaLocations.zone_for_operator_code(column_td[somalia_operator_column_config.raw_field])
+    if zone_string == Codes.NOT_CODED:
+        zone_code = somalia_zone_column_config.code_scheme.get_code_with_control_code(Codes.NOT_CODED)
+    else:
+        zone_code = somalia_zone_column_config.code_scheme.get_code_with_match_value(zone_string)
+
+    new_zone_label = CleaningUtils.make_label_from_cleaner_code(
+        somalia_zone_column_config.code_scheme, zone_code, Metadata.get_call_location()
+    )
+
+    # Replace the nc zone label with the new zone label that was created from the operator
+    new_zone_labels = [
+        label for label in zone_labels
+        if config_index.get_code(somalia_zone_column_config.code_scheme, label["CodeID"]).control_code != Codes.NOT_CODED
+    ]
+    new_zone_labels.append(new_zone_label.to_dict())
+
+    column_td.append_data({somalia_zone_column_config.coded_field: new_zone_labels}, provenance.metadata())
+    return True
 
 
-def impute_codes_by_column_traced_data(user, column_traced_data_iterable, analysis_dataset_configs):
+def impute_codes_by_column_traced_data(user, column_traced_data_iterable, analysis_dataset_configs, full_provenance=False,
+                                       config_index=None):
     """
     Imputes codes for column-view TracedData in-place.
 
-    Runs the following imputations:
+    Runs the following imputations, applying all of them to each TracedData in turn in a single pass over the data
+    (after a read-only pass to find the participants who withdrew consent):
      - Imputes Codes.TRUE_MISSING to columns that don't have a raw_field entry.
+     - Imputes 'NC' Somalia zones from the Somalia operator.
      - Imputes Codes.NOT_INTERNALLY_CONSISTENT to demographic columns that have multiple conflicting normal codes.
      - Imputes consent_withdrawn.
 
@@ -856,8 +936,51 @@ def impute_codes_by_column_traced_data(user, column_traced_data_iterable, analys
     :type column_traced_data_iterable: iterable of core_data_modules.traced_data.TracedData
     :param analysis_dataset_configs: Analysis dataset configurations for the imputation.
     :type analysis_dataset_configs: pipeline_config.analysis_configs.dataset_configurations
-    """
-    _impute_true_missing(user, column_traced_data_iterable, analysis_dataset_configs)
-    _impute_somalia_zone_from_somalia_operator(user, column_traced_data_iterable, analysis_dataset_configs)
-    _impute_nic_demogs(user, column_traced_data_iterable, analysis_dataset_configs)
-    _impute_consent_withdrawn(user, column_traced_data_iterable, analysis_dataset_configs)
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :param config_index: Index of `analysis_dataset_configs`. If None, a new index is built.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex | None
+    """
+    if config_index is None:
+        config_index = AnalysisConfigIndex(analysis_dataset_configs)
+    provenance = StepProvenance(user, full_provenance)
+
+    # Resolve the configuration for each imputation once, before the pass over the data.
+    column_configs = config_index.column_configs
+    demog_column_configs = config_index.demog_column_configs
+    somalia_zone_imputation_column_configs = _get_somalia_zone_imputation_column_configs(analysis_dataset_configs)
+
+    log.info("Searching for participants who withdrew consent...")
+    consent_withdrawn_uuids = _get_consent_withdrawn_participant_uuids(
+        column_traced_data_iterable, column_configs, config_index
+    )
+    log.info(f"Found {len(consent_withdrawn_uuids)} participants who withdrew consent")
+
+    log.info(f"Imputing codes for {len(column_traced_data_iterable)} column-view traced data items...")
+    imputed_true_missing_codes = 0
+    imputed_zone_labels = 0
+    imputed_nic_codes = 0
+    consent_withdrawn_tds = 0
+    for td in column_traced_data_iterable:
+        imputed_true_missing_codes += _impute_true_missing(provenance, td, column_configs)
+
+        if somalia_zone_imputation_column_configs is not None:
+            somalia_operator_column_config, somalia_zone_column_config = somalia_zone_imputation_column_configs
+            if _impute_somalia_zone_from_somalia_operator(
+                    provenance, td, somalia_operator_column_config, somalia_zone_column_config, config_index):
+                imputed_zone_labels += 1
+
+        imputed_nic_codes += _impute_nic_demogs(provenance, td, demog_column_configs, config_index)
+
+        if _impute_consent_withdrawn(provenance, td, column_configs, consent_withdrawn_uuids):
+            consent_withdrawn_tds += 1
+
+    log.info(f"Imputed {imputed_true_missing_codes} {Codes.TRUE_MISSING} codes for {len(column_traced_data_iterable)} "
+             f"traced data items")
+    if somalia_zone_imputation_column_configs is not None:
+        log.info(f"Imputed {imputed_zone_labels} Somalia zone labels from operator codes for "
+                 f"{len(column_traced_data_iterable)} traced data items")
+    log.info(f"Imputed {imputed_nic_codes} {Codes.NOT_INTERNALLY_CONSISTENT} codes for {len(column_traced_data_iterable)} "
+             f"traced data items")
+    log.info(f"Imputed consent withdrawn for {len(column_traced_data_iterable)} traced data items - "
+             f"{consent_withdrawn_tds} items were marked as consent_withdrawn")
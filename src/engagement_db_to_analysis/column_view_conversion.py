@@ -1,12 +1,15 @@
+import copy
+
 from core_data_modules.analysis import AnalysisConfiguration
 from core_data_modules.cleaners.cleaning_utils import CleaningUtils
 from core_data_modules.logging import Logger
 from core_data_modules.traced_data import Metadata, TracedData
 from core_data_modules.traced_data.util.fold_traced_data import FoldStrategies
-from core_data_modules.util import TimeUtils
-from engagement_database.data_models import Message
 
+from src.engagement_db_to_analysis.analysis_config_index import AnalysisConfigIndex
 from src.engagement_db_to_analysis.configuration import DatasetTypes, OperatorDatasetConfiguration
+from src.engagement_db_to_analysis.message_view_cache import MessageViewCache
+from src.engagement_db_to_analysis.provenance import StepProvenance
 
 """
 This module contains utility functions for converting configurations and datasets from the format used in the pipeline
@@ -37,108 +40,13 @@ def coding_config_to_column_config(coding_config, raw_dataset):
     )
 
 
-def analysis_dataset_config_to_column_configs(analysis_dataset_config):
-    """
-    Converts an analysis dataset configuration to the relevant "column-view" configurations.
-
-    The analysis dataset configuration is the normalised configuration that's specified in the pipeline configuration
-    files, and works great for processing individual messages.
-
-    The "column-view" configurations describe how to reconfigure the dataset for the final stages of analysis, where
-    we are less interested in individual messages, but in the labelled opinions, collated by labelled dataset, by
-    participant, or by project.
-
-    :param analysis_dataset_config: Analysis dataset configuration to convert.
-    :type analysis_dataset_config: src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
-    :return: List of all the column configurations for this analysis dataset configuration.
-    :rtype: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
-    """
-    column_configs = []
-    for coding_config in analysis_dataset_config.coding_configs:
-        column_config = AnalysisConfiguration(
-            dataset_name=coding_config.analysis_dataset,
-            raw_field=analysis_dataset_config.raw_dataset,
-            coded_field=f"{coding_config.analysis_dataset}_labels",
-            code_scheme=coding_config.code_scheme
-        )
-        column_configs.append(column_config)
-    return column_configs
-
-
-def analysis_dataset_configs_to_column_configs(analysis_dataset_configs):
-    """
-    Converts a list of analysis dataset configurations to the relevant "column-view" configurations.
-
-    :param analysis_dataset_configs: Analysis dataset configurations to convert.
-    :type analysis_dataset_configs: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
-    :return: List of all the column configurations for the analysis dataset configurations.
-    :rtype: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
-    """
-    column_configs = []
-    for analysis_dataset_config in analysis_dataset_configs:
-        column_configs.extend(analysis_dataset_config_to_column_configs(analysis_dataset_config))
-    return column_configs
-
-
-def analysis_dataset_configs_to_rqa_column_configs(analysis_dataset_configs):
-    """
-    Converts a list of analysis dataset configurations to a list of "column-view" configurations, for the rqa datasets
-    only.
-
-    :param analysis_dataset_configs: Analysis dataset configurations to convert.
-    :type analysis_dataset_configs: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
-    :return: List of rqa column configurations for the analysis dataset configurations.
-    :rtype: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
-    """
-    rqa_column_configs = []
-    for analysis_dataset_config in analysis_dataset_configs:
-        if analysis_dataset_config.dataset_type == DatasetTypes.RESEARCH_QUESTION_ANSWER:
-            rqa_column_configs.extend(analysis_dataset_config_to_column_configs(analysis_dataset_config))
-    return rqa_column_configs
-
-
-def analysis_dataset_configs_to_demog_column_configs(analysis_dataset_configs):
-    """
-    Converts a list of analysis dataset configurations to a list of "column-view" configurations, for the demographic
-    datasets only.
-
-    :param analysis_dataset_configs: Analysis dataset configurations to convert.
-    :type analysis_dataset_configs: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
-    :return: List of demographic column configurations for the analysis dataset configurations.
-    :rtype: list of core_data_modules.analysis.analysis_utils.AnalysisConfiguration
-    """
-    demog_column_configs = []
-    for analysis_dataset_config in analysis_dataset_configs:
-        if analysis_dataset_config.dataset_type == DatasetTypes.DEMOGRAPHIC:
-            demog_column_configs.extend(analysis_dataset_config_to_column_configs(analysis_dataset_config))
-    return demog_column_configs
-
-
-def analysis_dataset_config_for_message(analysis_dataset_configs, message):
-    """
-    Gets the analysis dataset configuration to use to process this message, by looking-up the configuration that refers
-    to this message's engagement db "dataset" property.
-
-    :param analysis_dataset_configs: Dataset configurations to search for the one that relates to the given message.
-    :type analysis_dataset_configs: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
-    :param message: Message to retrieve the analysis dataset configuration for.
-    :type message: engagement_database.data_models.Message
-    :return: Analysis dataset configuration to use for this message.
-    :rtype: src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
-    """
-    for config in analysis_dataset_configs:
-        if message.dataset in config.engagement_db_datasets:
-            return config
-    raise ValueError(f"No analysis dataset configuration found for message '{message.message_id}', which has engagement"
-                     f"db dataset {message.dataset}")
-
-
 def get_latest_labels_with_code_scheme(message, code_scheme):
     """
     Gets the labels assigned to this message under the given `code_scheme` (or a duplicate of this code scheme).
 
     Labels assigned under duplicate code schemes are normalised to have the primary code scheme id e.g. scheme_id
-    'scheme-abc123-1' will be re-written to 'scheme-abc123'.
+    'scheme-abc123-1' will be re-written to 'scheme-abc123'. The normalised labels are copies, so the labels on
+    `message` are not modified.
 
     :param message: Message to get the labels from.
     :type message: engagement_database.data_models.Message
@@ -150,75 +58,33 @@ def get_latest_labels_with_code_scheme(message, code_scheme):
     latest_labels_with_code_scheme = []
     for label in message.get_latest_labels():
         if label.scheme_id.startswith(code_scheme.scheme_id):
+            label = copy.copy(label)
             label.scheme_id = code_scheme.scheme_id
             latest_labels_with_code_scheme.append(label)
     return latest_labels_with_code_scheme
 
 
-def _filter_out_demogs_only(messages_traced_data, analysis_dataset_configs):
+def _get_column_data_for_message(message, column_td, message_analysis_dataset_config, config_index):
     """
-    Filters out messages from participants who only sent demographics.
+    Gets the data to write to a "column-view" TracedData object in order to add a message to it.
 
-    :param messages_traced_data: Messages traced data to filter.
-    :type messages_traced_data: list of core_data_modules.traced_data.TracedData
-    :param analysis_dataset_configs: Configuration for the filter.
-    :type analysis_dataset_configs: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
-    :param messages_traced_data: Filtered messages traced data.
-    :type messages_traced_data: list of core_data_modules.traced_data.TracedData
-    """
-    # Find the rqa engagement_db datasets in the given configuration.
-    rqa_engagement_db_datasets = []
-    for config in analysis_dataset_configs:
-        if config.dataset_type == DatasetTypes.RESEARCH_QUESTION_ANSWER:
-            rqa_engagement_db_datasets.extend(config.engagement_db_datasets)
-
-    # Find the participants who have a message in an rqa engagement_db dataset
-    rqa_participant_uuids = set()
-    for msg in messages_traced_data:
-        for rqa_dataset in rqa_engagement_db_datasets:
-            if msg["dataset"] == rqa_dataset:
-                rqa_participant_uuids.add(msg["participant_uuid"])
-
-    # Filter all the messages so that we exclude messages from people who didn't send an rqa.
-    filtered = []
-    excluded_uuids = set()
-    for msg in messages_traced_data:
-        if msg["participant_uuid"] in rqa_participant_uuids:
-            filtered.append(msg)
-        else:
-            excluded_uuids.add(msg["participant_uuid"])
-
-    log.info(f"Filtered out messages from participants who only sent demogs. Returning "
-             f"{len(filtered)}/{len(messages_traced_data)} messages (excluded {len(excluded_uuids)} uuids)")
-    return filtered
-
-
-def _add_message_to_column_td(user, message_td, column_td, analysis_dataset_configs):
-    """
-    Adds a message to a "column-view" TracedData object in-place.
-
-    This function adds this message's text and labels fields to an existing TracedData object in column-view format.
-    In cases where data already exists in the column-view columns:
+    This folds this message's text and labels fields into the existing data in the column-view columns:
      - Raw texts are handled by concatenation, by `core_data_modules.util.fold_traced_data.FoldStrategies.concatenate`.
      - Labels are handled by `core_data_modules.util.fold_traced_data.FoldStrategies.list_of_labels`.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param message_td: TracedData representing the message to add
-    :type message_td: core_data_modules.traced_data.TracedData
-    :param column_td: An existing TracedData object in column-view format, to which the relevant data from this message
-                      will be appended.
+    :param message: Message to add.
+    :type message: engagement_database.data_models.Message
+    :param column_td: An existing TracedData object in column-view format, which the message will be added to.
     :type column_td: core_data_modules.traced_data.TracedData
-    :param analysis_dataset_configs: Dataset configurations to use to decide how to process the message.
-    :type analysis_dataset_configs: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+    :param message_analysis_dataset_config: Analysis dataset configuration for the message.
+    :type message_analysis_dataset_config: src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+    :param config_index: Index of the analysis dataset configurations.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+    :return: Dictionary of column-view field -> updated value for that field.
+    :rtype: dict
     """
-    message = Message.from_dict(dict(message_td))
-
-    # Get the analysis dataset configuration for this message
-    message_analysis_dataset_config = analysis_dataset_config_for_message(analysis_dataset_configs, message)
-
     # Convert the analysis dataset config to its "column-view" configurations
-    column_configs = analysis_dataset_config_to_column_configs(message_analysis_dataset_config)
+    column_configs = config_index.get_column_configs_for_dataset_config(message_analysis_dataset_config)
 
     updated_column_data = dict()
 
@@ -250,30 +116,63 @@ def _add_message_to_column_td(user, message_td, column_td, analysis_dataset_conf
                 column_config.code_scheme, existing_labels, latest_labels_with_code_scheme
             )
 
-    # Append the TracedData history for this message to the column-view.
+    return updated_column_data
+
+
+def _hide_message_td(provenance, message_td):
+    """
+    Makes a copy of a message TracedData with all of its keys hidden, for appending to column-view TracedData.
+
+    :param provenance: Provenance of the pipeline step hiding the message.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param message_td: TracedData representing the message to hide.
+    :type message_td: core_data_modules.traced_data.TracedData
+    :return: Copy of `message_td`, with all of its keys hidden.
+    :rtype: core_data_modules.traced_data.TracedData
+    """
     message_td = message_td.copy()
-    message_td.hide_keys(message_td.keys(), Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
-    column_td.append_traced_data("appended_message", message_td, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+    message_td.hide_keys(message_td.keys(), provenance.metadata())
+    return message_td
+
+
+def _append_message_to_column_td(provenance, hidden_message_td, column_td, updated_column_data):
+    """
+    Appends a message's history and column data to a "column-view" TracedData object in-place.
+
+    :param provenance: Provenance of the pipeline step adding the message.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
+    :param hidden_message_td: TracedData representing the message to add, with all of its keys hidden.
+                              See `_hide_message_td`.
+    :type hidden_message_td: core_data_modules.traced_data.TracedData
+    :param column_td: An existing TracedData object in column-view format, to which the message will be appended.
+    :type column_td: core_data_modules.traced_data.TracedData
+    :param updated_column_data: Column data for the message. See `_get_column_data_for_message`.
+    :type updated_column_data: dict
+    """
+    # Append the TracedData history for this message to the column-view.
+    column_td.append_traced_data("appended_message", hidden_message_td, provenance.metadata())
 
     # Write the new data to the column-view TracedData
     # (we do this after appending the message_td so the TracedData is slightly easier to read)
-    column_td.append_data(updated_column_data, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+    column_td.append_data(updated_column_data, provenance.metadata())
 
 
-def _add_operators_to_column_td(user, column_td, operators, dataset_config):
+def _add_operators_to_column_td(provenance, column_td, operators, dataset_config, config_index):
     """
     Adds the given operators to the column traced data.
 
-    :param user: Identifier of user running the pipeline.
-    :type user: str
+    :param provenance: Provenance of the pipeline step adding the operators.
+    :type provenance: src.engagement_db_to_analysis.provenance.StepProvenance
     :param column_td: An existing TracedData object in column-view format, to which the operator(s) will be appended.
     :type column_td: core_data_modules.traced_data.TracedData
     :param operators: Operator strings to add
     :type operators: iterable of str
     :param dataset_config: Configuration for the operators dataset
     :type dataset_config: src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+    :param config_index: Index of the analysis dataset configurations.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
     """
-    for column_config in analysis_dataset_config_to_column_configs(dataset_config):
+    for column_config in config_index.get_column_configs_for_dataset_config(dataset_config):
         labels = []
         for operator in set(operators):
             labels.append(CleaningUtils.make_label_from_cleaner_code(
@@ -285,15 +184,18 @@ def _add_operators_to_column_td(user, column_td, operators, dataset_config):
         column_td.append_data({
             dataset_config.raw_dataset: ";".join(operators),
             column_config.coded_field: labels
-        }, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+        }, provenance.metadata())
 
 
-def convert_to_messages_column_format(user, messages_traced_data, analysis_config):
+def convert_to_column_views(user, messages_traced_data, analysis_config, message_views=None, full_provenance=False,
+                            config_index=None):
     """
-    Converts a list of messages traced data into "column-view" format by rqa-message.
+    Converts a list of messages traced data into both "column-view" formats, by rqa-message and by participant, in a
+    single pass over the messages.
 
-    Returns one "column-view" TracedData object for each rqa message, with all demographic messages from the same
-    participant appended to each TracedData.
+    Looks up each message's configuration once, and folds each demographic message into the column-view data once per
+    participant. The resulting demographic data and hidden message history is shared by reference between the
+    participant's column-view TracedData, rather than being rebuilt for each of them.
 
     :param user: Identifier of user running the pipeline.
     :type user: str
@@ -301,113 +203,104 @@ def convert_to_messages_column_format(user, messages_traced_data, analysis_confi
     :type messages_traced_data: list of core_data_modules.traced_data.TracedData
     :param analysis_config: Configuration for the conversion.
     :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
-    :return: Messages organised by rqa message into column-view format suitable for further analysis.
-    :rtype: list of core_data_modules.traced_data.TracedData
+    :param message_views: Cache of typed message views of `messages_traced_data`. If None, a new cache is used.
+    :type message_views: src.engagement_db_to_analysis.message_view_cache.MessageViewCache | None
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :param config_index: Index of `analysis_config.dataset_configurations`. If None, a new index is built.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex | None
+    :return: Tuple of (messages organised by rqa message into column-view format,
+                       messages organised by participant into column-view format).
+    :rtype: (list of core_data_modules.traced_data.TracedData, list of core_data_modules.traced_data.TracedData)
     """
     log.info(f"Converting {len(messages_traced_data)} messages traced data objects to column-view format by "
-             f"message...")
-    messages_traced_data = _filter_out_demogs_only(messages_traced_data, analysis_config.dataset_configurations)
+             f"message and by participant...")
+    if message_views is None:
+        message_views = MessageViewCache()
+    if config_index is None:
+        config_index = AnalysisConfigIndex(analysis_config.dataset_configurations)
+    provenance = StepProvenance(user, full_provenance)
+
+    operator_dataset_configs = [
+        dataset_config for dataset_config in analysis_config.dataset_configurations
+        if type(dataset_config) == OperatorDatasetConfiguration
+    ]
 
     messages_by_column = dict()  # of participant_uuid -> list of rqa messages in column view
-
-    # Conduct the conversion in 2 passes.
-    # Pass 1: Convert each rqa message to a new TracedData object in column-view.
-    for msg_td in messages_traced_data:
-        # Skip this message if it's not an RQA
-        message = Message.from_dict(dict(msg_td))
-        analysis_dataset_config = analysis_dataset_config_for_message(analysis_config.dataset_configurations, message)
-        if analysis_dataset_config.dataset_type != DatasetTypes.RESEARCH_QUESTION_ANSWER:
-            continue
-
-        # Convert to column-view TracedData
-        column_td = TracedData(
-            {"participant_uuid": message.participant_uuid, "timestamp": message.timestamp.isoformat()},
-            Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
-        )
-        _add_message_to_column_td(user, msg_td, column_td, analysis_config.dataset_configurations)
-
-        # Assign operators
-        for dataset_config in analysis_config.dataset_configurations:
-            if type(dataset_config) == OperatorDatasetConfiguration:
-                _add_operators_to_column_td(user, column_td, [message.channel_operator], dataset_config)
-
-        # Add to the list of converted rqa messages for this participant.
-        if message.participant_uuid not in messages_by_column:
-            messages_by_column[message.participant_uuid] = []
-        messages_by_column[message.participant_uuid].append(column_td)
-
-    # Pass 2: Update each converted rqa message with the demographic messages
-    for msg_td in messages_traced_data:
-        # Skip this message if it's not a demographic.
-        message = Message.from_dict(dict(msg_td))
-        analysis_dataset_config = analysis_dataset_config_for_message(analysis_config.dataset_configurations, message)
-        if analysis_dataset_config.dataset_type != DatasetTypes.DEMOGRAPHIC:
-            continue
-
-        # Add this demographic to each of the column-view rqa message TracedData for this participant.
-        # (Use messages_by_column.get() because we might have demographics for people who never sent an RQA message).
-        for column_td in messages_by_column.get(message.participant_uuid, []):
-            _add_message_to_column_td(user, msg_td, column_td, analysis_config.dataset_configurations)
-
-    flattened_messages = []
-    for msgs in messages_by_column.values():
-        flattened_messages.extend(msgs)
-
-    log.info(f"Converted {len(messages_traced_data)} messages traced data objects to {len(flattened_messages)} "
-             f"column-view format objects, by message")
-    return flattened_messages
-
-
-def convert_to_participants_column_format(user, messages_traced_data, analysis_config):
-    """
-    Converts a list of messages traced data into "column-view" format by participant.
-
-    Returns one "column-view" TracedData object for each participant, with all rqa and demographic messages from the
-    same participant appended to each TracedData.
-
-    :param user: Identifier of user running the pipeline.
-    :type user: str
-    :param messages_traced_data: Messages traced data to convert.
-    :type messages_traced_data: list of core_data_modules.traced_data.TracedData
-    :param analysis_config: Configuration for the conversion.
-    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
-    :return: Messages organised by participant into column-view format  suitable for further analysis.
-    :rtype: list of core_data_modules.traced_data.TracedData
-    """
-    log.info(f"Converting {len(messages_traced_data)} messages traced data objects to column-view format by "
-             f"participant...")
-    messages_traced_data = _filter_out_demogs_only(messages_traced_data, analysis_config.dataset_configurations)
-
-    uuids_to_operators = dict()  # of participant_uuid -> set of channel_operators
     participants_by_column = dict()  # of participant_uuid -> participant traced data in column view
+    uuids_to_operators = dict()  # of participant_uuid -> set of channel_operators
+    uuids_to_demogs = dict()  # of participant_uuid -> list of (hidden demographic message td, column data)
     for msg_td in messages_traced_data:
-        message = Message.from_dict(dict(msg_td))
+        message = message_views.get_message(msg_td)
+        analysis_dataset_config = config_index.get_dataset_config_for_message(message)
 
         # If we've not seen this participant before, create an empty Traced Data to represent them.
         if message.participant_uuid not in participants_by_column:
             participants_by_column[message.participant_uuid] = TracedData(
                 {"participant_uuid": message.participant_uuid},
-                Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+                provenance.metadata()
             )
+            uuids_to_operators[message.participant_uuid] = set()
+            uuids_to_demogs[message.participant_uuid] = []
+        participant = participants_by_column[message.participant_uuid]
+
+        hidden_msg_td = _hide_message_td(provenance, msg_td)
 
-        # If this message is an RQA message, add its operator to the set of operators for this participant
-        analysis_dataset_config = analysis_dataset_config_for_message(analysis_config.dataset_configurations, message)
         if analysis_dataset_config.dataset_type == DatasetTypes.RESEARCH_QUESTION_ANSWER:
-            if message.participant_uuid not in uuids_to_operators:
-                uuids_to_operators[message.participant_uuid] = set()
+            # Convert to a new column-view TracedData for this rqa message, and assign its operator.
+            column_td = TracedData(
+                {"participant_uuid": message.participant_uuid, "timestamp": message.timestamp.isoformat()},
+                provenance.metadata()
+            )
+            _append_message_to_column_td(
+                provenance, hidden_msg_td, column_td,
+                _get_column_data_for_message(message, column_td, analysis_dataset_config, config_index)
+            )
+            for dataset_config in operator_dataset_configs:
+                _add_operators_to_column_td(provenance, column_td, [message.channel_operator], dataset_config, config_index)
+            if message.participant_uuid not in messages_by_column:
+                messages_by_column[message.participant_uuid] = []
+            messages_by_column[message.participant_uuid].append(column_td)
+
             uuids_to_operators[message.participant_uuid].add(message.channel_operator)
 
-        # Add this message to the relevant participant's column-view TracedData.
-        participant = participants_by_column[message.participant_uuid]
-        _add_message_to_column_td(user, msg_td, participant, analysis_config.dataset_configurations)
+            _append_message_to_column_td(
+                provenance, hidden_msg_td, participant,
+                _get_column_data_for_message(message, participant, analysis_dataset_config, config_index)
+            )
+        else:
+            # Demographic columns are only written by demographic messages, so the folded demographic data is the
+            # same for the participant's column-view TracedData and for each of their rqa message column-view
+            # TracedData. Compute it once, and keep it to add to the rqa messages after they have all been converted.
+            column_data = _get_column_data_for_message(message, participant, analysis_dataset_config, config_index)
+            _append_message_to_column_td(provenance, hidden_msg_td, participant, column_data)
+            if analysis_dataset_config.dataset_type == DatasetTypes.DEMOGRAPHIC:
+                uuids_to_demogs[message.participant_uuid].append((hidden_msg_td, column_data))
+
+    # Add the demographics to each rqa message.
+    flattened_messages = []
+    for participant_uuid, column_tds in messages_by_column.items():
+        for column_td in column_tds:
+            for hidden_msg_td, column_data in uuids_to_demogs[participant_uuid]:
+                _append_message_to_column_td(provenance, hidden_msg_td, column_td, column_data)
+        flattened_messages.extend(column_tds)
+
+    # Filter out participants who only sent demographics, and assign operator codes to each remaining participant.
+    participants = []
+    for participant_uuid, participant in participants_by_column.items():
+        if participant_uuid not in messages_by_column:
+            continue
 
-    # Assign operator codes to each participant's column_td
-    for participant_uuid, column_td in participants_by_column.items():
-        for dataset_config in analysis_config.dataset_configurations:
-            if type(dataset_config) == OperatorDatasetConfiguration:
-                _add_operators_to_column_td(user, column_td, uuids_to_operators[participant_uuid], dataset_config)
+        for dataset_config in operator_dataset_configs:
+            _add_operators_to_column_td(
+                provenance, participant, uuids_to_operators[participant_uuid], dataset_config, config_index
+            )
+        participants.append(participant)
 
-    log.info(f"Converted {len(messages_traced_data)} messages traced data objects to "
-             f"{len(participants_by_column.values())} column-view format objects, by participant")
+    log.info(f"Filtered out messages from participants who only sent demogs (excluded "
+             f"{len(participants_by_column) - len(participants)} uuids)")
+    log.info(f"Converted {len(messages_traced_data)} messages traced data objects to {len(flattened_messages)} "
+             f"column-view format objects by message, and to {len(participants)} column-view format objects by "
+             f"participant")
 
-    return list(participants_by_column.values())
+    return flattened_messages, participants
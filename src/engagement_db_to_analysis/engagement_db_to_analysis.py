@@ -1,20 +1,19 @@
 from core_data_modules.logging import Logger
-from core_data_modules.traced_data import TracedData, Metadata
-from core_data_modules.traced_data.io import TracedDataJsonIO
-from core_data_modules.util import TimeUtils
+from core_data_modules.traced_data import TracedData
 from firebase_admin import storage
 
 from src.common.get_messages_in_datasets import get_messages_in_datasets
+from src.common.traced_data_jsonl import export_traced_data_jsonl_in_background
 from src.engagement_db_to_analysis import google_drive_upload
+from src.engagement_db_to_analysis.analysis_config_index import AnalysisConfigIndex
 from src.engagement_db_to_analysis.analysis_files import export_production_file, export_analysis_file
 from src.engagement_db_to_analysis.automated_analysis import run_automated_analysis
 from src.engagement_db_to_analysis.cache import AnalysisCache
-from src.engagement_db_to_analysis.code_imputation_functions import (impute_codes_by_message,
-                                                                     impute_codes_by_column_traced_data)
-from src.engagement_db_to_analysis.column_view_conversion import (convert_to_messages_column_format,
-                                                                  convert_to_participants_column_format)
+from src.engagement_db_to_analysis.provenance import StepProvenance
+from src.engagement_db_to_analysis.sharded_imputation import impute_and_convert_to_column_views
 from src.engagement_db_to_analysis.traced_data_filters import filter_messages
-from src.engagement_db_to_analysis.membership_group import (tag_membership_groups_participants)
+from src.engagement_db_to_analysis.membership_group import (load_membership_groups,
+                                                            tag_membership_groups_participants)
 
 from src.engagement_db_to_analysis.rapid_pro_advert_functions import sync_advert_contacts_to_rapid_pro
 
@@ -22,7 +21,7 @@ from src.engagement_db_to_analysis.rapid_pro_advert_functions import sync_advert
 log = Logger(__name__)
 
 
-def _convert_messages_to_traced_data(user, messages_map):
+def _convert_messages_to_traced_data(user, messages_map, full_provenance=False):
     """
     Converts messages dict objects to TracedData objects.
 
@@ -30,15 +29,18 @@ def _convert_messages_to_traced_data(user, messages_map):
     :type user: str
     :param messages_map: Dict of engagement db dataset -> list of Messages in that dataset.
     :type messages_map: dict of str -> list of engagement_database.data_models.Message
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
     :return: A list of Traced data message objects.
     :type: list of Traced data
     """
+    provenance = StepProvenance(user, full_provenance)
     messages_traced_data = []
     for engagement_db_dataset_messages in messages_map.values():
         for msg in engagement_db_dataset_messages:
             messages_traced_data.append(TracedData(
                 msg.to_dict(serialize_datetimes_to_str=True),
-                Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string())
+                provenance.metadata()
             ))
 
     log.info(f"Converted {len(messages_traced_data)} raw messages to TracedData")
@@ -46,15 +48,40 @@ def _convert_messages_to_traced_data(user, messages_map):
     return messages_traced_data
 
 
-def export_traced_data(traced_data, export_path):
-    with open(export_path, "w") as f:
-        TracedDataJsonIO.export_traced_data_iterable_to_jsonl(traced_data, f)
+def _export_traced_data_in_background(messages_by_column, participants_by_column, output_dir):
+    """
+    Starts exporting the messages and participants TracedData to JSONL files in `output_dir`, in the background.
+
+    :return: Handles to the exports. Call `wait` on each of these to wait for the exports to finish.
+    :rtype: list of src.common.traced_data_jsonl.BackgroundTracedDataJsonlExport
+    """
+    return [
+        export_traced_data_jsonl_in_background(messages_by_column, f"{output_dir}/messages.jsonl.gz"),
+        export_traced_data_jsonl_in_background(participants_by_column, f"{output_dir}/participants.jsonl.gz")
+    ]
 
 
 def generate_analysis_files(user, google_cloud_credentials_file_path, pipeline_config, uuid_table, engagement_db, rapid_pro,
-                            membership_group_dir_path,output_dir, cache_path=None, dry_run=False, export_large_files=False):
+                            membership_group_dir_path,output_dir, cache_path=None, dry_run=False, export_large_files=False,
+                            full_provenance=False, imputation_workers=1, regression_workers=1, map_workers=1,
+                            export_workers=1, drive_upload_workers=1):
     """
     :type pipeline_config: src.pipeline_configuration_spec.PipelineConfiguration
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :param imputation_workers: Number of worker processes to run the code imputations and column-view conversions in.
+                               The messages are sharded across the workers by participant.
+    :type imputation_workers: int
+    :param regression_workers: Number of worker processes to run the multiple-imputation regression analysis in.
+                               The RQAs are analysed in parallel across the workers.
+    :type regression_workers: int
+    :param map_workers: Number of worker processes to draw the participation maps in.
+    :type map_workers: int
+    :param export_workers: Number of worker processes to run the automated analysis exporters in.
+                           The exporters are run concurrently across the workers.
+    :type export_workers: int
+    :param drive_upload_workers: Maximum number of Google Drive folders to upload files to at once.
+    :type drive_upload_workers: int
     """
 
     analysis_dataset_configurations = pipeline_config.analysis.dataset_configurations
@@ -72,46 +99,58 @@ def generate_analysis_files(user, google_cloud_credentials_file_path, pipeline_c
         engagement_db_datasets.extend(config.engagement_db_datasets)
     messages_map = get_messages_in_datasets(engagement_db, engagement_db_datasets, cache, dry_run)
 
-    messages_traced_data = _convert_messages_to_traced_data(user, messages_map)
+    messages_traced_data = _convert_messages_to_traced_data(user, messages_map, full_provenance)
 
-    messages_traced_data = filter_messages(user, messages_traced_data, pipeline_config)
+    messages_traced_data = filter_messages(user, messages_traced_data, pipeline_config, full_provenance)
 
-    impute_codes_by_message(
-        user, messages_traced_data, analysis_dataset_configurations,
-        pipeline_config.analysis.ws_correct_dataset_code_scheme
-    )
+    # Index the analysis configuration once, for the stages that need to look up configurations per message or row.
+    config_index = AnalysisConfigIndex(analysis_dataset_configurations)
 
-    messages_by_column = convert_to_messages_column_format(user, messages_traced_data, pipeline_config.analysis)
-    participants_by_column = convert_to_participants_column_format(user, messages_traced_data, pipeline_config.analysis)
-
-    log.info(f"Imputing messages column-view traced data...")
-    impute_codes_by_column_traced_data(user, messages_by_column, pipeline_config.analysis.dataset_configurations)
-
-    log.info(f"Imputing participants column-view traced data...")
-    impute_codes_by_column_traced_data(user, participants_by_column, pipeline_config.analysis.dataset_configurations)
+    messages_traced_data, messages_by_column, participants_by_column = impute_and_convert_to_column_views(
+        user, messages_traced_data, pipeline_config.analysis, imputation_workers, full_provenance, config_index
+    )
 
     # Export to hard-coded files for now.
     export_production_file(messages_by_column, pipeline_config.analysis, f"{output_dir}/production.csv")
 
+    membership_groups = None
     if pipeline_config.analysis.membership_group_configuration is not None:
 
         membership_group_csv_urls = pipeline_config.analysis.membership_group_configuration.membership_group_csv_urls.items()
+        log.info("Loading membership groups...")
+        membership_groups = load_membership_groups(google_cloud_credentials_file_path, membership_group_csv_urls,
+                                                   membership_group_dir_path)
+
         log.info("Tagging membership group participants to messages_by_column traced data...")
         tag_membership_groups_participants(user, google_cloud_credentials_file_path, messages_by_column,
-                                           membership_group_csv_urls, membership_group_dir_path)
+                                           membership_group_csv_urls, membership_group_dir_path, full_provenance,
+                                           membership_groups)
 
         log.info("Tagging membership group participants to participants_by_column traced data...")
         tag_membership_groups_participants(user, google_cloud_credentials_file_path, participants_by_column,
-                                           membership_group_csv_urls, membership_group_dir_path)
-
-    export_analysis_file(messages_by_column, pipeline_config, f"{output_dir}/messages.csv", export_timestamps=True)
-    export_analysis_file(participants_by_column, pipeline_config, f"{output_dir}/participants.csv")
-
-    if export_large_files:
-        export_traced_data(messages_by_column, f"{output_dir}/messages.jsonl")
-        export_traced_data(participants_by_column, f"{output_dir}/participants.jsonl")
-
-    run_automated_analysis(messages_by_column, participants_by_column, pipeline_config.analysis, f"{output_dir}/automated-analysis", export_large_files=export_large_files)
+                                           membership_group_csv_urls, membership_group_dir_path, full_provenance,
+                                           membership_groups)
+
+    export_analysis_file(messages_by_column, pipeline_config, f"{output_dir}/messages.csv", export_timestamps=True,
+                         config_index=config_index)
+    export_analysis_file(participants_by_column, pipeline_config, f"{output_dir}/participants.csv",
+                         config_index=config_index)
+
+    # Export the TracedData in the background while the rest of the pipeline runs, which only reads the TracedData.
+    # The automated analysis forks worker processes when running the exporters or drawing the maps in parallel, and
+    # forking while the export threads are running can leave locks they hold (e.g. logging's) held forever in the
+    # workers. In that case, start the exports after the automated analysis, so they run alongside the uploads instead.
+    automated_analysis_forks = map_workers > 1 or export_workers > 1
+    traced_data_exports = []
+    if export_large_files and not automated_analysis_forks:
+        traced_data_exports = _export_traced_data_in_background(messages_by_column, participants_by_column, output_dir)
+
+    run_automated_analysis(messages_by_column, participants_by_column, pipeline_config.analysis, f"{output_dir}/automated-analysis", export_large_files=export_large_files,
+                           config_index=config_index, regression_workers=regression_workers, cache=cache,
+                           map_workers=map_workers, export_workers=export_workers)
+
+    if export_large_files and automated_analysis_forks:
+        traced_data_exports = _export_traced_data_in_background(messages_by_column, participants_by_column, output_dir)
 
     dry_run_text = "(dry run)" if dry_run else ""
     if pipeline_config.analysis.google_drive_upload is None:
@@ -127,13 +166,14 @@ def generate_analysis_files(user, google_cloud_credentials_file_path, pipeline_c
             )
 
             drive_dir = pipeline_config.analysis.google_drive_upload.drive_dir
-            google_drive_upload.upload_file(f"{output_dir}/production.csv", drive_dir)
+            uploads = [(f"{output_dir}/production.csv", drive_dir)]
             if export_large_files:
-                google_drive_upload.upload_file(f"{output_dir}/messages.csv", drive_dir)
-                google_drive_upload.upload_file(f"{output_dir}/participants.csv", drive_dir)
-            google_drive_upload.upload_all_files_in_dir(
+                uploads.append((f"{output_dir}/messages.csv", drive_dir))
+                uploads.append((f"{output_dir}/participants.csv", drive_dir))
+            uploads.extend(google_drive_upload.get_uploads_for_dir(
                 f"{output_dir}/automated-analysis", f"{drive_dir}/automated-analysis", recursive=True
-            )
+            ))
+            google_drive_upload.upload_files(uploads, max_concurrent_uploads=drive_upload_workers)
 
     if pipeline_config.analysis.analysis_dashboard_upload is None:
         log.debug(f"Not uploading to an Analysis Dashboard, because the 'analysis_dashboard' configuration was None {dry_run_text}")
@@ -158,5 +198,8 @@ def generate_analysis_files(user, google_cloud_credentials_file_path, pipeline_c
     if pipeline_config.rapid_pro_target is not None and pipeline_config.rapid_pro_target.sync_config.sync_advert_contacts:
         sync_advert_contacts_to_rapid_pro(
             participants_by_column, uuid_table, pipeline_config, rapid_pro,
-            google_cloud_credentials_file_path, membership_group_dir_path, cache_path, dry_run
+            google_cloud_credentials_file_path, membership_group_dir_path, cache_path, dry_run, membership_groups
         )
+
+    for traced_data_export in traced_data_exports:
+        traced_data_export.wait()
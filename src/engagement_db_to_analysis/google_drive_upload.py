@@ -1,5 +1,8 @@
+import hashlib
 import json
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 from core_data_modules.logging import Logger
 from storage.google_cloud import google_cloud_utils
@@ -7,6 +10,13 @@ from storage.google_drive import drive_client_wrapper
 
 log = Logger(__name__)
 
+_DRIVE_FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# Credentials the `drive_client_wrapper` was initialised with, so the same credentials can be used to initialise the
+# upload worker processes and the Drive service used to read the checksums of existing files.
+_credentials_info = None
+_drive_service = None
+
 
 def init_client(google_cloud_credentials_file_path, drive_credentials_file_url):
     """
@@ -26,56 +36,294 @@ def init_client(google_cloud_credentials_file_path, drive_credentials_file_url):
     ))
     drive_client_wrapper.init_client_from_info(credentials_info)
 
+    global _credentials_info, _drive_service
+    _credentials_info = credentials_info
+    _drive_service = None
 
-def upload_file(source_file_path, target_dir):
+
+def _get_drive_service():
     """
-    Uploads a file from local disk to Google Drive.
+    :return: Google Drive API service, for reading the metadata of files that have already been uploaded.
+    :rtype: googleapiclient.discovery.Resource
+    """
+    global _drive_service
+    if _drive_service is None:
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
 
-    :param source_file_path: Path to a local file on disk to upload.
-    :type source_file_path: str
+        assert _credentials_info is not None, "Google Drive client not initialised. Call `init_client` first."
+        credentials = service_account.Credentials.from_service_account_info(
+            _credentials_info, scopes=["https://www.googleapis.com/auth/drive"]
+        )
+        _drive_service = build("drive", "v3", credentials=credentials, cache_discovery=False)
+    return _drive_service
+
+
+def _quote(name):
+    return name.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def _list_files(drive_service, query, fields):
+    files = []
+    page_token = None
+    while True:
+        response = drive_service.files().list(
+            q=query, fields=f"nextPageToken, files({fields})", pageToken=page_token,
+            supportsAllDrives=True, includeItemsFromAllDrives=True
+        ).execute()
+        files.extend(response.get("files", []))
+        page_token = response.get("nextPageToken")
+        if page_token is None:
+            return files
+
+
+def _create_folder(drive_service, folder_name, parent_id):
+    folder = drive_service.files().create(
+        body={"name": folder_name, "mimeType": _DRIVE_FOLDER_MIME_TYPE, "parents": [parent_id]},
+        fields="id", supportsAllDrives=True
+    ).execute()
+    return folder["id"]
+
+
+def _get_folder_id(drive_service, target_dir, create_missing=False):
+    """
+    Gets the id of a folder on Google Drive, where the first folder in the path has been shared with this service
+    account.
+
+    Each folder in the path is looked up by name in the same way as `drive_client_wrapper`, so that this resolves to
+    the folder the `drive_client_wrapper` uploads into. If any folder in the path has duplicates, there is no way to
+    tell which of them the `drive_client_wrapper` will use, so this returns None rather than guessing.
+
+    :param drive_service: Google Drive API service.
+    :type drive_service: googleapiclient.discovery.Resource
+    :param target_dir: Path to the folder on Google Drive.
+    :type target_dir: str
+    :param create_missing: Whether to create any folders in the path that don't exist yet, other than the shared folder
+                           at the start of the path.
+    :type create_missing: bool
+    :return: Id of the folder, or None if the folder does not exist or any folder in the path has duplicates.
+    :rtype: str | None
+    """
+    folder_id = None
+    for folder_name in target_dir.split("/"):
+        if folder_id is None:
+            parent_query = "sharedWithMe = true"
+        else:
+            parent_query = f"'{folder_id}' in parents"
+
+        folders = _list_files(
+            drive_service,
+            f"name = '{_quote(folder_name)}' and mimeType = '{_DRIVE_FOLDER_MIME_TYPE}' and {parent_query} "
+            f"and trashed = false",
+            "id"
+        )
+        if len(folders) > 1:
+            log.warning(f"Found {len(folders)} folders named '{folder_name}' in Google Drive path '{target_dir}'")
+            return None
+
+        if len(folders) == 0:
+            if not create_missing or folder_id is None:
+                return None
+            log.info(f"Creating folder '{folder_name}' in Google Drive path '{target_dir}'...")
+            folder_id = _create_folder(drive_service, folder_name, folder_id)
+        else:
+            folder_id = folders[0]["id"]
+
+    return folder_id
+
+
+def get_remote_md5_checksums(target_dir, drive_service=None):
+    """
+    Gets the md5 checksums of the files in a folder on Google Drive.
+
+    :param target_dir: Path to the folder on Google Drive.
+    :type target_dir: str
+    :param drive_service: Google Drive API service to use. If None, uses a service with the credentials given to
+                          `init_client`.
+    :type drive_service: googleapiclient.discovery.Resource | None
+    :return: Dictionary of file name -> set of md5 checksums of the files with that name. There may be more than one
+             checksum if there are duplicate files with the same name. If the folder does not exist, or its path is
+             ambiguous because a folder in it has duplicates, returns an empty dictionary.
+    :rtype: dict of str -> set of str
+    """
+    if drive_service is None:
+        drive_service = _get_drive_service()
+
+    folder_id = _get_folder_id(drive_service, target_dir)
+    if folder_id is None:
+        return dict()
+
+    checksums = dict()  # of file name -> set of md5 checksum
+    for f in _list_files(drive_service, f"'{folder_id}' in parents and trashed = false", "name, md5Checksum"):
+        if f["name"] not in checksums:
+            checksums[f["name"]] = set()
+        checksums[f["name"]].add(f.get("md5Checksum"))
+    return checksums
+
+
+def _compute_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _upload_files_to_dir(source_file_paths, target_dir):
+    """
+    Uploads files from local disk to a single folder on Google Drive, replacing any existing files with the same names.
+
+    :param source_file_paths: Paths to the local files on disk to upload.
+    :type source_file_paths: list of str
     :param target_dir: Path to target directory on Google Drive.
     :type target_dir: str
     """
-    log.info(f"Uploading '{source_file_path}' to Google Drive path '{target_dir}'...")
-    drive_client_wrapper.update_or_create(
-        source_file_path=source_file_path,
-        target_folder_path=target_dir,
-        target_file_name=os.path.basename(source_file_path),
-        target_folder_is_shared_with_me=True,
-        recursive=True,
-        fix_duplicates=True
-    )
+    if len(source_file_paths) == 1:
+        log.info(f"Uploading '{source_file_paths[0]}' to Google Drive path '{target_dir}'...")
+        drive_client_wrapper.update_or_create(
+            source_file_path=source_file_paths[0],
+            target_folder_path=target_dir,
+            target_file_name=os.path.basename(source_file_paths[0]),
+            target_folder_is_shared_with_me=True,
+            recursive=True,
+            fix_duplicates=True
+        )
+    else:
+        log.info(f"Uploading {len(source_file_paths)} files to Google Drive path '{target_dir}'...")
+        drive_client_wrapper.update_or_create_batch(
+            source_file_paths=source_file_paths,
+            target_folder_path=target_dir,
+            target_folder_is_shared_with_me=True,
+            recursive=True,
+            fix_duplicates=True
+        )
 
 
-def upload_all_files_in_dir(source_dir_path, target_dir, recursive=False):
+def _init_worker(credentials_info):
+    # The `drive_client_wrapper` uses a single, global client that isn't thread-safe, so give each worker process its
+    # own client.
+    drive_client_wrapper.init_client_from_info(credentials_info)
+
+
+def upload_files(uploads, max_concurrent_uploads=1, skip_unchanged=True, drive_service=None):
     """
-    Uploads all files in a directory to Google Drive.
+    Uploads files from local disk to Google Drive.
+
+    Files that are already on Google Drive with the same md5 checksum are not uploaded again. The remaining files are
+    uploaded in a batch per target directory, with up to `max_concurrent_uploads` directories uploaded at once.
+
+    :param uploads: List of (path to a local file on disk to upload, path to target directory on Google Drive).
+    :type uploads: list of (str, str)
+    :param max_concurrent_uploads: Maximum number of target directories to upload files to at once. If 1, uploads each
+                                   target directory's files in turn, in this process.
+    :type max_concurrent_uploads: int
+    :param skip_unchanged: Whether to skip uploading files whose local md5 checksum matches the md5 checksum of the file
+                           with the same name that is already in the target directory on Google Drive.
+    :type skip_unchanged: bool
+    :param drive_service: Google Drive API service to use to read the checksums of existing files and to create target
+                          directories. If None, uses a service with the credentials given to `init_client`.
+    :type drive_service: googleapiclient.discovery.Resource | None
+    """
+    files_to_upload = dict()  # of target dir -> list of source file paths
+    remote_checksums = dict()  # of target dir -> (dict of file name -> set of md5 checksum)
+    skipped = 0
+    for source_file_path, target_dir in uploads:
+        if skip_unchanged:
+            if target_dir not in remote_checksums:
+                remote_checksums[target_dir] = get_remote_md5_checksums(target_dir, drive_service)
+            if remote_checksums[target_dir].get(os.path.basename(source_file_path)) == {_compute_md5(source_file_path)}:
+                skipped += 1
+                continue
+
+        if target_dir not in files_to_upload:
+            files_to_upload[target_dir] = []
+        files_to_upload[target_dir].append(source_file_path)
+
+    log.info(f"Uploading {len(uploads) - skipped} files to Google Drive; skipping the other {skipped} files because "
+             f"they are unchanged")
+
+    if max_concurrent_uploads == 1:
+        for target_dir, source_file_paths in files_to_upload.items():
+            _upload_files_to_dir(source_file_paths, target_dir)
+        return
+
+    # Create the target directories one at a time before uploading, otherwise concurrent uploads to a directory that
+    # doesn't exist yet would each create it. Parents are sorted before their children, so each folder is only created
+    # once. Directories whose path is ambiguous are uploaded to in this process, so the `drive_client_wrapper` still
+    # only creates their missing folders one at a time.
+    if drive_service is None:
+        drive_service = _get_drive_service()
+    concurrent_target_dirs = []
+    for target_dir in sorted(files_to_upload.keys()):
+        if _get_folder_id(drive_service, target_dir, create_missing=True) is None:
+            _upload_files_to_dir(files_to_upload[target_dir], target_dir)
+        else:
+            concurrent_target_dirs.append(target_dir)
+
+    # Start the workers with "spawn", so that each worker creates its own connections rather than inheriting copies of
+    # this process's.
+    assert _credentials_info is not None, "Google Drive client not initialised. Call `init_client` first."
+    with ProcessPoolExecutor(max_workers=max_concurrent_uploads, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(_credentials_info,)) as executor:
+        futures = [
+            executor.submit(_upload_files_to_dir, files_to_upload[target_dir], target_dir)
+            for target_dir in concurrent_target_dirs
+        ]
+        for future in futures:
+            future.result()
 
-    Note this is non-recursive i.e. files in subdirectories will not be uploaded.
+
+def get_uploads_for_dir(source_dir_path, target_dir, recursive=False):
+    """
+    Gets the uploads needed to upload all the files in a directory to Google Drive, for use with `upload_files`.
 
     :param source_dir_path: Path to a local directory on disk to upload files from.
     :type source_dir_path: str
     :param target_dir: Path to target directory on Google Drive.
     :type target_dir: str
-    :param recursive: Whether to recursively upload any sub-directories in this directory too.
+    :param recursive: Whether to include the files in any sub-directories of this directory too.
     :type recursive: bool
+    :return: List of (path to a local file on disk to upload, path to target directory on Google Drive).
+    :rtype: list of (str, str)
     """
     source_dir_contents = [os.path.join(source_dir_path, f) for f in os.listdir(source_dir_path)]
 
-    # Batch upload all the files in this directory
-    file_paths = []
+    uploads = []
     for path in source_dir_contents:
         if os.path.isfile(path):
-            file_paths.append(path)
-    drive_client_wrapper.update_or_create_batch(
-        source_file_paths=file_paths,
-        target_folder_path=target_dir,
-        target_folder_is_shared_with_me=True,
-        recursive=True,
-        fix_duplicates=True
-    )
+            uploads.append((path, target_dir))
 
     if recursive:
         for path in source_dir_contents:
             if not os.path.isfile(path):
-                upload_all_files_in_dir(path, f"{target_dir}/{os.path.basename(path)}", recursive=True)
+                uploads.extend(get_uploads_for_dir(path, f"{target_dir}/{os.path.basename(path)}", recursive=True))
+
+    return uploads
+
+
+def upload_file(source_file_path, target_dir):
+    """
+    Uploads a file from local disk to Google Drive.
+
+    :param source_file_path: Path to a local file on disk to upload.
+    :type source_file_path: str
+    :param target_dir: Path to target directory on Google Drive.
+    :type target_dir: str
+    """
+    _upload_files_to_dir([source_file_path], target_dir)
+
+
+def upload_all_files_in_dir(source_dir_path, target_dir, recursive=False):
+    """
+    Uploads all files in a directory to Google Drive.
+
+    Note this is non-recursive i.e. files in subdirectories will not be uploaded.
+
+    :param source_dir_path: Path to a local directory on disk to upload files from.
+    :type source_dir_path: str
+    :param target_dir: Path to target directory on Google Drive.
+    :type target_dir: str
+    :param recursive: Whether to recursively upload any sub-directories in this directory too.
+    :type recursive: bool
+    """
+    upload_files(get_uploads_for_dir(source_dir_path, target_dir, recursive), skip_unchanged=False)
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from core_data_modules.analysis.mapping import participation_maps, kenya_mapper, somalia_mapper
+from core_data_modules.logging import Logger
+from core_data_modules.util import IOUtils
+
+from src.engagement_db_to_analysis.configuration import AnalysisLocations, MapConfiguration
+
+log = Logger(__name__)
+
+MAPPERS = {
+    AnalysisLocations.KENYA_COUNTY: kenya_mapper.export_kenya_counties_map,
+    AnalysisLocations.KENYA_CONSTITUENCY: kenya_mapper.export_kenya_constituencies_map,
+
+    AnalysisLocations.MOGADISHU_SUB_DISTRICT: somalia_mapper.export_mogadishu_sub_district_frequencies_map,
+    AnalysisLocations.SOMALIA_DISTRICT: somalia_mapper.export_somalia_district_frequencies_map,
+    AnalysisLocations.SOMALIA_REGION: somalia_mapper.export_somalia_region_frequencies_map
+}
+
+
+def _get_map_configurations(analysis_config):
+    """
+    :param analysis_config: Analysis configuration.
+    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+    :return: The configured maps, or if no maps are configured, a default map configuration for every analysis
+             location in the dataset configurations that can be mapped.
+    :rtype: list of src.engagement_db_to_analysis.configuration.MapConfiguration
+    """
+    if analysis_config.maps is not None:
+        return analysis_config.maps
+
+    map_configurations = []
+    for analysis_dataset_config in analysis_config.dataset_configurations:
+        for coding_config in analysis_dataset_config.coding_configs:
+            if coding_config.analysis_location in MAPPERS:
+                map_configurations.append(MapConfiguration(coding_config.analysis_location))
+    return map_configurations
+
+
+def _get_map_render_jobs(participants_by_column, analysis_config, map_configurations, config_index, export_dir_path):
+    """
+    Computes the frequencies to draw on every participation map, without drawing any maps.
+
+    :param participants_by_column: Participants data in column-view format.
+    :type participants_by_column: iterable of dict
+    :param analysis_config: Analysis configuration.
+    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+    :param map_configurations: Configurations of the maps to compute the frequencies of.
+    :type map_configurations: list of src.engagement_db_to_analysis.configuration.MapConfiguration
+    :param config_index: Index of `analysis_config.dataset_configurations`.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+    :param export_dir_path: Directory the maps will be exported to.
+    :type export_dir_path: str
+    :return: List of (index of the map configuration in `map_configurations`, dict of region -> frequency, file path
+             to export the map to), for every map to draw.
+    :rtype: list of (int, dict of str -> int, str)
+    """
+    jobs = []
+    for map_config_index, map_config in enumerate(map_configurations):
+        dataset_config, coding_config = analysis_config.get_configurations_for_analysis_location(
+            map_config.analysis_location
+        )
+        column_config = config_index.get_column_config_for_dataset_name(coding_config.analysis_dataset)
+
+        # Pass a mapper that records each map to draw instead of drawing it, so the maps can be drawn afterwards,
+        # in parallel, skipping those that are already cached.
+        participation_maps.export_participation_maps(
+            participants_by_column, "consent_withdrawn", config_index.rqa_column_configs, column_config,
+            lambda frequencies, file_path, map_config_index=map_config_index: jobs.append(
+                (map_config_index, dict(frequencies), file_path)
+            ),
+            f"{export_dir_path}/maps/{column_config.dataset_name}/{column_config.dataset_name}_"
+        )
+
+    return jobs
+
+
+def _get_map_cache_key(map_config, frequencies):
+    """
+    Gets the key to cache a map under, which is a hash of everything drawn on the map.
+
+    The region filter is a function so can't be hashed directly. Instead, the regions it includes are hashed.
+
+    :param map_config: Configuration of the map.
+    :type map_config: src.engagement_db_to_analysis.configuration.MapConfiguration
+    :param frequencies: Dictionary of region -> frequency drawn on the map.
+    :type frequencies: dict of str -> int
+    :return: Cache key.
+    :rtype: str
+    """
+    if map_config.region_filter is None:
+        included_regions = None
+    else:
+        included_regions = [region for region in sorted(frequencies) if map_config.region_filter(region)]
+
+    key_data = {
+        "analysis_location": map_config.analysis_location,
+        "legend_position": map_config.legend_position,
+        "included_regions": included_regions,
+        "frequencies": frequencies
+    }
+    key_json = json.dumps(key_data, sort_keys=True, separators=(",", ":"))
+    return f"{map_config.analysis_location}_{hashlib.sha256(key_json.encode('utf-8')).hexdigest()}"
+
+
+def _render_map(map_config, frequencies, file_path):
+    IOUtils.ensure_dirs_exist_for_file(file_path)
+    MAPPERS[map_config.analysis_location](
+        frequencies, file_path, region_filter=map_config.region_filter, legend_position=map_config.legend_position
+    )
+
+
+# Map configurations shared by every map drawn in a worker process. This is set once per worker by `_init_worker`.
+_worker_map_configurations = None
+
+
+def _init_worker(map_configurations):
+    global _worker_map_configurations
+    _worker_map_configurations = map_configurations
+
+
+def _render_map_in_worker(map_config_index, frequencies, file_path):
+    _render_map(_worker_map_configurations[map_config_index], frequencies, file_path)
+
+
+def export_participation_maps(participants_by_column, analysis_config, config_index, export_dir_path, workers=1,
+                              cache=None):
+    """
+    Exports participation maps for each configured analysis location, to `export_dir_path`/maps.
+
+    The frequencies to draw on every map are computed first. Maps whose frequencies and configuration are the same as
+    a map in the cache are then copied from the cache, and the remaining maps are drawn, in parallel when
+    `workers` > 1. Maps in the cache that weren't used are then deleted from the cache.
+
+    :param participants_by_column: Participants data in column-view format.
+    :type participants_by_column: iterable of dict
+    :param analysis_config: Analysis configuration.
+    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+    :param config_index: Index of `analysis_config.dataset_configurations`.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+    :param export_dir_path: Directory to export the automated analysis files to.
+    :type export_dir_path: str
+    :param workers: Number of worker processes to draw the maps in. If 1, draws every map in this process.
+    :type workers: int
+    :param cache: Cache to copy unchanged maps from and save newly drawn maps to. If None, every map is drawn and no
+                  maps are cached.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
+    """
+    map_configurations = _get_map_configurations(analysis_config)
+    log.info(f"Exporting participation maps for locations "
+             f"{[config.analysis_location for config in map_configurations]}...")
+
+    jobs = _get_map_render_jobs(
+        participants_by_column, analysis_config, map_configurations, config_index, export_dir_path
+    )
+
+    jobs_to_render = []  # of (map config index, frequencies, file path, cache key)
+    used_cache_keys = set()
+    for map_config_index, frequencies, file_path in jobs:
+        cache_key = None
+        if cache is not None:
+            cache_key = _get_map_cache_key(map_configurations[map_config_index], frequencies)
+            used_cache_keys.add(cache_key)
+            if cache.get_participation_map(cache_key, file_path):
+                continue
+        jobs_to_render.append((map_config_index, frequencies, file_path, cache_key))
+    log.info(f"Drawing {len(jobs_to_render)} participation maps; copied the other "
+             f"{len(jobs) - len(jobs_to_render)} unchanged maps from the cache")
+
+    if workers == 1:
+        for map_config_index, frequencies, file_path, _ in jobs_to_render:
+            _render_map(map_configurations[map_config_index], frequencies, file_path)
+    else:
+        # Start the workers with "fork", so that the map configurations are inherited by the workers rather than
+        # pickled, because their region filters may be lambdas.
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_worker, initargs=(map_configurations,)) as executor:
+            futures = [
+                executor.submit(_render_map_in_worker, map_config_index, frequencies, file_path)
+                for map_config_index, frequencies, file_path, _ in jobs_to_render
+            ]
+            for future in futures:
+                future.result()
+
+    if cache is not None:
+        for _, _, file_path, cache_key in jobs_to_render:
+            cache.set_participation_map(cache_key, file_path)
+
+        # Delete the cached maps that weren't used in this run, so the cache doesn't grow every time the data changes.
+        deleted = cache.delete_participation_maps_except(used_cache_keys)
+        log.info(f"Deleted {deleted} participation maps from the cache that were not used in this run")
@@ -1,19 +1,26 @@
-import os
-from google.api_core.exceptions import NotFound
 import csv
+import json
+import os
 
 from core_data_modules.logging import Logger
 from core_data_modules.util import IOUtils
-from storage.google_cloud import google_cloud_utils
-from core_data_modules.util import TimeUtils
-from core_data_modules.traced_data import Metadata
+from google.cloud import storage
+
+from src.engagement_db_to_analysis.provenance import StepProvenance
 
 log = Logger(__name__)
 
+# Name of the file in the membership group directory that records the generation of each downloaded CSV.
+_GENERATIONS_FILE_NAME = ".generations.json"
+
 
 def _get_membership_groups_csvs(google_cloud_credentials_file_path, membership_group_csv_urls, membership_group_dir_path):
     """
     Downloads de-identified membership groups CSVs from g-cloud.
+
+    Each CSV is only downloaded if it hasn't been downloaded before, or if its blob has been updated since it was last
+    downloaded, detected by comparing the blob's generation with the generation that was downloaded.
+
     :param google_cloud_credentials_file_path: Path to the Google Cloud service account credentials file to use to
                                                access the credentials bucket.
     :type google_cloud_credentials_file_path: str
@@ -22,31 +29,54 @@ def _get_membership_groups_csvs(google_cloud_credentials_file_path, membership_g
     :param membership_group_dir_path: Path to directory containing de-identified membership groups CSVs containing membership groups data
                         stored as `avf-participant-uuid` column.
     """
-
+    generations_file_path = f"{membership_group_dir_path}/{_GENERATIONS_FILE_NAME}"
+    try:
+        with open(generations_file_path) as f:
+            downloaded_generations = json.load(f)  # of csv file name -> generation of the downloaded blob
+    except FileNotFoundError:
+        downloaded_generations = dict()
+
+    client = storage.Client.from_service_account_json(google_cloud_credentials_file_path)
     for membership_group, membership_group_csv_url in membership_group_csv_urls:
         for i, membership_group_csv_url in enumerate(membership_group_csv_url):
             membership_group_csv = membership_group_csv_url.split("/")[-1]
 
             export_file_path = f'{membership_group_dir_path}/{membership_group_csv}'
 
-            if os.path.exists(export_file_path):
-                log.info(f"File '{membership_group_csv}' already exists, skipping download")
+            bucket_name, blob_name = membership_group_csv_url.replace("gs://", "", 1).split("/", 1)
+            blob = client.bucket(bucket_name).get_blob(blob_name)
+            if blob is None:
+                log.warning(f"{membership_group_csv}' not found in google cloud, skipping download")
+                continue
+
+            if os.path.exists(export_file_path) and downloaded_generations.get(membership_group_csv) == blob.generation:
+                log.info(f"File '{membership_group_csv}' is already up to date, skipping download")
                 continue
 
-            try:
-                log.info(f"Saving '{membership_group_csv}' to directory f'{membership_group_dir_path}...")
-                IOUtils.ensure_dirs_exist_for_file(export_file_path)
-                with open(export_file_path, "wb") as membership_group_csv_file:
-                    google_cloud_utils.download_blob_to_file(
-                        google_cloud_credentials_file_path, membership_group_csv_url, membership_group_csv_file)
+            # Download the generation that was just looked-up, to a temporary file that is only moved into place once
+            # the download is complete.
+            log.info(f"Saving '{membership_group_csv}' (generation {blob.generation}) to directory "
+                     f"f'{membership_group_dir_path}...")
+            IOUtils.ensure_dirs_exist_for_file(export_file_path)
+            temp_file_path = f"{membership_group_dir_path}/.{membership_group_csv}_temp"
+            with open(temp_file_path, "wb") as membership_group_csv_file:
+                blob.download_to_file(membership_group_csv_file)
+            os.replace(temp_file_path, export_file_path)
+
+            downloaded_generations[membership_group_csv] = blob.generation
+            temp_generations_file_path = f"{generations_file_path}_temp"
+            with open(temp_generations_file_path, "w") as f:
+                json.dump(downloaded_generations, f)
+            os.replace(temp_generations_file_path, generations_file_path)
 
-            except NotFound:
-                log.warning(f"{membership_group_csv}' not found in google cloud, skipping download")
 
-def _get_membership_groups_data(google_cloud_credentials_file_path, membership_group_csv_urls,
-                                membership_group_dir_path):
+def load_membership_groups(google_cloud_credentials_file_path, membership_group_csv_urls, membership_group_dir_path):
     """
-    Downloads de-identified membership groups CSVs from g-cloud and groups them by their group identity.
+    Downloads any new or updated de-identified membership groups CSVs from g-cloud and groups their participants by
+    their group identity.
+
+    Load the membership groups once per run, and pass them to each call to `tag_membership_groups_participants`.
+
     :param google_cloud_credentials_file_path: Path to the Google Cloud service account credentials file to use to
                                                access the credentials bucket.
     :type google_cloud_credentials_file_path: str
@@ -55,6 +85,8 @@ def _get_membership_groups_data(google_cloud_credentials_file_path, membership_g
     :param membership_group_dir_path: Path to directory containing de-identified membership groups CSVs containing membership groups data
                         stored as `avf-participant-uuid` column.
     :type: membership_group_dir_path: str
+    :return: Dictionary of membership group name -> avf-participant-uuids of the participants in that group.
+    :rtype: dict of str -> set of str
     """
 
     # fetch the latest membership csvs
@@ -72,8 +104,7 @@ def _get_membership_groups_data(google_cloud_credentials_file_path, membership_g
 
             if os.path.exists(membership_group_csv_file_path):
                 with open(membership_group_csv_file_path, "r", encoding='utf-8-sig') as f:
-                    membership_group_data = list(csv.DictReader(f))
-                    for row in membership_group_data:
+                    for row in csv.DictReader(f):
                         membership_group_participants[membership_group].add(row['avf-participant-uuid'])
             else:
                 log.warning(f"{membership_group_csv} does not exist in {membership_group_dir_path} skipping!")
@@ -82,8 +113,10 @@ def _get_membership_groups_data(google_cloud_credentials_file_path, membership_g
 
     return membership_group_participants
 
+
 def tag_membership_groups_participants(user, google_cloud_credentials_file_path, column_view_traced_data,
-                                       membership_group_csv_urls, membership_group_dir_path):
+                                       membership_group_csv_urls, membership_group_dir_path, full_provenance=False,
+                                       membership_groups=None):
     """
     This tags uids who participated in projects membership groups.
     :param user: Identifier of the user running this program, for TracedData Metadata.
@@ -98,20 +131,25 @@ def tag_membership_groups_participants(user, google_cloud_credentials_file_path,
     :type membership_group_dir_path: str
     :param membership_group_csv_urls: Dict of membership group name to group g-cloud csv url(s).
     :type membership_group_csv_urls: Dict
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :param membership_groups: Membership groups returned by `load_membership_groups`. If None, the membership groups
+                              are loaded.
+    :type membership_groups: dict of str -> set of str | None
     """
-
-    _get_membership_groups_csvs(google_cloud_credentials_file_path, membership_group_csv_urls, membership_group_dir_path)
-
-    membership_group_participants = _get_membership_groups_data(google_cloud_credentials_file_path, membership_group_csv_urls,
-                            membership_group_dir_path)
+    if membership_groups is None:
+        membership_groups = load_membership_groups(
+            google_cloud_credentials_file_path, membership_group_csv_urls, membership_group_dir_path
+        )
 
     # Tag a participant based on the membership group type they belong to
+    provenance = StepProvenance(user, full_provenance)
+    membership_groups = list(membership_groups.items())
     for td in column_view_traced_data:
-        membership_group_participation_data = dict()
-
-        for membership_group in membership_group_participants.keys():
-            membership_group_participation_data[membership_group] = \
-                td['participant_uuid'] in membership_group_participants[membership_group]
+        participant_uuid = td['participant_uuid']
+        membership_group_participation_data = {
+            membership_group: participant_uuid in participant_uuids
+            for membership_group, participant_uuids in membership_groups
+        }
 
-        td.append_data(membership_group_participation_data, Metadata(user, Metadata.get_call_location(),
-                                                    TimeUtils.utc_now_as_iso_string()))
+        td.append_data(membership_group_participation_data, provenance.metadata())
@@ -0,0 +1,46 @@
+from engagement_database.data_models import Message
+
+
+class MessageViewCache:
+    def __init__(self):
+        """
+        Cache of the typed `Message` views of messages TracedData.
+
+        Deserializing a message TracedData to a `Message` is expensive, and most of the message-level stages of analysis
+        need the typed view of every message. This cache lets each message be deserialized once, and only be
+        deserialized again after its TracedData has been updated.
+
+        Callers that update a message TracedData that has a cached view must call `invalidate` after the update.
+        """
+        self._views = dict()  # of id(message_td) -> (message_td, Message)
+
+    def get_message(self, message_td):
+        """
+        Gets the typed view of the given message TracedData.
+
+        The returned message is shared with other callers, so must not be modified.
+
+        :param message_td: Message TracedData to get the typed view of.
+        :type message_td: core_data_modules.traced_data.TracedData
+        :return: `message_td` deserialized as a Message.
+        :rtype: engagement_database.data_models.Message
+        """
+        view = self._views.get(id(message_td))
+        # The cached TracedData is held by the cache, so its id can't be re-used by another object while it's cached.
+        # Check the identity anyway to guard against stale entries.
+        if view is not None and view[0] is message_td:
+            return view[1]
+
+        message = Message.from_dict(dict(message_td))
+        self._views[id(message_td)] = (message_td, message)
+        return message
+
+    def invalidate(self, message_td):
+        """
+        Removes the cached view of the given message TracedData, if there is one, so that the next call to
+        `get_message` deserializes the latest data.
+
+        :param message_td: Message TracedData to invalidate the view of.
+        :type message_td: core_data_modules.traced_data.TracedData
+        """
+        self._views.pop(id(message_td), None)
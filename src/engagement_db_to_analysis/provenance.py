@@ -0,0 +1,59 @@
+import sys
+
+from core_data_modules.traced_data import Metadata
+from core_data_modules.util import TimeUtils
+
+
+def _get_caller_location(depth):
+    """
+    Gets the location of a caller further up the stack.
+
+    This only reads the requested frame, so is much cheaper than `Metadata.get_call_location`, which inspects the
+    entire stack.
+
+    :param depth: Number of frames above the caller of this function to get the location of.
+    :type depth: int
+    :return: Location of the caller, as "<file path>:<line number>:<function name>".
+    :rtype: str
+    """
+    frame = sys._getframe(depth + 1)
+    return f"{frame.f_code.co_filename}:{frame.f_lineno}:{frame.f_code.co_name}"
+
+
+class StepProvenance:
+    def __init__(self, user, full_provenance=False):
+        """
+        Provides the Metadata to record for the TracedData updates made by one step of the analysis pipeline.
+
+        In the default, lightweight mode, every update in the step shares a single Metadata, which records where the
+        step was started from and when. In full mode, each update gets its own Metadata recording exactly where and
+        when it was made. Full mode is much slower on large datasets, so only use it when auditing.
+
+        Construct a StepProvenance at the start of each step.
+
+        :param user: Identifier of user running the pipeline.
+        :type user: str
+        :param full_provenance: Whether to record a separate Metadata for each update, rather than one shared Metadata
+                                for the whole step.
+        :type full_provenance: bool
+        """
+        self.user = user
+        self.full_provenance = full_provenance
+
+        if full_provenance:
+            self._step_metadata = None
+        else:
+            self._step_metadata = Metadata(user, _get_caller_location(1), TimeUtils.utc_now_as_iso_string())
+
+    def metadata(self):
+        """
+        Gets the Metadata to record for a TracedData update in this step.
+
+        :return: The shared step Metadata in lightweight mode, or a new Metadata for the location this method was
+                 called from in full mode.
+        :rtype: core_data_modules.traced_data.Metadata
+        """
+        if self._step_metadata is not None:
+            return self._step_metadata
+
+        return Metadata(self.user, _get_caller_location(1), TimeUtils.utc_now_as_iso_string())
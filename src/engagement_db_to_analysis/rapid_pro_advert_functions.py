@@ -3,8 +3,9 @@ from core_data_modules.analysis import analysis_utils, AnalysisConfiguration as
 from core_data_modules.cleaners import Codes
 from core_data_modules.logging import Logger
 
+from src.common.update_rapid_pro_contacts import update_rapid_pro_contacts
 from src.engagement_db_to_analysis.cache import AnalysisCache
-from src.engagement_db_to_analysis.membership_group import (_get_membership_groups_data)
+from src.engagement_db_to_analysis.membership_group import load_membership_groups
 from src.pipeline_configuration_spec import *
 
 
@@ -14,7 +15,8 @@ CONSENT_WITHDRAWN_KEY = "consent_withdrawn"
 
 #TODO move this to engagement db to rapid_pro sync once we support syncing imputed labels to db
 def _generate_weekly_advert_uuids(participants_by_column, analysis_config,
-                                              google_cloud_credentials_file_path, membership_group_dir_path):
+                                  google_cloud_credentials_file_path, membership_group_dir_path,
+                                  membership_groups=None):
     '''
     Generates sets of weekly advert UUIDs to advertise to. A participant is considered as
     being needed to advertise to if they are in the participants_by_column or
@@ -30,6 +32,9 @@ def _generate_weekly_advert_uuids(participants_by_column, analysis_config,
     :param membership_group_dir_path: Path to directory containing de-identified membership groups CSVs containing membership groups data
                         stored as `avf-participant-uuid` column.
     :type: membership_group_dir_path: str
+    :param membership_groups: Membership groups returned by `load_membership_groups`. If None, the membership groups
+                              are loaded.
+    :type membership_groups: dict of str -> set of str | None
     :return opt_out_uuids and weekly_advert_uuids : Set of opted out and weekly advert uuids.
     :rtype opt_out_uuids & weekly_advert_uuids: (set of str, set of str)
     '''
@@ -46,15 +51,15 @@ def _generate_weekly_advert_uuids(participants_by_column, analysis_config,
     # If available, add consented membership group uids to advert uuids
     if analysis_config.membership_group_configuration is not None:
         log.info(f"Adding consented membership group uids to advert uuids ")
-        membership_group_csv_urls = \
-            analysis_config.membership_group_configuration.membership_group_csv_urls.items()
-
-        membership_groups_data = _get_membership_groups_data(google_cloud_credentials_file_path,
-                                                            membership_group_csv_urls, membership_group_dir_path)
+        if membership_groups is None:
+            membership_group_csv_urls = \
+                analysis_config.membership_group_configuration.membership_group_csv_urls.items()
+            membership_groups = load_membership_groups(google_cloud_credentials_file_path,
+                                                       membership_group_csv_urls, membership_group_dir_path)
 
         consented_membership_groups_uuids = 0
         opt_out_membership_groups_uuids = 0
-        for membership_group in membership_groups_data.values():
+        for membership_group in membership_groups.values():
             for uuid in membership_group:
                 if uuid in opt_out_uuids:
                     opt_out_membership_groups_uuids += 1
@@ -107,26 +112,6 @@ def _generate_non_relevant_advert_uuids_by_dataset(participants_by_column, analy
     return non_relevant_uuids
 
 
-def _convert_uuids_to_urns(uuids_group, uuid_table):
-    """
-    Converts a list of UUIDs to their respective rapid_pro urns.
-
-    :param uuids_group: set of participant UUIDs to convert.
-    :type uuids_group: set of participant UUIDs.
-    :param uuid_table: UUID table to use to de-identify contact urns.
-    :type uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
-    :return urns: a set of de-identified urn.
-    :rtype: set of str
-    """
-
-    log.info(f"Converting {len(uuids_group)} uuids to urns...")
-    urn_lut = uuid_table.uuid_to_data_batch(uuids_group)
-    urns = {urn_lut[uuid] for uuid in uuids_group}
-    log.info(f"Converted {len(uuids_group)} uuids to {len(urns)} urns")
-
-    return urns
-
-
 #Todo: standardize and move to rapidpro tools
 def _ensure_contact_field_exists(workspace_contact_fields, contact_field, rapid_pro, dry_run=False):
     """
@@ -147,10 +132,13 @@ def _ensure_contact_field_exists(workspace_contact_fields, contact_field, rapid_
 
 
 def _sync_advert_contacts_fields_to_rapid_pro(cache, target_uuids, advert_contact_field_key, uuid_table, rapid_pro,
-                                              dry_run=False):
+                                              batch_size=100, max_concurrent_updates=1, dry_run=False):
     """
     Updates the advert contact field for the target urns.
 
+    The uuids to sync are re-identified and updated in batches. Each uuid is journaled to the cache as soon as its
+    contact has been updated, so a run that is resumed after a crash never updates the same contact twice.
+
     :param cache: An instance of AnalysisCache to get uuids synced in previous pipeline run and set uuids synced in this session.
     :param type: AnalysisCache
     :param target_uuids: Set containing all uuids for the target context e.g opt_out uuids, weekly advert uuids.
@@ -161,40 +149,52 @@ def _sync_advert_contacts_fields_to_rapid_pro(cache, target_uuids, advert_contac
     :type uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable.
     :param rapid_pro: Rapid Pro client to sync the groups to.
     :type rapid_pro: rapid_pro_tools.rapid_pro.RapidProClient
+    :param batch_size: Number of uuids to re-identify and update in Rapid Pro in each batch.
+    :type batch_size: int
+    :param max_concurrent_updates: Maximum number of Rapid Pro contact updates to have in flight at once.
+    :type max_concurrent_updates: int
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
     """
-    synced_uuids = []
+    synced_uuids = set()
     if cache is not None:
-        previously_synced_non_relevant_uuids = cache.get_synced_uuids(advert_contact_field_key)
-        log.info(f'Found {len(previously_synced_non_relevant_uuids)} uuids whose {advert_contact_field_key} contact '
+        synced_uuids = cache.get_synced_uuids(advert_contact_field_key)
+        log.info(f'Found {len(synced_uuids)} uuids whose {advert_contact_field_key} contact '
                  f'field was synced in previous pipeline run...')
-        synced_uuids.extend(previously_synced_non_relevant_uuids)
+        if not dry_run:
+            cache.set_synced_uuids(advert_contact_field_key, synced_uuids)
 
     # If cache is available, check for uuids to sync in the current pipeline run.
-    uuids_to_sync = target_uuids - set(synced_uuids)
+    # Sort the uuids so that batches are the same between runs.
+    uuids_to_sync = sorted(target_uuids - synced_uuids)
+
+    if len(uuids_to_sync) == 0:
+        log.info("Found 0 uuids to sync in this run skipping...")
+        return
+
+    log.info(f'Syncing {len(uuids_to_sync)} urns in this run ')
+    for batch_start in range(0, len(uuids_to_sync), batch_size):
+        batch_uuids = uuids_to_sync[batch_start:batch_start + batch_size]
 
-    if len(uuids_to_sync) > 0:
-        log.info(f'Syncing {len(uuids_to_sync)} urns in this run ')
         # Re-identify the uuids.
-        urns_to_sync = _convert_uuids_to_urns(uuids_to_sync, uuid_table)
-        # Update the advert contact field for the target urns.
-        for urn in urns_to_sync:
-            if not dry_run:
-                rapid_pro.update_contact(urn, contact_fields={advert_contact_field_key: "yes"})
-            synced_uuids.append(uuid_table.data_to_uuid(urn))
+        uuid_to_urn = uuid_table.uuid_to_data_batch(batch_uuids)
+        urn_to_uuid = {urn: uuid for uuid, urn in uuid_to_urn.items()}
 
+        def on_contact_updated(urn):
             if cache is not None and not dry_run:
-                cache.set_synced_uuids(advert_contact_field_key, synced_uuids)
+                cache.add_synced_uuids(advert_contact_field_key, [urn_to_uuid[urn]])
 
-    else:
-        assert len(uuids_to_sync) == 0
-        log.info("Found 0 uuids to sync in this run skipping...")
+        # Update the advert contact field for the target urns.
+        update_rapid_pro_contacts(
+            rapid_pro, {urn: {advert_contact_field_key: "yes"} for urn in urn_to_uuid},
+            max_concurrent_updates, on_contact_updated, dry_run
+        )
+        log.info(f"Synced {min(batch_start + batch_size, len(uuids_to_sync))}/{len(uuids_to_sync)} urns")
 
 
 def sync_advert_contacts_to_rapid_pro(participants_by_column, uuid_table, pipeline_config, rapid_pro,
                                       google_cloud_credentials_file_path, membership_group_dir_path, cache_path,
-                                      dry_run=False):
+                                      dry_run=False, membership_groups=None):
     """
     Syncs advert contacts to rapid_pro by:
       1. Updating the contact field for weekly advert urns who are in the participants_by_column or a listening group and
@@ -220,6 +220,9 @@ def sync_advert_contacts_to_rapid_pro(participants_by_column, uuid_table, pipeli
     :type cache_path: str
     :param dry_run: Whether to perform a dry run.
     :type dry_run: bool
+    :param membership_groups: Membership groups returned by `load_membership_groups`. If None, the membership groups
+                              are loaded.
+    :type membership_groups: dict of str -> set of str | None
     """
     if cache_path is None:
         cache = None
@@ -230,20 +233,23 @@ def sync_advert_contacts_to_rapid_pro(participants_by_column, uuid_table, pipeli
 
     weekly_advert_uuids = _generate_weekly_advert_uuids(
         participants_by_column, pipeline_config.analysis,
-        google_cloud_credentials_file_path, membership_group_dir_path
+        google_cloud_credentials_file_path, membership_group_dir_path, membership_groups
     )
 
     # Get workspace contact fields to check whether our target contact field exists
     workspace_contact_fields = rapid_pro.get_fields()
 
-    weekly_advert_contact_field = pipeline_config.rapid_pro_target.sync_config.weekly_advert_contact_field
+    sync_config = pipeline_config.rapid_pro_target.sync_config
+
+    weekly_advert_contact_field = sync_config.weekly_advert_contact_field
     if weekly_advert_contact_field is None:
         log.debug(f"Not syncing the weekly advert contacts to rapid pro because `weekly_advert_contact_field` was None")
     else:
         log.info(f"Syncing weekly advert contacts to rapid pro...")
         _ensure_contact_field_exists(workspace_contact_fields, weekly_advert_contact_field, rapid_pro, dry_run)
         _sync_advert_contacts_fields_to_rapid_pro(
-            cache, weekly_advert_uuids, weekly_advert_contact_field.key, uuid_table, rapid_pro, dry_run
+            cache, weekly_advert_uuids, weekly_advert_contact_field.key, uuid_table, rapid_pro,
+            sync_config.contact_update_batch_size, sync_config.max_concurrent_contact_updates, dry_run
         )
 
     # Update dataset non-relevant groups to rapid_pro
@@ -258,4 +264,5 @@ def sync_advert_contacts_to_rapid_pro(participants_by_column, uuid_table, pipeli
 
             _sync_advert_contacts_fields_to_rapid_pro(cache, non_relevant_uuids,
                                                       analysis_dataset_config.rapid_pro_non_relevant_field.key,
-                                                      uuid_table, rapid_pro, dry_run)
+                                                      uuid_table, rapid_pro, sync_config.contact_update_batch_size,
+                                                      sync_config.max_concurrent_contact_updates, dry_run)
@@ -2,11 +2,16 @@ from core_data_modules.analysis.analysis_utils import normal_codes
 from core_data_modules.logging import Logger
 
 from src.engagement_db_to_analysis.regression_analysis.data_conversion import \
-    convert_participants_to_regression_data_frame
+    convert_participants_to_regression_columns
+from src.engagement_db_to_analysis.regression_analysis.r_runtime import get_r_runtime
+from src.engagement_db_to_analysis.regression_analysis.r_utils import convert_columns_to_r_data_frame_of_factors
+from src.engagement_db_to_analysis.regression_analysis.regression_results_cache import \
+    get_regression_results_cache_key
 
 
 log = Logger(__name__)
 
+ANALYSIS_NAME = "complete_case_regression"
 GLM_FAMILY = 'binomial(link="logit")'
 
 
@@ -23,7 +28,7 @@ def _get_model_formula(theme, predictors):
 
 
 def run_complete_case_regression_analysis(participants, consent_withdrawn_field, rqa_analysis_config,
-                                          demog_analysis_configs):
+                                          demog_analysis_configs, cache=None, used_cache_keys=None):
     """
     Runs complete-case, multivariate regression analysis on one RQA configuration against multiple demographics.
 
@@ -40,46 +45,78 @@ def run_complete_case_regression_analysis(participants, consent_withdrawn_field,
                                    TODO: The actual demographics are currently a hard-coded subset of what is provided
                                          here. Derive automatically or from configuration in future.
     :type demog_analysis_configs: list of core_data_modules.analysis.AnalysisConfiguration
+    :param cache: Cache to read regression results from and write them to, keyed on a hash of the regression data and
+                  model settings. If the results for this data and model are already cached, they are returned without
+                  running R. If None, the regression is always run and the results are not cached.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
+    :param used_cache_keys: If not None, the key the results were read from or written to in `cache` is added to
+                            this set.
+    :type used_cache_keys: set of str | None
     :return: Dictionary of theme -> regression results table, formatted as a string.
     :rtype: dict of str -> str
             TODO: Return the regression results table as an object that can be inspected and formatted rather than a str
     """
-    from rpy2.interactive.packages import importr
-    from rpy2.robjects import r
-
-    # Initialise R
-    base = importr("base")
-    arm = importr("arm")  # Library for 'Data Analysis Using Regression and Multilevel/Hierarchical Models'
-
-    data_frame = convert_participants_to_regression_data_frame(
+    regression_columns = convert_participants_to_regression_columns(
         participants, consent_withdrawn_field, rqa_analysis_config, demog_analysis_configs
     )
 
     # TODO: Derive these predictors automatically or from configuration rather than from a hard-coded list.
     predictors = ["gender", "age_category", "disability", "recently_displaced"]
 
-    results = dict()
+    formulae = dict()  # of theme -> model formula
     for code in normal_codes(rqa_analysis_config.code_scheme.codes):
         theme = f"{rqa_analysis_config.dataset_name}_{code.string_value}"
-        formula = _get_model_formula(theme, predictors)
+        formulae[theme] = _get_model_formula(theme, predictors)
+
+    cache_key = None
+    if cache is not None:
+        cache_key = get_regression_results_cache_key(
+            ANALYSIS_NAME, regression_columns, {"formulae": formulae, "glm_family": GLM_FAMILY}
+        )
+        if used_cache_keys is not None:
+            used_cache_keys.add(cache_key)
+        cached_results = cache.get_regression_results(cache_key)
+        if cached_results is not None:
+            log.info(f"Using cached complete case regression results for dataset "
+                     f"'{rqa_analysis_config.dataset_name}'")
+            return cached_results
+
+    # Get R, which is only started, and its packages loaded, the first time they are needed in this process.
+    r_runtime = get_r_runtime()
+    base = r_runtime.get_package("base")
+    arm = r_runtime.get_package("arm")  # Library for 'Data Analysis Using Regression and Multilevel/Hierarchical Models'
+    r = r_runtime.r
+
+    data_frame = convert_columns_to_r_data_frame_of_factors(regression_columns)
+
+    results = dict()
+    for theme, formula in formulae.items():
 
         log.info(f"Running complete case regression '{formula}'...")
-        regression_results = arm.bayesglm(formula, family=r(GLM_FAMILY), data=data_frame)
+        with r_runtime.time_fitting():
+            regression_results = arm.bayesglm(formula, family=r(GLM_FAMILY), data=data_frame)
 
-        summarised_results = base.summary(regression_results)
-        coefficients = summarised_results.rx2("coefficients")
-        results_table = str(coefficients)
+            summarised_results = base.summary(regression_results)
+            coefficients = summarised_results.rx2("coefficients")
+            results_table = str(coefficients)
         results[theme] = results_table
 
+    if cache is not None:
+        cache.set_regression_results(cache_key, results)
+
     return results
 
 
-def run_all_complete_case_regression_analysis(participants, consent_withdrawn_field, rqa_analysis_configs, demog_analysis_configs):
+def run_all_complete_case_regression_analysis(participants, consent_withdrawn_field, rqa_analysis_configs, demog_analysis_configs,
+                                              cache=None):
     """
     Runs all the complete case regression analysis for multiple RQA and demographic configurations.
 
     This function calls `run_complete_case_regression_analysis` once for each of the given `rqa_analysis_configs`.
 
+    Complete case regression results in the `cache` that weren't used by any of these RQAs are then deleted from the
+    cache.
+
     :param participants: Participants to analyse.
     :type participants: iterable of core_data_modules.traced_data.TracedData
     :param consent_withdrawn_field: Field in each participants object which records if consent is withdrawn.
@@ -91,21 +128,30 @@ def run_all_complete_case_regression_analysis(participants, consent_withdrawn_fi
                                    TODO: The actual demographics are currently a hard-coded subset of what is provided
                                          here. Derive automatically or from configuration in future.
     :type demog_analysis_configs: list of core_data_modules.analysis.AnalysisConfiguration
+    :param cache: Cache of regression results. See `run_complete_case_regression_analysis`.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
     :return: Dictionary of dataset_name -> (dict of theme -> results table as text)
     :rtype dict of str -> (dict of str -> str)
     """
     all_results = dict()  # of dataset_name -> (dict of theme -> results table as text)
+    used_cache_keys = set()
     for rqa_config in rqa_analysis_configs:
         rqa_results = run_complete_case_regression_analysis(
-            participants, consent_withdrawn_field, rqa_config, demog_analysis_configs
+            participants, consent_withdrawn_field, rqa_config, demog_analysis_configs, cache, used_cache_keys
         )
         all_results[rqa_config.dataset_name] = rqa_results
 
+    get_r_runtime().log_timings()
+
+    if cache is not None:
+        deleted = cache.delete_regression_results_except(ANALYSIS_NAME, used_cache_keys)
+        log.info(f"Deleted {deleted} complete case regression results that weren't used from the cache")
+
     return all_results
 
 
 def export_all_complete_case_regression_analysis_txt(participants, consent_withdrawn_field, rqa_analysis_configs,
-                                                     demog_analysis_configs, f):
+                                                     demog_analysis_configs, f, cache=None):
     """
     Computes all the complete-case regression analysis and exports them to a text file.
 
@@ -122,9 +168,11 @@ def export_all_complete_case_regression_analysis_txt(participants, consent_withd
     :type demog_analysis_configs: list of core_data_modules.analysis.AnalysisConfiguration
     :param f: Text file to write the regression results to.
     :type f: file-like
+    :param cache: Cache of regression results. See `run_complete_case_regression_analysis`.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
     """
     regression_results = run_all_complete_case_regression_analysis(
-        participants, consent_withdrawn_field, rqa_analysis_configs, demog_analysis_configs
+        participants, consent_withdrawn_field, rqa_analysis_configs, demog_analysis_configs, cache
     )
 
     for results in regression_results.values():
@@ -4,25 +4,7 @@ from core_data_modules.analysis import analysis_utils
 from core_data_modules.analysis.analysis_utils import get_codes_from_td, normal_codes
 from core_data_modules.cleaners import Codes
 
-from src.engagement_db_to_analysis.regression_analysis.r_utils import convert_dicts_to_r_data_frame_of_factors
-
-
-def _get_matrix_values(codes, dataset_name, code_scheme):
-    """
-    Gets the normal matrix values for a list of codes.
-    """
-    matrix_values = dict()  # of str -> str
-
-    code_ids = {code.code_id for code in codes}
-    for code in normal_codes(code_scheme.codes):
-        if code.code_id in code_ids:
-            value = 1  # Use 1 here instead of Codes.MATRIX_1 because the type needs to be int, not str.
-        else:
-            value = 0
-
-        matrix_values[f"{dataset_name}_{code.string_value}"] = value
-
-    return matrix_values
+from src.engagement_db_to_analysis.regression_analysis.r_utils import convert_columns_to_r_data_frame_of_factors
 
 
 def _get_categorical_value(codes):
@@ -39,43 +21,62 @@ def _get_categorical_value(codes):
     return all_normal_codes[0].string_value
 
 
-def _get_participant_regression_data(participant, consent_withdrawn_field, rqa_analysis_config, demog_analysis_configs):
+def convert_participants_to_regression_columns(participants, consent_withdrawn_field,
+                                               rqa_analysis_config, demog_analysis_configs):
     """
-    Gets the relevant data needed for regression analysis from a single participant.
+    Converts a list of participants into the data needed for regression analysis, in column-format, with one value per
+    relevant participant in each column.
 
-    The returned data contains:
-     - The participant_uuid
-     - The normal RQA labels, in matrix-format.
-     - The normal demographic labels, in categorical-format.
+    The columns are built directly while reading each participant, rather than building a dictionary per participant
+    and transposing, and contain the values as the strings R's factors are built from. They contain the same data,
+    in the same order, as the data-frame returned by `convert_participants_to_regression_data_frame`:
+     - All the normal codes in the rqa configuration, in matrix-format, as "1" or "0".
+     - All the normal codes in the demog configurations, in categorical-format, or None if the participant has no
+       normal code for that demographic.
 
-    :param participant: Participant to get the relevant regression data from.
-    :type participant: core_data_modules.traced_data.TracedData
+    :param participants: Participants to convert.
+    :type participants: iterable of core_data_modules.traced_data.TracedData
     :param consent_withdrawn_field: Field in each participants object which records if consent is withdrawn.
     :type consent_withdrawn_field: str
-    :param rqa_analysis_config: Configuration for the RQA dataset to include in the returned data-frame.
+    :param rqa_analysis_config: Configuration for the RQA dataset to include in the returned data.
     :type rqa_analysis_config: core_data_modules.analysis.AnalysisConfiguration
-    :param demog_analysis_configs: Configuration for the demographic datasets to include in the returned data-frame.
+    :param demog_analysis_configs: Configuration for the demographic datasets to include in the returned data.
     :type demog_analysis_configs: list of core_data_modules.analysis.AnalysisConfiguration
+    :return: Dictionary of column name -> values for each relevant participant e.g. {"s01e01_yes": ["1", "0", ...]}
+    :rtype: dict of str -> (list of (str | None))
     """
-    # Ensure participant has not opted-out
-    assert participant[consent_withdrawn_field] == Codes.FALSE
+    responded_participants = analysis_utils.filter_relevant(participants, consent_withdrawn_field, [rqa_analysis_config])
 
-    # Extract the regression data into a dictionary.
-    # This will contain the relevant RQA labels in matrix-format, and the relevant demog labels in categorical-format.
-    regression_data = {}
+    # Look up the matrix column of each normal RQA code once, rather than once per participant.
+    # Use "1"/"0" here rather than Codes.MATRIX_1/Codes.MATRIX_0, to match the int values these columns used to be
+    # built from.
+    rqa_matrix_columns = [
+        (code.code_id, f"{rqa_analysis_config.dataset_name}_{code.string_value}")
+        for code in normal_codes(rqa_analysis_config.code_scheme.codes)
+    ]
+
+    columns = dict()  # of column name -> list of values, where the nth value of each column is for the nth participant
+    for _, column_name in rqa_matrix_columns:
+        columns[column_name] = []
+    for demog_config in demog_analysis_configs:
+        columns[demog_config.dataset_name] = []
 
-    # Extract the relevant RQA labels in matrix-format.
-    rqa_codes = get_codes_from_td(participant, rqa_analysis_config)
-    regression_data.update(
-        _get_matrix_values(rqa_codes, rqa_analysis_config.dataset_name, rqa_analysis_config.code_scheme)
-    )
+    for participant in responded_participants:
+        # Ensure participant has not opted-out
+        assert participant[consent_withdrawn_field] == Codes.FALSE
 
-    # Extract the relevant demographic labels in categorical-format.
-    for demog_config in demog_analysis_configs:
-        demog_codes = get_codes_from_td(participant, demog_config)
-        regression_data[demog_config.dataset_name] = _get_categorical_value(demog_codes)
+        # Extract the relevant RQA labels in matrix-format.
+        rqa_code_ids = {code.code_id for code in get_codes_from_td(participant, rqa_analysis_config)}
+        for code_id, column_name in rqa_matrix_columns:
+            columns[column_name].append("1" if code_id in rqa_code_ids else "0")
 
-    return regression_data
+        # Extract the relevant demographic labels in categorical-format.
+        for demog_config in demog_analysis_configs:
+            columns[demog_config.dataset_name].append(
+                _get_categorical_value(get_codes_from_td(participant, demog_config))
+            )
+
+    return columns
 
 
 def convert_participants_to_regression_data_frame(participants, consent_withdrawn_field,
@@ -104,14 +105,9 @@ def convert_participants_to_regression_data_frame(participants, consent_withdraw
     :return: R data-frame that can be used to run regression analysis.
     :rtype: rpy2.robjects.DataFrame
     """
-    responded_participants = analysis_utils.filter_relevant(participants, consent_withdrawn_field, [rqa_analysis_config])
-
-    # Extract the data needed by the regression from the list of participants.
-    regression_dicts = []  # of dict of str -> str, where each dict contains the data for one participant.
-    for participant in responded_participants:
-        regression_dicts.append(
-            _get_participant_regression_data(participant, consent_withdrawn_field, rqa_analysis_config, demog_analysis_configs)
-        )
+    regression_columns = convert_participants_to_regression_columns(
+        participants, consent_withdrawn_field, rqa_analysis_config, demog_analysis_configs
+    )
 
     # Convert the regression data into an R data frame.
-    return convert_dicts_to_r_data_frame_of_factors(regression_dicts)
+    return convert_columns_to_r_data_frame_of_factors(regression_columns)
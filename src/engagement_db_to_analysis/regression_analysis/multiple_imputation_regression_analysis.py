@@ -1,20 +1,27 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 from core_data_modules.analysis.analysis_utils import normal_codes
 from core_data_modules.logging import Logger
-from rpy2 import robjects
-from rpy2.interactive.packages import importr
-from rpy2.robjects import r
 
 from src.engagement_db_to_analysis.regression_analysis.data_conversion import \
-    convert_participants_to_regression_data_frame
+    convert_participants_to_regression_columns
+from src.engagement_db_to_analysis.regression_analysis.r_runtime import get_r_runtime
+from src.engagement_db_to_analysis.regression_analysis.r_utils import convert_columns_to_r_data_frame_of_factors
+from src.engagement_db_to_analysis.regression_analysis.regression_results_cache import \
+    get_regression_results_cache_key
 
 
 log = Logger(__name__)
 
+ANALYSIS_NAME = "multiple_imputation_regression"
 GLM_FAMILY = 'binomial(link="logit")'
+MICE_SEED = 123
+MICE_IMPUTATIONS = 20
 
 
 def run_multiple_imputation_regression_analysis(participants, consent_withdrawn_field, rqa_analysis_config,
-                                                demog_analysis_configs):
+                                                demog_analysis_configs, cache=None, used_cache_keys=None):
     """
     Runs multiple-imputation regression analysis on one RQA configuration against multiple demographics.
 
@@ -31,6 +38,13 @@ def run_multiple_imputation_regression_analysis(participants, consent_withdrawn_
                                    TODO: The actual demographics are currently a hard-coded subset of what is provided
                                          here. Derive automatically or from configuration in future.
     :type demog_analysis_configs: list of core_data_modules.analysis.AnalysisConfiguration
+    :param cache: Cache to read regression results from and write them to, keyed on a hash of the regression data and
+                  model settings. If the results for this data and model are already cached, they are returned without
+                  running R. If None, the regression is always run and the results are not cached.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
+    :param used_cache_keys: If not None, the key the results were read from or written to in `cache` is added to
+                            this set.
+    :type used_cache_keys: set of str | None
     :return: Dictionary of theme -> regression results table, formatted as a string.
     :rtype: dict of str -> str
             TODO: Return the regression results table as an object that can be inspected and formatted rather than a str
@@ -39,56 +53,121 @@ def run_multiple_imputation_regression_analysis(participants, consent_withdrawn_
     if len(normal_codes(rqa_analysis_config.code_scheme.codes)) == 0:
         return dict()
 
-    # Initialise R
-    base = importr("base")  # R standard library
-    arm = importr("arm")  # Library for 'Data Analysis Using Regression and Multilevel/Hierarchical Models'
-    mice = importr("mice")  # Library for 'Multivariate Imputation by Chained Equations'
-    env = robjects.globalenv
-
     # TODO: Derive these variables automatically or from configuration rather than from a hard-coded string.
-    demographic_datasets = {"gender", "disability", "recently_displaced", "age_category"}
+    # Use a list rather than a set so that the order of the predictors in the model formulae, and therefore in the
+    # results, is the same in every process.
+    demographic_datasets = ["gender", "age_category", "disability", "recently_displaced"]
 
-    data_frame = convert_participants_to_regression_data_frame(
+    regression_columns = convert_participants_to_regression_columns(
         participants, consent_withdrawn_field, rqa_analysis_config,
         [config for config in demog_analysis_configs if config.dataset_name in demographic_datasets]
     )
 
+    demogs_formula = " + ".join(demographic_datasets)
+    formulae = dict()  # of theme -> model formula
+    for code in normal_codes(rqa_analysis_config.code_scheme.codes):
+        theme = f"{rqa_analysis_config.dataset_name}_{code.string_value}"
+        formulae[theme] = f"{theme} ~ {demogs_formula}"
+
+    cache_key = None
+    if cache is not None:
+        cache_key = get_regression_results_cache_key(
+            ANALYSIS_NAME, regression_columns,
+            {"formulae": formulae, "glm_family": GLM_FAMILY, "mice_seed": MICE_SEED,
+             "mice_imputations": MICE_IMPUTATIONS}
+        )
+        if used_cache_keys is not None:
+            used_cache_keys.add(cache_key)
+        cached_results = cache.get_regression_results(cache_key)
+        if cached_results is not None:
+            log.info(f"Using cached multiple imputation regression results for dataset "
+                     f"'{rqa_analysis_config.dataset_name}'")
+            return cached_results
+
+    # Get R, which is only started, and its packages loaded, the first time they are needed in this process.
+    r_runtime = get_r_runtime()
+    base = r_runtime.get_package("base")  # R standard library
+    r_runtime.get_package("arm")  # Library for 'Data Analysis Using Regression and Multilevel/Hierarchical Models'
+    mice = r_runtime.get_package("mice")  # Library for 'Multivariate Imputation by Chained Equations'
+    r = r_runtime.r
+    env = r_runtime.globalenv
+
+    data_frame = convert_columns_to_r_data_frame_of_factors(regression_columns)
+
     # Generate 20 copies of the input dataset, where each copy has had the missing data filled in with a different set
     # of plausible values.
     # Reset R's random number generator seed to ensure we get reproducible results.
     log.info(f"Running multiple imputation for dataset '{rqa_analysis_config.dataset_name}'...")
-    base.set_seed(123)
-    multiple_imputed_data_frame = mice.mice(data_frame, m=20, printFlag=False)
+    with r_runtime.time_fitting():
+        base.set_seed(MICE_SEED)
+        multiple_imputed_data_frame = mice.mice(data_frame, m=MICE_IMPUTATIONS, printFlag=False)
     env["multiple_imputed_data_frame"] = multiple_imputed_data_frame
     env["glm_family"] = r(GLM_FAMILY)
 
-    demogs_formula = " + ".join(demographic_datasets)
     results = dict()
-    for code in normal_codes(rqa_analysis_config.code_scheme.codes):
-        theme = f"{rqa_analysis_config.dataset_name}_{code.string_value}"
-        formula = f"{theme} ~ {demogs_formula}"
+    for theme, formula in formulae.items():
         log.info(f"Running multiple imputation regression for '{formula}'...")
 
-        # Run the regression analysis independently on each imputed dataset
-        env["multiple_regression_results"] = r(
-            f"with(multiple_imputed_data_frame, bayesglm({formula}, family=glm_family))"
-        )
+        with r_runtime.time_fitting():
+            # Run the regression analysis independently on each imputed dataset
+            env["multiple_regression_results"] = r(
+                f"with(multiple_imputed_data_frame, bayesglm({formula}, family=glm_family))"
+            )
 
-        # Pool the results from each independent regression, to give a final estimate of the regression
-        # coefficients and confidence intervals.
-        env["pooled_results"] = r("pool(multiple_regression_results)")
-        summarised_results = r("summary(pooled_results, conf.int=TRUE, conf.level=0.95)")
-        results[theme] = str(summarised_results)
+            # Pool the results from each independent regression, to give a final estimate of the regression
+            # coefficients and confidence intervals.
+            env["pooled_results"] = r("pool(multiple_regression_results)")
+            summarised_results = r("summary(pooled_results, conf.int=TRUE, conf.level=0.95)")
+            results[theme] = str(summarised_results)
+
+    if cache is not None:
+        cache.set_regression_results(cache_key, results)
 
     return results
 
 
-def run_all_multiple_imputation_regression_analysis(participants, consent_withdrawn_field, rqa_analysis_configs, demog_analysis_configs):
+# Data shared by every regression run in a worker process. This is set once per worker by `_init_worker`, so that the
+# participants only need to be sent to each worker once, rather than once per RQA.
+_worker_participants = None
+_worker_consent_withdrawn_field = None
+_worker_demog_analysis_configs = None
+_worker_cache = None
+
+
+def _init_worker(participants, consent_withdrawn_field, demog_analysis_configs, cache):
+    global _worker_participants, _worker_consent_withdrawn_field, _worker_demog_analysis_configs, _worker_cache
+    _worker_participants = participants
+    _worker_consent_withdrawn_field = consent_withdrawn_field
+    _worker_demog_analysis_configs = demog_analysis_configs
+    _worker_cache = cache
+
+
+def _run_multiple_imputation_regression_analysis_in_worker(rqa_analysis_config):
+    used_cache_keys = set()
+    results = run_multiple_imputation_regression_analysis(
+        _worker_participants, _worker_consent_withdrawn_field, rqa_analysis_config, _worker_demog_analysis_configs,
+        _worker_cache, used_cache_keys
+    )
+    # Each worker has its own R runtime, so log its running totals after each RQA it analyses.
+    get_r_runtime().log_timings()
+    return results, used_cache_keys
+
+
+def run_all_multiple_imputation_regression_analysis(participants, consent_withdrawn_field, rqa_analysis_configs,
+                                                    demog_analysis_configs, workers=1, cache=None):
     """
     Runs all the multiple imputation regression analysis for multiple RQA and demographic configurations.
 
     This function calls `run_multiple_imputation_regression_analysis` once for each of the given `rqa_analysis_configs`.
 
+    Each RQA is analysed independently, and resets R's random number generator seed before imputing, so when
+    `workers` > 1 the RQAs are analysed in parallel, each in a worker process with its own embedded R, and give the
+    same results as when analysed one after another. R is started and its packages are loaded once per process, and
+    reused for every RQA analysed in that process.
+
+    Multiple imputation regression results in the `cache` that weren't used by any of these RQAs are then deleted from
+    the cache.
+
     :param participants: Participants to analyse.
     :type participants: iterable of core_data_modules.traced_data.TracedData
     :param consent_withdrawn_field: Field in each participants object which records if consent is withdrawn.
@@ -100,21 +179,54 @@ def run_all_multiple_imputation_regression_analysis(participants, consent_withdr
                                    TODO: The actual demographics are currently a hard-coded subset of what is provided
                                          here. Derive automatically or from configuration in future.
     :type demog_analysis_configs: list of core_data_modules.analysis.AnalysisConfiguration
-    :return: Dictionary of dataset_name -> (dict of theme -> results table as text)
+    :param workers: Number of worker processes to analyse the RQAs in. If 1, analyses every RQA in this process.
+    :type workers: int
+    :param cache: Cache of regression results. See `run_multiple_imputation_regression_analysis`.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
+    :return: Dictionary of dataset_name -> (dict of theme -> results table as text), in the order of
+             `rqa_analysis_configs`.
     :rtype dict of str -> (dict of str -> str)
     """
     all_results = dict()  # of dataset_name -> (dict of theme -> results table as text)
-    for rqa_config in rqa_analysis_configs:
-        rqa_results = run_multiple_imputation_regression_analysis(
-            participants, consent_withdrawn_field, rqa_config, demog_analysis_configs
-        )
-        all_results[rqa_config.dataset_name] = rqa_results
+    used_cache_keys = set()
+    if workers == 1:
+        for rqa_config in rqa_analysis_configs:
+            rqa_results = run_multiple_imputation_regression_analysis(
+                participants, consent_withdrawn_field, rqa_config, demog_analysis_configs, cache, used_cache_keys
+            )
+            all_results[rqa_config.dataset_name] = rqa_results
+
+        get_r_runtime().log_timings()
+    else:
+        # Start the workers with "spawn" rather than "fork", so that each worker initialises its own embedded R instead
+        # of inheriting a copy of this process's R session.
+        log.info(f"Running multiple imputation regression analysis for {len(rqa_analysis_configs)} RQAs in {workers} "
+                 f"worker processes...")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker,
+                                 initargs=(participants, consent_withdrawn_field, demog_analysis_configs,
+                                           cache)) as executor:
+            rqa_futures = [
+                (rqa_config, executor.submit(_run_multiple_imputation_regression_analysis_in_worker, rqa_config))
+                for rqa_config in rqa_analysis_configs
+            ]
+
+            # Collect the results in the order of `rqa_analysis_configs`, so the results are exported in the same
+            # order regardless of which RQA finishes first.
+            for rqa_config, future in rqa_futures:
+                rqa_results, rqa_cache_keys = future.result()
+                all_results[rqa_config.dataset_name] = rqa_results
+                used_cache_keys.update(rqa_cache_keys)
+
+    if cache is not None:
+        deleted = cache.delete_regression_results_except(ANALYSIS_NAME, used_cache_keys)
+        log.info(f"Deleted {deleted} multiple imputation regression results that weren't used from the cache")
 
     return all_results
 
 
 def export_all_multiple_imputation_regression_analysis_txt(participants, consent_withdrawn_field, rqa_analysis_configs,
-                                                           demog_analysis_configs, f):
+                                                           demog_analysis_configs, f, workers=1, cache=None):
     """
     Computes all the multiple imputation regression analysis and exports the results to a text file.
 
@@ -131,9 +243,14 @@ def export_all_multiple_imputation_regression_analysis_txt(participants, consent
     :type demog_analysis_configs: list of core_data_modules.analysis.AnalysisConfiguration
     :param f: Text file to write the regression results to.
     :type f: file-like
+    :param workers: Number of worker processes to analyse the RQAs in. See
+                    `run_all_multiple_imputation_regression_analysis`.
+    :type workers: int
+    :param cache: Cache of regression results. See `run_multiple_imputation_regression_analysis`.
+    :type cache: src.engagement_db_to_analysis.cache.AnalysisCache | None
     """
     regression_results = run_all_multiple_imputation_regression_analysis(
-        participants, consent_withdrawn_field, rqa_analysis_configs, demog_analysis_configs
+        participants, consent_withdrawn_field, rqa_analysis_configs, demog_analysis_configs, workers, cache
     )
 
     for results in regression_results.values():
@@ -0,0 +1,104 @@
+import time
+from contextlib import contextmanager
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class RRuntime:
+    def __init__(self):
+        """
+        Embedded R session shared by all the regression analysis run in this process.
+
+        R is started, and each R package is loaded, the first time they are needed, then reused for every subsequent
+        theme and RQA. The time spent starting R and loading packages, and the time spent fitting models, are recorded
+        separately so the two costs can be compared.
+
+        Use `get_r_runtime` to get the runtime for this process, rather than constructing a new one.
+        """
+        self._robjects = None
+        self._packages = dict()  # of R package name -> loaded package
+        self.startup_seconds = 0.0  # Total time spent starting R and loading packages.
+        self.fitting_seconds = 0.0  # Total time spent in `time_fitting` blocks.
+
+    def _get_robjects(self):
+        if self._robjects is None:
+            start = time.perf_counter()
+            # Import rpy2 here rather than at the top of the module, because importing rpy2.robjects starts an
+            # embedded R.
+            from rpy2 import robjects
+            self._robjects = robjects
+            duration = time.perf_counter() - start
+            self.startup_seconds += duration
+            log.info(f"Started R in {duration:.2f}s")
+        return self._robjects
+
+    @property
+    def r(self):
+        """
+        :return: R evaluator, for evaluating R code from a string.
+        :rtype: rpy2.robjects.R
+        """
+        return self._get_robjects().r
+
+    @property
+    def globalenv(self):
+        """
+        :return: R global environment.
+        :rtype: rpy2.robjects.Environment
+        """
+        return self._get_robjects().globalenv
+
+    def get_package(self, package_name):
+        """
+        Gets an R package, loading it if this is the first time it has been requested in this process.
+
+        :param package_name: Name of the R package to get e.g. "base", "arm".
+        :type package_name: str
+        :return: Loaded R package.
+        :rtype: rpy2.robjects.packages.Package
+        """
+        if package_name not in self._packages:
+            self._get_robjects()
+            start = time.perf_counter()
+            from rpy2.interactive.packages import importr
+            self._packages[package_name] = importr(package_name)
+            duration = time.perf_counter() - start
+            self.startup_seconds += duration
+            log.info(f"Loaded R package '{package_name}' in {duration:.2f}s")
+        return self._packages[package_name]
+
+    @contextmanager
+    def time_fitting(self):
+        """
+        Context manager that adds the time spent in its block to `fitting_seconds`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.fitting_seconds += time.perf_counter() - start
+
+    def log_timings(self):
+        """
+        Logs the total time this runtime has spent starting R and loading packages, compared with fitting models.
+        """
+        log.info(f"R startup and package loading took {self.startup_seconds:.2f}s in total; "
+                 f"model fitting took {self.fitting_seconds:.2f}s in total")
+
+
+_r_runtime = None
+
+
+def get_r_runtime():
+    """
+    Gets the R runtime for this process, creating it if this is the first time it has been requested.
+
+    :return: R runtime for this process.
+    :rtype: RRuntime
+    """
+    global _r_runtime
+    if _r_runtime is None:
+        _r_runtime = RRuntime()
+    return _r_runtime
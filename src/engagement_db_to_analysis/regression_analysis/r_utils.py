@@ -1,8 +1,6 @@
 # TODO: Move to CoreDataModules once stable
 from collections import defaultdict
 
-from rpy2.robjects import DataFrame, FactorVector
-
 
 def convert_dicts_to_r_data_frame_of_factors(dicts):
     """
@@ -14,6 +12,9 @@ def convert_dicts_to_r_data_frame_of_factors(dicts):
     :param dicts: Dictionaries to convert. Every dictionary must contain the same keys.
     :type dicts: dict of str -> (str | int | None)
     """
+    # Import rpy2 here rather than at the top of the module, because importing rpy2.robjects starts an embedded R.
+    from rpy2.robjects import DataFrame
+
     if len(dicts) == 0:
         return DataFrame({})
 
@@ -22,20 +23,50 @@ def convert_dicts_to_r_data_frame_of_factors(dicts):
     for d in dicts:
         assert set(d.keys()) == keys, f"{set(d.keys())}, {keys}"
 
-    # R data-frames are constructed from a dict of (column_name) -> (values_vector), where
-    # the nth row of the created data_frame contains the values at the nth position of each values_vector.
-    # Therefore:
-
-    # 1. Convert the input dicts to a dict of (column_name -> list of values)
+    # Convert the input dicts to a dict of (column_name -> list of values), then convert those columns.
     lists = defaultdict(list)
     for d in dicts:
         for (k, v) in d.items():
             lists[k].append(None if v is None else str(v))
 
-    # 2. Convert each list of values to an R vector
-    vectors = dict()
-    for (dataset_name, values) in lists.items():
-        vectors[dataset_name] = FactorVector(values)
+    return convert_columns_to_r_data_frame_of_factors(lists)
+
+
+def convert_columns_to_r_data_frame_of_factors(columns):
+    """
+    Converts a dictionary of columns to an R data-frame.
+
+    Each column in the returned data-frame contains a "FactorVector", which is the datatype used to represent
+    categorical data in R. Each column is built as a pandas Categorical and the columns are converted to R together,
+    using rpy2's pandas converter, so this is much faster than `convert_dicts_to_r_data_frame_of_factors` for data
+    that can be built column-wise.
+
+    :param columns: Dictionary of column name -> values, where the nth row of the created data-frame contains the
+                    values at the nth position of each column. Every column must contain the same number of values.
+                    If every column is empty, returns an empty data-frame.
+    :type columns: dict of str -> (list of (str | None))
+    :return: R data-frame with one factor column for each of the given columns, in the same order.
+    :rtype: rpy2.robjects.DataFrame
+    """
+    # Import rpy2 here rather than at the top of the module, because importing rpy2.robjects starts an embedded R.
+    import pandas
+    from rpy2 import robjects
+    from rpy2.robjects import DataFrame, StrVector, pandas2ri
+    from rpy2.robjects.conversion import localconverter
+
+    column_lengths = {len(values) for values in columns.values()}
+    assert len(column_lengths) <= 1, f"Columns have different lengths {column_lengths}"
+
+    if len(columns) == 0 or column_lengths == {0}:
+        return DataFrame({})
+
+    r_sort = robjects.r["sort"]
+    categoricals = dict()  # of column name -> pandas.Categorical
+    for (column_name, values) in columns.items():
+        # Order each factor's levels in the same way as R's `factor`, by sorting the distinct values in R, so that
+        # the reference levels of the regressions are the same as when the factors are built in R.
+        levels = list(r_sort(StrVector(list({value for value in values if value is not None}))))
+        categoricals[column_name] = pandas.Categorical(values, categories=levels)
 
-    # 3. Convert the R vectors to an R data frame
-    return DataFrame(vectors)
+    with localconverter(robjects.default_converter + pandas2ri.converter):
+        return robjects.conversion.py2rpy(pandas.DataFrame(categoricals))
@@ -0,0 +1,29 @@
+import hashlib
+import json
+
+
+def get_regression_results_cache_key(analysis_name, regression_columns, model_settings):
+    """
+    Gets the key to cache a regression analysis' results under.
+
+    The key is a hash of everything that determines the results: the analysis that was run, the data that was analysed,
+    and the model and its settings. If any of these change, the key changes, so cached results never need to be
+    invalidated when the data changes.
+
+    :param analysis_name: Name of the regression analysis e.g. "complete_case_regression".
+    :type analysis_name: str
+    :param regression_columns: Data to run the regression on, in column-format.
+                               See `data_conversion.convert_participants_to_regression_columns`.
+    :type regression_columns: dict of str -> (list of (str | None))
+    :param model_settings: JSON-serializable settings of the model e.g. the formulae, family, and imputation settings.
+    :type model_settings: dict
+    :return: Cache key.
+    :rtype: str
+    """
+    key_data = {
+        "analysis_name": analysis_name,
+        "data": regression_columns,
+        "model_settings": model_settings
+    }
+    key_json = json.dumps(key_data, sort_keys=True, separators=(",", ":"))
+    return f"{analysis_name}_{hashlib.sha256(key_json.encode('utf-8')).hexdigest()}"
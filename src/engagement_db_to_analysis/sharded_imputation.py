@@ -0,0 +1,253 @@
+import io
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from core_data_modules.logging import Logger
+from core_data_modules.traced_data.io import TracedDataJsonIO
+
+from src.engagement_db_to_analysis.analysis_config_index import AnalysisConfigIndex
+from src.engagement_db_to_analysis.code_imputation_functions import (impute_codes_by_message,
+                                                                     impute_codes_by_column_traced_data)
+from src.engagement_db_to_analysis.column_view_conversion import convert_to_column_views
+from src.engagement_db_to_analysis.configuration import AnalysisConfiguration, DatasetTypes
+from src.engagement_db_to_analysis.message_view_cache import MessageViewCache
+
+log = Logger(__name__)
+
+
+def _impute_and_convert_to_column_views(user, messages_traced_data, analysis_config, full_provenance, config_index):
+    """
+    Imputes codes for the given messages, converts them to the messages and participants column-views, then imputes
+    codes for both column-views.
+
+    :param user: Identifier of user running the pipeline.
+    :type user: str
+    :param messages_traced_data: Messages traced data to process. The TracedData are updated in-place.
+    :type messages_traced_data: list of core_data_modules.traced_data.TracedData
+    :param analysis_config: Analysis configuration.
+    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :param config_index: Index of `analysis_config.dataset_configurations`.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex
+    :return: Tuple of (messages traced data, messages by column, participants by column).
+    :rtype: (list of core_data_modules.traced_data.TracedData,
+             list of core_data_modules.traced_data.TracedData,
+             list of core_data_modules.traced_data.TracedData)
+    """
+    # Share the typed views of the messages between the message-level stages, so each message is only deserialized
+    # again after its labels have been updated.
+    message_views = MessageViewCache()
+
+    impute_codes_by_message(
+        user, messages_traced_data, analysis_config.dataset_configurations,
+        analysis_config.ws_correct_dataset_code_scheme, message_views, full_provenance, config_index
+    )
+
+    messages_by_column, participants_by_column = convert_to_column_views(
+        user, messages_traced_data, analysis_config, message_views, full_provenance, config_index
+    )
+
+    log.info(f"Imputing messages column-view traced data...")
+    impute_codes_by_column_traced_data(
+        user, messages_by_column, analysis_config.dataset_configurations, full_provenance, config_index
+    )
+
+    log.info(f"Imputing participants column-view traced data...")
+    impute_codes_by_column_traced_data(
+        user, participants_by_column, analysis_config.dataset_configurations, full_provenance, config_index
+    )
+
+    return messages_traced_data, messages_by_column, participants_by_column
+
+
+def _serialize_traced_data(traced_data):
+    """
+    :param traced_data: TracedData to serialize.
+    :type traced_data: iterable of core_data_modules.traced_data.TracedData
+    :return: `traced_data` serialized to JSONL.
+    :rtype: str
+    """
+    f = io.StringIO()
+    TracedDataJsonIO.export_traced_data_iterable_to_jsonl(traced_data, f)
+    return f.getvalue()
+
+
+def _deserialize_traced_data(traced_data_jsonl):
+    """
+    :param traced_data_jsonl: TracedData serialized by `_serialize_traced_data`.
+    :type traced_data_jsonl: str
+    :return: Deserialized TracedData.
+    :rtype: list of core_data_modules.traced_data.TracedData
+    """
+    return list(TracedDataJsonIO.import_jsonl_to_traced_data_iterable(io.StringIO(traced_data_jsonl)))
+
+
+def _impute_and_convert_shard_to_column_views(user, messages_jsonl, dataset_configurations,
+                                              ws_correct_dataset_code_scheme, full_provenance):
+    """
+    Runs `_impute_and_convert_to_column_views` on one shard of messages, in a worker process.
+
+    The TracedData are sent to and from the worker as JSONL rather than pickled, because pickling a TracedData recurses
+    through its whole history, which fails for participants with long histories. Only the parts of the analysis
+    configuration the imputations and conversions use are sent, because the rest (e.g. map region filters) may not be
+    picklable. The configuration index is rebuilt here, because it is keyed on the identity of the configurations.
+
+    :param user: Identifier of user running the pipeline.
+    :type user: str
+    :param messages_jsonl: Messages traced data to process, serialized by `_serialize_traced_data`.
+    :type messages_jsonl: str
+    :param dataset_configurations: Analysis dataset configurations.
+    :type dataset_configurations: list of src.engagement_db_to_analysis.configuration.AnalysisDatasetConfiguration
+    :param ws_correct_dataset_code_scheme: WS - Correct Dataset code scheme.
+    :type ws_correct_dataset_code_scheme: core_data_modules.data_models.CodeScheme
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :return: Tuple of (messages traced data, messages by column, participants by column), each serialized by
+             `_serialize_traced_data`.
+    :rtype: (str, str, str)
+    """
+    analysis_config = AnalysisConfiguration(dataset_configurations, ws_correct_dataset_code_scheme)
+    results = _impute_and_convert_to_column_views(
+        user, _deserialize_traced_data(messages_jsonl), analysis_config, full_provenance,
+        AnalysisConfigIndex(dataset_configurations)
+    )
+    return tuple(_serialize_traced_data(traced_data) for traced_data in results)
+
+
+def _shard_for_participant_uuid(participant_uuid, shards):
+    """
+    :param participant_uuid: Participant uuid to get the shard of.
+    :type participant_uuid: str
+    :param shards: Total number of shards.
+    :type shards: int
+    :return: Index of the shard that `participant_uuid` belongs to. This is stable across processes and runs.
+    :rtype: int
+    """
+    return zlib.crc32(participant_uuid.encode("utf-8")) % shards
+
+
+def _merge_column_views(shard_column_views, participant_ranks):
+    """
+    Merges column-view TracedData from each shard into the order the serial conversion would have produced.
+
+    Each shard's column-view is ordered by participant, in the order the participants' messages appear in that shard.
+    The serial conversion orders participants in the same way across all the messages, so merging is a stable sort of
+    each participant's block of TracedData by the participant's rank.
+
+    :param shard_column_views: Column-view TracedData produced by each shard.
+    :type shard_column_views: list of (list of core_data_modules.traced_data.TracedData)
+    :param participant_ranks: Dictionary of participant_uuid -> rank of that participant in the serial conversion.
+    :type participant_ranks: dict of str -> int
+    :return: Merged column-view TracedData.
+    :rtype: list of core_data_modules.traced_data.TracedData
+    """
+    participant_blocks = dict()  # of participant_uuid -> list of column-view TracedData
+    for column_view in shard_column_views:
+        for td in column_view:
+            participant_uuid = td["participant_uuid"]
+            if participant_uuid not in participant_blocks:
+                participant_blocks[participant_uuid] = []
+            participant_blocks[participant_uuid].append(td)
+
+    merged = []
+    for participant_uuid in sorted(participant_blocks, key=lambda uuid: participant_ranks[uuid]):
+        merged.extend(participant_blocks[participant_uuid])
+    return merged
+
+
+def impute_and_convert_to_column_views(user, messages_traced_data, analysis_config, workers=1, full_provenance=False,
+                                       config_index=None):
+    """
+    Imputes codes for the given messages, converts them to the messages and participants column-views, and imputes
+    codes for both column-views.
+
+    Every stage of this process depends only on the messages of one participant at a time, so when `workers` > 1 the
+    messages are sharded by a hash of their participant_uuid and each shard is processed in a separate worker process.
+    The shards' results are merged so that they are in the same order as when processing with a single worker.
+
+    With a single worker, the given `messages_traced_data` are updated in-place. With multiple workers, the processed
+    messages are copies, so use the returned messages instead.
+
+    :param user: Identifier of user running the pipeline.
+    :type user: str
+    :param messages_traced_data: Messages traced data to process.
+    :type messages_traced_data: list of core_data_modules.traced_data.TracedData
+    :param analysis_config: Analysis configuration.
+    :type analysis_config: src.engagement_db_to_analysis.configuration.AnalysisConfiguration
+    :param workers: Number of worker processes to shard the processing across. If 1, processes all the messages in
+                    this process.
+    :type workers: int
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
+    :param config_index: Index of `analysis_config.dataset_configurations`. If None, a new index is built.
+    :type config_index: src.engagement_db_to_analysis.analysis_config_index.AnalysisConfigIndex | None
+    :return: Tuple of (messages traced data, messages by column, participants by column).
+    :rtype: (list of core_data_modules.traced_data.TracedData,
+             list of core_data_modules.traced_data.TracedData,
+             list of core_data_modules.traced_data.TracedData)
+    """
+    assert workers >= 1, f"workers must be at least 1, but was {workers}"
+    if config_index is None:
+        config_index = AnalysisConfigIndex(analysis_config.dataset_configurations)
+
+    if workers == 1:
+        return _impute_and_convert_to_column_views(
+            user, messages_traced_data, analysis_config, full_provenance, config_index
+        )
+
+    # Shard the messages by participant, keeping the messages in each shard in their original relative order.
+    # Record the rank of each participant in the serial column-view conversions, so the shards' column-views can be
+    # merged back into that order:
+    #  - messages are converted by message in order of each participant's first rqa message.
+    #  - messages are converted by participant in order of each participant's first message.
+    rqa_engagement_db_datasets = set()
+    for dataset_config in analysis_config.dataset_configurations:
+        if dataset_config.dataset_type == DatasetTypes.RESEARCH_QUESTION_ANSWER:
+            rqa_engagement_db_datasets.update(dataset_config.engagement_db_datasets)
+
+    shards = [[] for _ in range(workers)]
+    shard_message_indices = [[] for _ in range(workers)]
+    participant_ranks = dict()  # of participant_uuid -> rank by first message
+    rqa_participant_ranks = dict()  # of participant_uuid -> rank by first rqa message
+    for i, msg_td in enumerate(messages_traced_data):
+        participant_uuid = msg_td["participant_uuid"]
+        if participant_uuid not in participant_ranks:
+            participant_ranks[participant_uuid] = len(participant_ranks)
+        if msg_td["dataset"] in rqa_engagement_db_datasets and participant_uuid not in rqa_participant_ranks:
+            rqa_participant_ranks[participant_uuid] = len(rqa_participant_ranks)
+
+        shard = _shard_for_participant_uuid(participant_uuid, workers)
+        shards[shard].append(msg_td)
+        shard_message_indices[shard].append(i)
+
+    log.info(f"Processing {len(messages_traced_data)} messages from {len(participant_ranks)} participants in "
+             f"{workers} shards, of sizes {[len(shard) for shard in shards]}...")
+    # Start the workers with "spawn" rather than "fork", so that they don't inherit this process's database clients
+    # and their threads.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        shard_futures = [
+            executor.submit(
+                _impute_and_convert_shard_to_column_views, user, _serialize_traced_data(shard),
+                analysis_config.dataset_configurations, analysis_config.ws_correct_dataset_code_scheme, full_provenance
+            )
+            for shard in shards
+        ]
+        shard_results = [
+            tuple(_deserialize_traced_data(traced_data_jsonl) for traced_data_jsonl in future.result())
+            for future in shard_futures
+        ]
+
+    # Merge the shards' results, restoring the order of the serial processing.
+    merged_messages = [None] * len(messages_traced_data)
+    for message_indices, (shard_messages, _, _) in zip(shard_message_indices, shard_results):
+        for i, msg_td in zip(message_indices, shard_messages):
+            merged_messages[i] = msg_td
+
+    messages_by_column = _merge_column_views([result[1] for result in shard_results], rqa_participant_ranks)
+    participants_by_column = _merge_column_views([result[2] for result in shard_results], participant_ranks)
+    log.info(f"Merged the results of {workers} shards into {len(messages_by_column)} column-view objects by message "
+             f"and {len(participants_by_column)} column-view objects by participant")
+
+    return merged_messages, messages_by_column, participants_by_column
@@ -2,16 +2,15 @@ from dateutil.parser import isoparse
 import time
 
 from core_data_modules.logging import Logger
-from core_data_modules.traced_data import Metadata
-from core_data_modules.util import TimeUtils
 
+from src.engagement_db_to_analysis.provenance import StepProvenance
 from src.pipeline_configuration_spec import *
 
 
 log = Logger(__name__)
 
 
-def rqa_time_range_filter(user, messages_traced_data, pipeline_config):
+def rqa_time_range_filter(user, messages_traced_data, pipeline_config, full_provenance=False):
     """
     Filters a list of td for research question messages received within the given time range.
 
@@ -19,6 +18,8 @@ def rqa_time_range_filter(user, messages_traced_data, pipeline_config):
     :type messages_traced_data: list of TracedData
     :pipeline_config: pipeline configuration module
     :type PIPELINE_CONFIGURATION:
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
     :return: Filtered list.
     :rtype: list of TracedData
     """
@@ -48,6 +49,7 @@ def rqa_time_range_filter(user, messages_traced_data, pipeline_config):
             for engagement_db_dataset in analysis_dataset_config.engagement_db_datasets:
                 rqa_engagement_db_datasets.append(engagement_db_dataset)
 
+    provenance = StepProvenance(user, full_provenance)
     filtered = []
     for td in messages_traced_data:
         if td["dataset"] in rqa_engagement_db_datasets:
@@ -55,7 +57,7 @@ def rqa_time_range_filter(user, messages_traced_data, pipeline_config):
                 continue
             if end_time_inclusive is not None and isoparse(td["timestamp"]) > end_time_inclusive:
                 continue
-            td.append_data({}, Metadata(user, Metadata.get_call_location(), TimeUtils.utc_now_as_iso_string()))
+            td.append_data({}, provenance.metadata())
             filtered.append(td)
         else:
             filtered.append(td)
@@ -65,7 +67,7 @@ def rqa_time_range_filter(user, messages_traced_data, pipeline_config):
     return filtered
 
 
-def filter_test_messages(user, messages_traced_data, test_participant_uuids):
+def filter_test_messages(user, messages_traced_data, test_participant_uuids, full_provenance=False):
     """
     Filters out test messages sent by pipeline_config.test_participant_uuids i.e AVF/Aggregator staff
 
@@ -73,10 +75,13 @@ def filter_test_messages(user, messages_traced_data, test_participant_uuids):
     :type messages_traced_data: list of TracedData
     :param test_participant_uuids: a list containing test participant uids.
     :type test_participant_uuids: list of str
+    :param full_provenance: See `src.engagement_db_to_analysis.provenance.StepProvenance`.
+    :type full_provenance: bool
     :return: Filtered dict.
     :rtype: dict of participant_uid -> TracedData
     """
     log.debug("Filtering test messages data...")
+    provenance = StepProvenance(user, full_provenance)
     filtered = []
 
     filtered_participants_uuids = set()
@@ -87,8 +92,7 @@ def filter_test_messages(user, messages_traced_data, test_participant_uuids):
 
         # Updates the td object with new Metadata for this filter function.
         # The allows us to hold history of the td update for easy traceback.
-        td.append_data({}, Metadata(user, Metadata.get_call_location(),
-                                                    TimeUtils.utc_now_as_iso_string()))
+        td.append_data({}, provenance.metadata())
         filtered.append(td)
 
     log.info(f"Filtered out {len(filtered_participants_uuids)}/{len(test_participant_uuids)} test participants messages...")
@@ -97,13 +101,15 @@ def filter_test_messages(user, messages_traced_data, test_participant_uuids):
     return filtered
 
 
-def filter_messages(user, messages_traced_data, pipeline_config):
+def filter_messages(user, messages_traced_data, pipeline_config, full_provenance=False):
 
     # Filter out runs sent outwith the project start and end dates
-    messages_traced_data = rqa_time_range_filter(user, messages_traced_data, pipeline_config)
+    messages_traced_data = rqa_time_range_filter(user, messages_traced_data, pipeline_config, full_provenance)
 
     if pipeline_config.test_participant_uuids is not None:
-        messages_traced_data = filter_test_messages(user, messages_traced_data, pipeline_config.test_participant_uuids)
+        messages_traced_data = filter_test_messages(
+            user, messages_traced_data, pipeline_config.test_participant_uuids, full_provenance
+        )
     else:
         log.debug(
             "Not filtering out test participants messages (because the pipeline_config.filter_test_participants was set to `False`)")
@@ -0,0 +1,107 @@
+import json
+import os
+
+from core_data_modules.util import IOUtils
+
+from src.common.cache import Cache
+from src.engagement_db_to_rapid_pro.code_scheme_index import CodeSchemeIndex
+
+
+class EngagementDBToRapidProCache(Cache):
+    def _contact_fields_hashes_path(self):
+        return f"{self.cache_dir}/contact_fields_hashes.jsonl"
+
+    def get_contact_fields_hashes(self):
+        """
+        Gets the hashes of the contact fields that were last written to Rapid Pro for each participant.
+
+        :return: Dictionary of participant_uuid -> hash of the contact fields last written to Rapid Pro for that
+                 participant.
+        :rtype: dict of str -> str
+        """
+        contact_fields_hashes = dict()
+        try:
+            with open(self._contact_fields_hashes_path()) as f:
+                # The file is an append-only journal, so later entries supersede earlier ones.
+                for line in f:
+                    entry = json.loads(line)
+                    contact_fields_hashes[entry["participant_uuid"]] = entry["contact_fields_hash"]
+        except FileNotFoundError:
+            pass
+
+        return contact_fields_hashes
+
+    def set_contact_fields_hashes(self, contact_fields_hashes):
+        """
+        Replaces all the cached contact fields hashes with the given hashes.
+
+        Use this to compact the journal written by `add_contact_fields_hashes`.
+
+        :param contact_fields_hashes: Dictionary of participant_uuid -> hash of the contact fields last written to
+                                      Rapid Pro for that participant.
+        :type contact_fields_hashes: dict of str -> str
+        """
+        export_path = self._contact_fields_hashes_path()
+        temp_path = f"{self.cache_dir}/.contact_fields_hashes_temp.jsonl"
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        with open(temp_path, "w") as f:
+            for participant_uuid, contact_fields_hash in contact_fields_hashes.items():
+                f.write(json.dumps({"participant_uuid": participant_uuid, "contact_fields_hash": contact_fields_hash}))
+                f.write("\n")
+        os.replace(temp_path, export_path)
+
+    def add_contact_fields_hashes(self, contact_fields_hashes):
+        """
+        Appends the given contact fields hashes to the cache, superseding any existing hashes for the same
+        participants.
+
+        :param contact_fields_hashes: Dictionary of participant_uuid -> hash of the contact fields just written to
+                                      Rapid Pro for that participant.
+        :type contact_fields_hashes: dict of str -> str
+        """
+        export_path = self._contact_fields_hashes_path()
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        with open(export_path, "a") as f:
+            for participant_uuid, contact_fields_hash in contact_fields_hashes.items():
+                f.write(json.dumps({"participant_uuid": participant_uuid, "contact_fields_hash": contact_fields_hash}))
+                f.write("\n")
+
+    def get_code_scheme_index(self, source_file_mtimes):
+        """
+        Gets the cached code scheme index, if it was compiled from the given source files.
+
+        :param source_file_mtimes: Dictionary of code scheme file path -> modification time, for each of the files the
+                                   index should have been compiled from.
+        :type source_file_mtimes: dict of str -> float
+        :return: Cached code scheme index, or None if there is no cached index or it was compiled from different files.
+        :rtype: src.engagement_db_to_rapid_pro.code_scheme_index.CodeSchemeIndex | None
+        """
+        try:
+            with open(f"{self.cache_dir}/code_scheme_index.json") as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        # Indexes cached by earlier versions of this cache contain the full code schemes rather than the compiled codes,
+        # so treat those as a cache miss too.
+        if cached["source_file_mtimes"] != source_file_mtimes or "codes" not in cached["index"]:
+            return None
+
+        return CodeSchemeIndex.from_dict(cached["index"])
+
+    def set_code_scheme_index(self, source_file_mtimes, index):
+        """
+        Sets the cached code scheme index.
+
+        :param source_file_mtimes: Dictionary of code scheme file path -> modification time, for each of the files the
+                                   index was compiled from.
+        :type source_file_mtimes: dict of str -> float
+        :param index: Code scheme index to cache.
+        :type index: src.engagement_db_to_rapid_pro.code_scheme_index.CodeSchemeIndex
+        """
+        export_path = f"{self.cache_dir}/code_scheme_index.json"
+        temp_path = f"{self.cache_dir}/.code_scheme_index_temp.json"
+        IOUtils.ensure_dirs_exist_for_file(export_path)
+        with open(temp_path, "w") as f:
+            json.dump({"source_file_mtimes": source_file_mtimes, "index": index.to_dict()}, f)
+        os.replace(temp_path, export_path)
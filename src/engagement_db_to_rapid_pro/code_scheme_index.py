@@ -0,0 +1,245 @@
+import glob
+import json
+from collections import defaultdict
+from os import path
+
+from core_data_modules.data_models import CodeScheme
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+def _merge_code_schemes(code_schemes):
+    """
+    Merges the given `code_schemes` into a single code scheme containing all the codes from the input `code_schemes`.
+
+    Fails if `len(code_schemes) == 0` or if any of the `code_schemes` have differing `scheme_id`s.
+
+    :param code_schemes: Code schemes to merge into one.
+    :type code_schemes: list of core_data_modules.data_models.CodeScheme
+    :return: `code_schemes` merged into a single code scheme containing all the codes.
+    :rtype: core_data_modules.data_models.CodeScheme
+    """
+    assert len(code_schemes) > 0, len(code_schemes)
+
+    merged_code_scheme = code_schemes[0]
+    merged_codes = {c.code_id: c for c in merged_code_scheme.codes}  # of code id -> Code
+    for code_scheme in code_schemes[1:]:
+        assert code_scheme.scheme_id == merged_code_scheme.scheme_id
+        # For each code in this code scheme, add it to the merged code scheme if it doesn't exist on that scheme yet.
+        # If it does exist, ensure the code is the same as the one that exists already.
+        for code in code_scheme.codes:
+            if code.code_id in merged_codes:
+                assert code == merged_codes[code.code_id]
+                continue
+
+            merged_code_scheme.codes.append(code)
+            merged_codes[code.code_id] = code
+
+    return merged_code_scheme
+
+
+def _merge_code_schemes_by_scheme_id(code_schemes):
+    """
+    Merges the given `code_schemes` such that those that share the same scheme_id are combined into one code scheme
+    that contains all the codes from the merged code schemes. Code schemes which have unique scheme_ids will be
+    included in the results unmodified.
+
+    :param code_schemes: Code schemes to merge by scheme_id.
+    :type code_schemes: list of core_data_modules.data_models.CodeScheme
+    :return: `code_schemes` merged by scheme_ids.
+    :rtype code_schemes: list of core_data_modules.data_models.CodeScheme
+    """
+    code_schemes_by_id = defaultdict(list)
+    for code_scheme in code_schemes:
+        code_schemes_by_id[code_scheme.scheme_id].append(code_scheme)
+
+    merged_code_schemes = []
+    for code_schemes in code_schemes_by_id.values():
+        merged_code_schemes.append(_merge_code_schemes(code_schemes))
+    return merged_code_schemes
+
+
+class IndexedCode:
+    def __init__(self, code_id, code_type, control_code, string_value):
+        """
+        The fields of a code that are needed to decode labels, compiled from a
+        `core_data_modules.data_models.Code`.
+
+        :param code_id: Id of the code.
+        :type code_id: str
+        :param code_type: Type of the code e.g. "Normal", "Control".
+        :type code_type: str
+        :param control_code: Control code of the code e.g. "STOP", or None if this isn't a control code.
+        :type control_code: str | None
+        :param string_value: String value of the code.
+        :type string_value: str
+        """
+        self.code_id = code_id
+        self.code_type = code_type
+        self.control_code = control_code
+        self.string_value = string_value
+
+    @classmethod
+    def from_code(cls, code):
+        return cls(code.code_id, code.code_type, code.control_code, code.string_value)
+
+    def to_dict(self):
+        return {
+            "code_id": self.code_id,
+            "code_type": self.code_type,
+            "control_code": self.control_code,
+            "string_value": self.string_value
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["code_id"], d["code_type"], d["control_code"], d["string_value"])
+
+
+class CodeSchemeIndex:
+    def __init__(self, codes):
+        """
+        Compiled index of code schemes, for constant-time look-ups of the codes that labels refer to.
+
+        The index only contains the fields of each code needed to decode labels, so it can be cached and loaded again
+        without parsing the code schemes. Use `from_code_scheme_files` to compile an index.
+
+        :param codes: Dictionary of scheme id -> (dictionary of code id -> code), for each code scheme to index.
+                      Labels are matched to the first scheme id they start with, in dictionary order.
+        :type codes: dict of str -> (dict of str -> IndexedCode)
+        """
+        self.scheme_ids = list(codes.keys())
+        self._codes = codes
+
+        # Cache of label scheme id -> scheme id of the code scheme the label is for. This is filled on demand because
+        # label scheme ids may have duplicate-scheme suffixes e.g. '-2'.
+        self._label_scheme_id_to_scheme_id = dict()
+
+    @classmethod
+    def from_code_schemes(cls, code_schemes):
+        """
+        Compiles a CodeSchemeIndex from the given code schemes.
+
+        :param code_schemes: Code schemes to index. These must all have unique scheme ids.
+        :type code_schemes: list of core_data_modules.data_models.CodeScheme
+        :rtype: CodeSchemeIndex
+        """
+        codes = dict()  # of scheme id -> (dict of code id -> IndexedCode)
+        for code_scheme in code_schemes:
+            assert code_scheme.scheme_id not in codes, f"Duplicate scheme id {code_scheme.scheme_id}"
+            codes[code_scheme.scheme_id] = {code.code_id: IndexedCode.from_code(code) for code in code_scheme.codes}
+        return cls(codes)
+
+    @classmethod
+    def from_code_scheme_files(cls, code_scheme_file_paths):
+        """
+        Compiles a CodeSchemeIndex from the given code scheme files.
+
+        Some RQAs from projects that were run before this Engagement-Data-Pipeline infrastructure was created
+        accidentally used the same scheme_id for different code_schemes between projects. Since the index is only
+        used to decode labels, handle this by merging impacted code_schemes into one for now.
+        TODO: Edit the problematic code schemes in affected projects to give them all unique scheme ids, then
+              remove this workaround.
+
+        :param code_scheme_file_paths: Paths to the code scheme json files to index.
+        :type code_scheme_file_paths: list of str
+        :rtype: CodeSchemeIndex
+        """
+        code_schemes = []
+        for file_path in code_scheme_file_paths:
+            with open(file_path) as f:
+                code_schemes.append(CodeScheme.from_firebase_map(json.load(f)))
+
+        return cls.from_code_schemes(_merge_code_schemes_by_scheme_id(code_schemes))
+
+    def to_dict(self):
+        return {
+            "codes": [
+                {"scheme_id": scheme_id, "codes": [code.to_dict() for code in codes.values()]}
+                for scheme_id, codes in self._codes.items()
+            ]
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls({
+            scheme["scheme_id"]: {code["code_id"]: IndexedCode.from_dict(code) for code in scheme["codes"]}
+            for scheme in d["codes"]
+        })
+
+    def get_scheme_id_for_label(self, label):
+        """
+        Gets the scheme id of the code scheme that the given label is for.
+
+        Handles duplicated scheme ids (i.e. schemes ending in '-1', '-2' etc.).
+
+        :param label: Label to get the code scheme of.
+        :type label: core_data_modules.data_models.Label
+        :return: Scheme id of the code scheme for this label, or None if the label isn't for any of the indexed code
+                 schemes.
+        :rtype: str | None
+        """
+        if label.scheme_id not in self._label_scheme_id_to_scheme_id:
+            matching_scheme_id = None
+            for scheme_id in self.scheme_ids:
+                if label.scheme_id.startswith(scheme_id):
+                    matching_scheme_id = scheme_id
+                    break
+            self._label_scheme_id_to_scheme_id[label.scheme_id] = matching_scheme_id
+
+        return self._label_scheme_id_to_scheme_id[label.scheme_id]
+
+    def get_code_for_label(self, label):
+        """
+        Gets the code that the given label refers to.
+
+        :param label: Label to get the code of.
+        :type label: core_data_modules.data_models.Label
+        :return: Code for this label.
+        :rtype: IndexedCode
+        """
+        scheme_id = self.get_scheme_id_for_label(label)
+        assert scheme_id is not None, f"Label has scheme_id {label.scheme_id}, but this is not present in any of " \
+                                      f"the given code schemes."
+
+        code = self._codes[scheme_id].get(label.code_id)
+        assert code is not None, f"Label has code_id {label.code_id}, but this is not present in code scheme " \
+                                 f"{scheme_id}."
+        return code
+
+
+def load_code_scheme_index(code_schemes_dir, cache=None, dry_run=False):
+    """
+    Loads a CodeSchemeIndex of all the code schemes in the given directory (searched recursively).
+
+    If a cache is provided and it contains an index compiled from files with the same paths and modification times as
+    those currently in `code_schemes_dir`, the cached index is used. Otherwise, the index is compiled from the files and,
+    unless this is a dry run, written to the cache.
+
+    :param code_schemes_dir: Directory containing the code scheme json files to index.
+    :type code_schemes_dir: str
+    :param cache: Cache to read/write the compiled index from/to, or None.
+    :type cache: src.engagement_db_to_rapid_pro.cache.EngagementDBToRapidProCache | None
+    :param dry_run: Whether to perform a dry run. If True, the compiled index is not written to the cache.
+    :type dry_run: bool
+    :return: Index of the code schemes in `code_schemes_dir`.
+    :rtype: CodeSchemeIndex
+    """
+    code_scheme_file_paths = glob.glob(f"{code_schemes_dir}/**/*.json", recursive=True)
+    source_file_mtimes = {file_path: path.getmtime(file_path) for file_path in code_scheme_file_paths}
+
+    if cache is not None:
+        cached_index = cache.get_code_scheme_index(source_file_mtimes)
+        if cached_index is not None:
+            log.info(f"Loaded compiled index of {len(cached_index.scheme_ids)} code schemes from the cache")
+            return cached_index
+
+    log.info(f"Compiling an index of the code schemes in {len(code_scheme_file_paths)} files...")
+    index = CodeSchemeIndex.from_code_scheme_files(code_scheme_file_paths)
+    log.info(f"Compiled an index of {len(index.scheme_ids)} code schemes")
+
+    if cache is not None and not dry_run:
+        cache.set_code_scheme_index(source_file_mtimes, index)
+
+    return index
@@ -42,7 +42,8 @@ class DatasetConfiguration:
 @dataclass
 class EngagementDBToRapidProConfiguration:
     def __init__(self, allow_clearing_fields, write_mode=WriteModes.SHOW_PRESENCE,  normal_datasets=None,
-                 consent_withdrawn_dataset=None, weekly_advert_contact_field=None, sync_advert_contacts=False):
+                 consent_withdrawn_dataset=None, weekly_advert_contact_field=None, sync_advert_contacts=False,
+                 contact_update_batch_size=100, max_concurrent_contact_updates=4):
         """
         Configuration for syncing an engagement database to a Rapid Pro workspace.
 
@@ -96,6 +97,14 @@ class EngagementDBToRapidProConfiguration:
                                      It also runs from the rapid pro -> analysis sync, not from this sync.
                                      TODO: Fix this layering violation.
         :type sync_advert_contacts: bool
+        :param contact_update_batch_size: Number of participants to re-identify and update in Rapid Pro in each batch.
+                                          Progress is written to the incremental cache after each batch completes,
+                                          so this also controls how much work is repeated after a crash.
+        :type contact_update_batch_size: int
+        :param max_concurrent_contact_updates: Maximum number of Rapid Pro contact updates to have in flight at once.
+                                               Rapid Pro rate limits are per workspace, so increasing this beyond a
+                                               handful of workers is unlikely to help.
+        :type max_concurrent_contact_updates: int
         """
         self.allow_clearing_fields = allow_clearing_fields
         self.normal_datasets = normal_datasets
@@ -103,3 +112,5 @@ class EngagementDBToRapidProConfiguration:
         self.weekly_advert_contact_field = weekly_advert_contact_field
         self.write_mode = write_mode
         self.sync_advert_contacts = sync_advert_contacts
+        self.contact_update_batch_size = contact_update_batch_size
+        self.max_concurrent_contact_updates = max_concurrent_contact_updates
@@ -1,13 +1,14 @@
-import glob
 import json
 from collections import defaultdict
 
 from core_data_modules.cleaners import Codes
-from core_data_modules.data_models import CodeScheme
 from core_data_modules.logging import Logger
+from core_data_modules.util import SHAUtils
 
-from src.common.cache import Cache
 from src.common.get_messages_in_datasets import get_messages_in_datasets
+from src.common.update_rapid_pro_contacts import update_rapid_pro_contacts
+from src.engagement_db_to_rapid_pro.cache import EngagementDBToRapidProCache
+from src.engagement_db_to_rapid_pro.code_scheme_index import load_code_scheme_index
 from src.engagement_db_to_rapid_pro.configuration import WriteModes
 
 log = Logger(__name__)
@@ -59,14 +60,68 @@ def _get_all_messages(engagement_db, sync_config, cache=None):
     return messages
 
 
-def _get_normal_contact_fields_for_participant(participant_messages, sync_config):
+def _get_dataset_to_normal_dataset_config_indices(sync_config):
     """
-    Gets the normal contact fields for a given participant and sync configuration.
+    :param sync_config: Sync config to index.
+    :type sync_config: src.engagement_db_to_rapid_pro.configuration.EngagementDBToRapidProConfiguration
+    :return: Dictionary of engagement db dataset -> indices of the `sync_config.normal_datasets` that dataset is in.
+             Each index is listed once, in ascending order, even if a dataset is listed more than once in the same
+             dataset configuration.
+    :rtype: dict of str -> list of int
+    """
+    dataset_to_normal_dataset_config_indices = defaultdict(list)
+    if sync_config.normal_datasets is not None:
+        for i, dataset_config in enumerate(sync_config.normal_datasets):
+            for engagement_db_dataset in set(dataset_config.engagement_db_datasets):
+                dataset_to_normal_dataset_config_indices[engagement_db_dataset].append(i)
+    return dataset_to_normal_dataset_config_indices
+
+
+def _group_participant_messages(participant_messages, sync_config, dataset_to_normal_dataset_config_indices):
+    """
+    Groups a participant's messages by the dataset configurations they need to be synced under, in a single pass over
+    the messages.
 
     :param participant_messages: All messages from the participant to process.
     :type participant_messages: list of engagement_database.data_models.Message
     :param sync_config: Sync config defining which messages to get.
     :type sync_config: src.engagement_db_to_rapid_pro.configuration.EngagementDBToRapidProConfiguration
+    :param dataset_to_normal_dataset_config_indices: Dictionary of engagement db dataset -> indices of the
+                                                     `sync_config.normal_datasets` that dataset is in, as returned by
+                                                     `_get_dataset_to_normal_dataset_config_indices`.
+    :type dataset_to_normal_dataset_config_indices: dict of str -> list of int
+    :return: Tuple of:
+              1. The messages with text in each of the `sync_config.normal_datasets`, in the same order as
+                 `sync_config.normal_datasets`.
+              2. The messages in the `sync_config.consent_withdrawn_dataset`.
+             Messages within each group are in the same order as in `participant_messages`.
+    :rtype: (list of (list of engagement_database.data_models.Message),
+             list of engagement_database.data_models.Message)
+    """
+    normal_dataset_messages = [[] for _ in (sync_config.normal_datasets or [])]
+    consent_withdrawn_datasets = set() if sync_config.consent_withdrawn_dataset is None else \
+        set(sync_config.consent_withdrawn_dataset.engagement_db_datasets)
+    consent_withdrawn_messages = []
+
+    for msg in participant_messages:
+        if msg.text is not None:
+            for i in dataset_to_normal_dataset_config_indices.get(msg.dataset, []):
+                normal_dataset_messages[i].append(msg)
+        if msg.dataset in consent_withdrawn_datasets:
+            consent_withdrawn_messages.append(msg)
+
+    return normal_dataset_messages, consent_withdrawn_messages
+
+
+def _get_normal_contact_fields_for_participant(normal_dataset_messages, sync_config):
+    """
+    Gets the normal contact fields for a given participant and sync configuration.
+
+    :param normal_dataset_messages: The participant's messages with text in each of the `sync_config.normal_datasets`,
+                                    as returned by `_group_participant_messages`.
+    :type normal_dataset_messages: list of (list of engagement_database.data_models.Message)
+    :param sync_config: Sync config defining which messages to get.
+    :type sync_config: src.engagement_db_to_rapid_pro.configuration.EngagementDBToRapidProConfiguration
     :return: Dictionary of Rapid Pro contact field id -> value.
     :rtype: dict of str -> str
     """
@@ -74,13 +129,7 @@ def _get_normal_contact_fields_for_participant(participant_messages, sync_config
         return dict()
 
     contact_fields = dict()
-    for dataset_config in sync_config.normal_datasets:
-        # Find all the messages from this participant in this dataset
-        dataset_messages = []
-        for msg in participant_messages:
-            if msg.dataset in dataset_config.engagement_db_datasets and msg.text is not None:
-                dataset_messages.append(msg)
-
+    for dataset_config, dataset_messages in zip(sync_config.normal_datasets, normal_dataset_messages):
         # If there are no messages in this dataset, either clear the contact field if we're allowed to, or simply skip
         # this dataset if not.
         # (We might not be able to be allowed to clear the field because doing so could cause synchronisation problems
@@ -104,16 +153,18 @@ def _get_normal_contact_fields_for_participant(participant_messages, sync_config
     return contact_fields
 
 
-def _get_consent_withdrawn_field_for_participant(participant_messages, sync_config, code_schemes):
+def _get_consent_withdrawn_field_for_participant(consent_withdrawn_messages, sync_config, code_scheme_index):
     """
     Gets the consent_withdrawn contact field for a given participant and sync configuration.
 
-    :param participant_messages: All messages from the participant to process.
-    :type participant_messages: list of engagement_database.data_models.Message
+    :param consent_withdrawn_messages: The participant's messages in the `sync_config.consent_withdrawn_dataset`, as
+                                       returned by `_group_participant_messages`.
+    :type consent_withdrawn_messages: list of engagement_database.data_models.Message
     :param sync_config: Sync config defining which messages to get.
     :type sync_config: src.engagement_db_to_rapid_pro.configuration.EngagementDBToRapidProConfiguration
-    :param code_schemes: Project code schemes (used to decode the labels to identify consent withdrawn messages).
-    :type code_schemes: list of core_data_modules.data_models.CodeScheme
+    :param code_scheme_index: Index of the project code schemes (used to decode the labels to identify consent
+                              withdrawn messages).
+    :type code_scheme_index: src.engagement_db_to_rapid_pro.code_scheme_index.CodeSchemeIndex
     :return: Dictionary of Rapid Pro contact field id -> value.
     :rtype: dict of str -> str
     """
@@ -121,13 +172,12 @@ def _get_consent_withdrawn_field_for_participant(participant_messages, sync_conf
         return dict()
 
     all_labels = []
-    for msg in participant_messages:
-        if msg.dataset in sync_config.consent_withdrawn_dataset.engagement_db_datasets:
-            all_labels.extend(msg.get_latest_labels())
+    for msg in consent_withdrawn_messages:
+        all_labels.extend(msg.get_latest_labels())
 
     contact_fields = dict()
     consent_withdrawn_contact_field = sync_config.consent_withdrawn_dataset.rapid_pro_contact_field
-    if _labels_contain_consent_withdrawn(all_labels, code_schemes):
+    if _labels_contain_consent_withdrawn(all_labels, code_scheme_index):
         contact_fields[consent_withdrawn_contact_field.key] = "yes"
     elif sync_config.allow_clearing_fields:
         contact_fields[consent_withdrawn_contact_field.key] = ""
@@ -153,79 +203,106 @@ def _ensure_rapid_pro_has_contact_fields(rapid_pro, contact_fields, dry_run=Fals
             rapid_pro.create_field(field_id=contact_field.key, label=contact_field.label)
 
 
-def _code_scheme_for_label(label, code_schemes):
-    for code_scheme in code_schemes:
-        if label.scheme_id.startswith(code_scheme.scheme_id):
-            return code_scheme
+def _labels_contain_consent_withdrawn(labels, code_scheme_index):
+    """
+    :param labels: Labels to check for consent withdrawn code.
+    :type labels: list of core_data_modules.data_models.Label
+    :param code_scheme_index: Index of the project code schemes.
+    :type code_scheme_index: src.engagement_db_to_rapid_pro.code_scheme_index.CodeSchemeIndex
+    :return: Whether any of the given labels contain a code with code id 'STOP'.
+    :rtype: bool
+    """
+    for label in labels:
+        if code_scheme_index.get_code_for_label(label).control_code == Codes.STOP:
+            return True
+
+    return False
 
 
-def _merge_code_schemes(code_schemes):
+def _hash_contact_fields(contact_fields):
+    """
+    :param contact_fields: Dictionary of Rapid Pro contact field key -> value.
+    :type contact_fields: dict of str -> str
+    :return: Hash of the given contact fields, which is independent of the order of the keys in `contact_fields`.
+    :rtype: str
     """
-    Merges the given `code_schemes` into a single code scheme containing all the codes from the input `code_schemes`.
+    return SHAUtils.sha_string(json.dumps(contact_fields, sort_keys=True))
 
-    Fails if `len(code_schemes) == 0` or if any of the `code_schemes` have differing `scheme_id`s.
 
-    :param code_schemes: Code schemes to merge into one.
-    :type code_schemes: list of core_data_modules.data_models.CodeScheme
-    :return: `code_schemes` merged into a single code scheme containing all the codes.
-    :rtype: core_data_modules.data_models.CodeScheme
+def _sync_participants_to_rapid_pro(rapid_pro, uuid_table, participant_uuids, messages_by_participant, sync_config,
+                                    code_scheme_index, contact_fields_hashes, dry_run=False):
     """
-    assert len(code_schemes) > 0, len(code_schemes)
-
-    merged_code_scheme = code_schemes[0]
-    for code_scheme in code_schemes[1:]:
-        assert code_scheme.scheme_id == merged_code_scheme.scheme_id
-        # For each code in this code scheme, add it to the merged code scheme if it doesn't exist on that scheme yet.
-        # If it does exist, ensure the code is the same as the one that exists already.
-        for code in code_scheme.codes:
-            merged_code_ids = {c.code_id for c in merged_code_scheme.codes}
-            if code.code_id in merged_code_ids:
-                assert code == merged_code_scheme.get_code_with_code_id(code.code_id)
-                continue
+    Syncs a batch of participants to Rapid Pro, by recomputing their contact fields, re-identifying them in bulk,
+    and updating their contacts concurrently.
 
-            merged_code_scheme.codes.append(code)
+    Participants whose recomputed contact fields are identical to those last written to Rapid Pro (according to
+    `contact_fields_hashes`) are not re-identified or updated.
 
-    return merged_code_scheme
+    :param rapid_pro: Rapid Pro client to sync to.
+    :type rapid_pro: rapid_pro_tools.rapid_pro_client.RapidProClient
+    :param uuid_table: UUID table to use to re-identify the participants.
+    :type uuid_table: id_infrastructure.firestore_uuid_table.FirestoreUuidTable
+    :param participant_uuids: Uuids of the participants to sync.
+    :type participant_uuids: list of str
+    :param messages_by_participant: Dictionary of participant_uuid -> all messages from that participant.
+    :type messages_by_participant: dict of str -> list of engagement_database.data_models.Message
+    :param sync_config: Configuration for the sync.
+    :type sync_config: src.engagement_db_to_rapid_pro.configuration.EngagementDBToRapidProConfiguration
+    :param code_scheme_index: Index of the project code schemes (used to decode the labels to identify consent
+                              withdrawn messages).
+    :type code_scheme_index: src.engagement_db_to_rapid_pro.code_scheme_index.CodeSchemeIndex
+    :param contact_fields_hashes: Dictionary of participant_uuid -> hash of the contact fields last written to Rapid
+                                  Pro. This is updated in place with the hashes of the contact fields written here.
+    :type contact_fields_hashes: dict of str -> str
+    :param dry_run: Whether to perform a dry run.
+    :type dry_run: bool
+    :return: Dictionary of participant_uuid -> hash of the contact fields written, for each participant that was
+             updated in Rapid Pro.
+    :rtype: dict of str -> str
+    """
+    # Build a dictionary of contact_field -> value for all the latest values for each participant.
+    dataset_to_normal_dataset_config_indices = _get_dataset_to_normal_dataset_config_indices(sync_config)
+    uuid_to_contact_fields = dict()  # of participant_uuid -> (dict of contact field key -> value)
+    for participant_uuid in participant_uuids:
+        normal_dataset_messages, consent_withdrawn_messages = _group_participant_messages(
+            messages_by_participant[participant_uuid], sync_config, dataset_to_normal_dataset_config_indices
+        )
 
+        contact_fields = dict()
+        contact_fields.update(
+            _get_normal_contact_fields_for_participant(normal_dataset_messages, sync_config)
+        )
+        contact_fields.update(
+            _get_consent_withdrawn_field_for_participant(consent_withdrawn_messages, sync_config, code_scheme_index)
+        )
 
-def _merge_code_schemes_by_scheme_id(code_schemes):
-    """
-    Merges the given `code_schemes` such that those that share the same scheme_id are combined into one code scheme
-    that contains all the codes from the merged code schemes. Code schemes which have unique scheme_ids will be
-    included in the results unmodified.
-
-    :param code_schemes: Code schemes to merge by scheme_id.
-    :type code_schemes: list of core_data_modules.data_models.CodeScheme
-    :return: `code_schemes` merged by scheme_ids.
-    :rtype code_schemes: list of core_data_modules.data_models.CodeScheme
-    """
-    code_schemes_by_id = defaultdict(list)
-    for code_scheme in code_schemes:
-        code_schemes_by_id[code_scheme.scheme_id].append(code_scheme)
+        # TODO: Update special group membership status e.g listening groups
 
-    merged_code_schemes = []
-    for code_schemes in code_schemes_by_id.values():
-        merged_code_schemes.append(_merge_code_schemes(code_schemes))
-    return merged_code_schemes
+        uuid_to_contact_fields[participant_uuid] = contact_fields
 
+    # Only update the participants whose contact fields have changed since we last wrote them to Rapid Pro.
+    updated_contact_fields_hashes = dict()  # of participant_uuid -> contact fields hash
+    for participant_uuid, contact_fields in uuid_to_contact_fields.items():
+        contact_fields_hash = _hash_contact_fields(contact_fields)
+        if contact_fields_hashes.get(participant_uuid) != contact_fields_hash:
+            updated_contact_fields_hashes[participant_uuid] = contact_fields_hash
 
-def _labels_contain_consent_withdrawn(labels, code_schemes):
-    """
-    :param labels: Labels to check for consent withdrawn code.
-    :type labels: list of core_data_modules.data_models.Label
-    :param code_schemes: List of project code schemes.
-    :type code_schemes: iterable of core_data_modules.data_models.CodeScheme
-    :return: Whether any of the given labels contain a code with code id 'STOP'.
-    :rtype: bool
-    """
-    for label in labels:
-        code_scheme = _code_scheme_for_label(label, code_schemes)
-        assert code_scheme is not None, f"Label has scheme_id {label.scheme_id}, but this is not present in any of " \
-                                        f"the given code schemes."
-        if code_scheme.get_code_with_code_id(label.code_id).control_code == Codes.STOP:
-            return True
+    log.info(f"{len(updated_contact_fields_hashes)}/{len(participant_uuids)} participants in this batch have contact "
+             f"fields that differ from those last written to Rapid Pro")
+    if len(updated_contact_fields_hashes) == 0:
+        return updated_contact_fields_hashes
 
-    return False
+    # Re-identify the participants.
+    uuid_to_urn = uuid_table.uuid_to_data_batch(list(updated_contact_fields_hashes.keys()))
+
+    # Write the contact fields to rapid pro
+    urn_to_contact_fields = {uuid_to_urn[uuid]: uuid_to_contact_fields[uuid] for uuid in updated_contact_fields_hashes}
+    update_rapid_pro_contacts(
+        rapid_pro, urn_to_contact_fields, sync_config.max_concurrent_contact_updates, dry_run=dry_run
+    )
+
+    contact_fields_hashes.update(updated_contact_fields_hashes)
+    return updated_contact_fields_hashes
 
 
 def sync_engagement_db_to_rapid_pro(engagement_db, rapid_pro, uuid_table, sync_config, cache_path=None, dry_run=False):
@@ -252,20 +329,10 @@ def sync_engagement_db_to_rapid_pro(engagement_db, rapid_pro, uuid_table, sync_c
         log.warning(f"No `cache_path` provided. This tool will sync all relevant engagement db messages from all of time")
     else:
         log.info(f"Initialising engagement db -> rapid pro sync cache at '{cache_path}/engagement_db_to_rapid_pro'")
-        cache = Cache(f"{cache_path}/engagement_db_to_rapid_pro")
-
-    # Load all the project code schemes, so we can easily scan for STOP messages later.
-    code_schemes = []
-    for path in glob.glob("code_schemes/**/*.json", recursive=True):
-        with open(path) as f:
-            code_schemes.append(CodeScheme.from_firebase_map(json.load(f)))
+        cache = EngagementDBToRapidProCache(f"{cache_path}/engagement_db_to_rapid_pro")
 
-    # Some RQAs from projects that were run before this Engagement-Data-Pipeline infrastructure was created accidentally
-    # used the same scheme_id for different code_schemes between projects. Since this stage only uses code schemes
-    # to check for consent withdrawn status, handle this by merging impacted code_schemes into one for now.
-    # TODO: Edit the problematic code schemes in affected projects to give them all unique scheme ids, then
-    #       remove this workaround.
-    code_schemes = _merge_code_schemes_by_scheme_id(code_schemes)
+    # Load an index of all the project code schemes, so we can easily scan for STOP messages later.
+    code_scheme_index = load_code_scheme_index("code_schemes", cache, dry_run)
 
     # Get all the messages from the datasets we're interested in syncing, and group them by participant
     messages = _get_all_messages(engagement_db, sync_config, cache)
@@ -297,46 +364,73 @@ def sync_engagement_db_to_rapid_pro(engagement_db, rapid_pro, uuid_table, sync_c
         contact_fields_to_sync.append(sync_config.consent_withdrawn_dataset.rapid_pro_contact_field)
     _ensure_rapid_pro_has_contact_fields(rapid_pro, contact_fields_to_sync, dry_run)
 
+    # Load the hashes of the contact fields we last wrote to Rapid Pro for each participant, so we can skip updating
+    # participants whose contact fields haven't changed.
+    # Note this means that if a contact field is changed in Rapid Pro (e.g. by a flow) but the data in the engagement
+    # database that it is derived from has not changed, the contact field will not be reset by this sync.
+    contact_fields_hashes = dict()  # of participant_uuid -> contact fields hash
+    if cache is not None:
+        contact_fields_hashes = cache.get_contact_fields_hashes()
+        log.info(f"Loaded the contact fields hashes last written to Rapid Pro for {len(contact_fields_hashes)} "
+                 f"participants")
+        if not dry_run:
+            cache.set_contact_fields_hashes(contact_fields_hashes)
+
     # Sync each message to Rapid Pro, by recomputing the state of every participant.
+    # Participants are synced in batches. After each batch has been written to Rapid Pro, the last message that
+    # triggered the batch is checkpointed to the cache, because every message up to and including this one has now
+    # been synced.
     participants_synced_this_cycle = set()
+    participants_updated_this_cycle = 0
     non_deindentified_uuids = 0
+    batch_participant_uuids = []
+    batch_last_message = None
     for i, message in enumerate(messages_triggering_sync):
-        log.info(f"Syncing message {i + 1}/{len(messages_triggering_sync)}: {message.message_id}...")
         participant_uuid = message.participant_uuid
 
         if not participant_uuid.startswith(uuid_table._uuid_prefix):
             non_deindentified_uuids += 1
             continue
 
+        batch_last_message = message
         if participant_uuid in participants_synced_this_cycle:
-            log.info(f"Skipping this message because we've already synced participant_uuid {participant_uuid} in this "
-                     f"pipeline run")
-            if cache is not None and not dry_run:
-                cache.set_message("last_synced", message)
+            log.debug(f"Skipping message {message.message_id} because participant_uuid {participant_uuid} has already "
+                      f"been synced in this pipeline run")
             continue
 
-        # Build a dictionary of contact_field -> value for all the latest values for this participant.
-        contact_fields = dict()
-        contact_fields.update(
-            _get_normal_contact_fields_for_participant(messages_by_participant[participant_uuid], sync_config)
-        )
-        contact_fields.update(
-            _get_consent_withdrawn_field_for_participant(messages_by_participant[participant_uuid], sync_config, code_schemes)
-        )
-
-        # TODO: Update special group membership status e.g listening groups
-
-        # Re-identify the participant.
-        urn = uuid_table.uuid_to_data(participant_uuid)
-
-        # Write the contact fields to rapid pro
-        if not dry_run:
-            rapid_pro.update_contact(urn, contact_fields=contact_fields)
-
         participants_synced_this_cycle.add(participant_uuid)
+        batch_participant_uuids.append(participant_uuid)
+
+        if len(batch_participant_uuids) == sync_config.contact_update_batch_size:
+            log.info(f"Syncing a batch of {len(batch_participant_uuids)} participants, triggered by messages up to "
+                     f"{i + 1}/{len(messages_triggering_sync)}...")
+            updated_contact_fields_hashes = _sync_participants_to_rapid_pro(
+                rapid_pro, uuid_table, batch_participant_uuids, messages_by_participant, sync_config,
+                code_scheme_index, contact_fields_hashes, dry_run
+            )
+            participants_updated_this_cycle += len(updated_contact_fields_hashes)
+            if cache is not None and not dry_run:
+                cache.add_contact_fields_hashes(updated_contact_fields_hashes)
+                cache.set_message("last_synced", batch_last_message)
+            batch_participant_uuids = []
+            batch_last_message = None
+
+    if batch_last_message is not None:
+        if len(batch_participant_uuids) > 0:
+            log.info(f"Syncing a final batch of {len(batch_participant_uuids)} participants...")
+            updated_contact_fields_hashes = _sync_participants_to_rapid_pro(
+                rapid_pro, uuid_table, batch_participant_uuids, messages_by_participant, sync_config,
+                code_scheme_index, contact_fields_hashes, dry_run
+            )
+            participants_updated_this_cycle += len(updated_contact_fields_hashes)
+            if cache is not None and not dry_run:
+                cache.add_contact_fields_hashes(updated_contact_fields_hashes)
         if cache is not None and not dry_run:
-            cache.set_message("last_synced", message)
+            cache.set_message("last_synced", batch_last_message)
 
+    log.info(f"Synced {len(participants_synced_this_cycle)} participants, triggered by "
+             f"{len(messages_triggering_sync)} messages. Updated {participants_updated_this_cycle} of these in Rapid "
+             f"Pro; the rest had unchanged contact fields")
     log.warning(f"skipped syncing {non_deindentified_uuids} non deindentified uuids")
 
     log.info(f"Done")
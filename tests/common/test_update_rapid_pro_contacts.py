@@ -0,0 +1,54 @@
+import threading
+import time
+
+import pytest
+
+from src.common.update_rapid_pro_contacts import update_rapid_pro_contacts
+
+
+class FakeRapidProClient:
+    def __init__(self, failing_urn):
+        """
+        Rapid Pro client whose contact updates succeed, except for the update of `failing_urn`, which fails.
+        """
+        self.failing_urn = failing_urn
+        self.updated_urns = set()
+        self._lock = threading.Lock()
+
+    def update_contact(self, urn, contact_fields):
+        time.sleep(0.01)
+        if urn == self.failing_urn:
+            raise ConnectionError(f"Failed to update {urn}")
+        with self._lock:
+            self.updated_urns.add(urn)
+
+
+def test_update_rapid_pro_contacts_reports_every_update_that_succeeded_before_a_failure():
+    urns = [f"tel:+{i}" for i in range(50)]
+    rapid_pro = FakeRapidProClient(failing_urn=urns[5])
+    reported_urns = []
+
+    with pytest.raises(ConnectionError):
+        update_rapid_pro_contacts(
+            rapid_pro, {urn: {"field": "yes"} for urn in urns}, max_workers=4,
+            on_contact_updated=reported_urns.append
+        )
+
+    # Every contact that was updated in Rapid Pro is reported once, and the updates that hadn't started when the
+    # failure was raised are cancelled rather than sent.
+    assert sorted(reported_urns) == sorted(rapid_pro.updated_urns)
+    assert len(reported_urns) == len(set(reported_urns))
+    assert urns[5] not in reported_urns
+    assert len(rapid_pro.updated_urns) < len(urns) - 1
+
+
+def test_update_rapid_pro_contacts_reports_every_update():
+    urns = [f"tel:+{i}" for i in range(20)]
+    rapid_pro = FakeRapidProClient(failing_urn=None)
+    reported_urns = []
+
+    update_rapid_pro_contacts(
+        rapid_pro, {urn: {"field": "yes"} for urn in urns}, max_workers=4, on_contact_updated=reported_urns.append
+    )
+
+    assert sorted(reported_urns) == sorted(urns)
@@ -0,0 +1,193 @@
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from core_data_modules.analysis import engagement_counts, repeat_participations, theme_distributions, cross_tabs
+from core_data_modules.analysis.traffic_analysis import TrafficLabel
+from core_data_modules.cleaners import Codes
+from core_data_modules.cleaners.cleaning_utils import CleaningUtils
+from core_data_modules.data_models import CodeScheme
+from core_data_modules.data_models.code_scheme import CodeTypes
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src.engagement_db_to_analysis import automated_analysis
+from src.engagement_db_to_analysis.analysis_config_index import AnalysisConfigIndex
+from src.engagement_db_to_analysis.analysis_counts import AnalysisCounts
+from src.engagement_db_to_analysis.configuration import (AnalysisConfiguration, AnalysisDatasetConfiguration,
+                                                         CodingConfiguration, DatasetTypes)
+
+CODE_SCHEMES_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "code_schemes")
+START = datetime(2021, 4, 1, tzinfo=timezone.utc)
+
+
+def _load_code_scheme(fname):
+    with open(os.path.join(CODE_SCHEMES_DIR, f"{fname}.json")) as f:
+        return CodeScheme.from_firebase_map(json.load(f))
+
+
+def _labels(code_scheme, codes):
+    return [CleaningUtils.make_label_from_cleaner_code(code_scheme, code, "test").to_dict() for code in codes]
+
+
+def _random_labels(rng, code_scheme, max_normal_codes):
+    normal_codes = [code for code in code_scheme.codes if code.code_type == CodeTypes.NORMAL]
+    if rng.random() < 0.2:
+        return _labels(code_scheme, [code_scheme.get_code_with_control_code(
+            rng.choice([Codes.TRUE_MISSING, Codes.NOT_REVIEWED, Codes.NOT_CODED]))])
+    return _labels(code_scheme, rng.sample(normal_codes, rng.randint(1, max_normal_codes)))
+
+
+def _make_column_view_data(rqa_scheme, gender_scheme, participants=60):
+    """
+    Makes messages and participants column-view TracedData, where each value has been updated several times so that
+    reading the TracedData has to search its history.
+    """
+    rng = random.Random(0)
+    messages_by_column = []
+    participants_by_column = []
+    for i in range(participants):
+        consent_withdrawn = Codes.TRUE if rng.random() < 0.1 else Codes.FALSE
+        participant_uuid = f"avf-participant-uuid-{i}"
+        gender_labels = _random_labels(rng, gender_scheme, 1)
+
+        rqa_messages = []
+        for j in range(rng.randint(1, 3)):
+            rqa_messages.append({
+                "participant_uuid": participant_uuid,
+                "timestamp": (START + timedelta(days=rng.randint(0, 60))).isoformat(),
+                "rqa_s01e01_raw": f"message {i}-{j}",
+                "s01e01_labels": _random_labels(rng, rqa_scheme, 3),
+                "gender_raw": "gender",
+                "gender_labels": gender_labels
+            })
+
+        participant = {
+            "participant_uuid": participant_uuid,
+            "rqa_s01e01_raw": ";".join(msg["rqa_s01e01_raw"] for msg in rqa_messages),
+            "s01e01_labels": [label for msg in rqa_messages for label in msg["s01e01_labels"]],
+            "gender_raw": "gender",
+            "gender_labels": gender_labels
+        }
+
+        for column_view in rqa_messages + [participant]:
+            td = TracedData({"participant_uuid": participant_uuid}, Metadata("test", "test", "test"))
+            td.append_data({"consent_withdrawn": Codes.FALSE}, Metadata("test", "test", "test"))
+            for key, value in column_view.items():
+                td.append_data({key: value}, Metadata("test", "test", "test"))
+            if consent_withdrawn == Codes.TRUE:
+                td.append_data({
+                    "consent_withdrawn": Codes.TRUE,
+                    "s01e01_labels": _labels(rqa_scheme, [rqa_scheme.get_code_with_control_code(Codes.STOP)]),
+                    "gender_labels": _labels(gender_scheme, [gender_scheme.get_code_with_control_code(Codes.STOP)])
+                }, Metadata("test", "test", "test"))
+
+            if column_view is participant:
+                participants_by_column.append(td)
+            else:
+                messages_by_column.append(td)
+
+    return messages_by_column, participants_by_column
+
+
+def _run_exporters(messages_by_column, participants_by_column, analysis_config, export_dir_path):
+    config_index = AnalysisConfigIndex(analysis_config.dataset_configurations)
+    analysis_counts = AnalysisCounts(config_index, "consent_withdrawn", analysis_config.cross_tabs)
+    analysis_counts.add_messages(messages_by_column)
+    analysis_counts.add_participants(participants_by_column)
+    data = automated_analysis._AutomatedAnalysisData(
+        messages_by_column, participants_by_column, analysis_counts, analysis_config, config_index, export_dir_path,
+        regression_workers=1, map_workers=1, cache=None, export_large_files=False
+    )
+    for exporter in automated_analysis._get_exporters(analysis_config, export_large_files=False):
+        # Seed the global random number generator before each exporter, in case it samples.
+        random.seed(0)
+        exporter(data)
+
+    exported_files = dict()  # of file name -> file contents
+    for file_name in sorted(os.listdir(export_dir_path)):
+        with open(os.path.join(export_dir_path, file_name)) as f:
+            exported_files[file_name] = f.read()
+    return exported_files
+
+
+def _make_analysis_config(rqa_scheme, gender_scheme):
+    return AnalysisConfiguration(
+        dataset_configurations=[
+            AnalysisDatasetConfiguration(["s01e01"], DatasetTypes.RESEARCH_QUESTION_ANSWER, "rqa_s01e01_raw",
+                                         [CodingConfiguration(rqa_scheme, "s01e01")]),
+            AnalysisDatasetConfiguration(["gender"], DatasetTypes.DEMOGRAPHIC, "gender_raw",
+                                         [CodingConfiguration(gender_scheme, "gender")])
+        ],
+        ws_correct_dataset_code_scheme=None,
+        cross_tabs=[("s01e01", "gender")],
+        traffic_labels=[
+            TrafficLabel(START, START + timedelta(days=30), "April"),
+            TrafficLabel(START + timedelta(days=30), START + timedelta(days=61), "May")
+        ]
+    )
+
+
+def test_analyses_of_column_view_values_match_analyses_of_traced_data(tmp_path):
+    rqa_scheme = _load_code_scheme("s01e01")
+    gender_scheme = _load_code_scheme("gender")
+    analysis_config = _make_analysis_config(rqa_scheme, gender_scheme)
+    messages_by_column, participants_by_column = _make_column_view_data(rqa_scheme, gender_scheme)
+
+    os.makedirs(f"{tmp_path}/traced_data")
+    traced_data_files = _run_exporters(
+        messages_by_column, participants_by_column, analysis_config, f"{tmp_path}/traced_data"
+    )
+    os.makedirs(f"{tmp_path}/values")
+    values_files = _run_exporters(
+        automated_analysis._read_column_view_values(messages_by_column),
+        automated_analysis._read_column_view_values(participants_by_column),
+        analysis_config, f"{tmp_path}/values"
+    )
+
+    assert sorted(traced_data_files.keys()) == [
+        "cross_tabs_s01e01_vs_gender.csv", "demographic_distributions.csv", "engagement_counts.csv",
+        "repeat_participations.csv", "sample_messages.csv", "theme_distributions.csv", "traffic_analysis.csv"
+    ]
+    assert values_files == traced_data_files
+
+
+def test_analysis_counts_exports_match_core_data_modules_exports(tmp_path):
+    rqa_scheme = _load_code_scheme("s01e01")
+    gender_scheme = _load_code_scheme("gender")
+    analysis_config = _make_analysis_config(rqa_scheme, gender_scheme)
+    messages_by_column, participants_by_column = _make_column_view_data(rqa_scheme, gender_scheme)
+    messages_by_column = automated_analysis._read_column_view_values(messages_by_column)
+    participants_by_column = automated_analysis._read_column_view_values(participants_by_column)
+
+    os.makedirs(f"{tmp_path}/analysis_counts")
+    analysis_counts_files = _run_exporters(
+        messages_by_column, participants_by_column, analysis_config, f"{tmp_path}/analysis_counts"
+    )
+
+    config_index = AnalysisConfigIndex(analysis_config.dataset_configurations)
+    rqa_column_configs = config_index.rqa_column_configs
+    demog_column_configs = config_index.demog_column_configs
+    core_data_modules_exporters = {
+        "engagement_counts.csv": lambda f: engagement_counts.export_engagement_counts_csv(
+            messages_by_column, participants_by_column, "consent_withdrawn", rqa_column_configs, f
+        ),
+        "repeat_participations.csv": lambda f: repeat_participations.export_repeat_participations_csv(
+            participants_by_column, "consent_withdrawn", rqa_column_configs, f
+        ),
+        "theme_distributions.csv": lambda f: theme_distributions.export_theme_distributions_csv(
+            participants_by_column, "consent_withdrawn", rqa_column_configs, demog_column_configs, f
+        ),
+        "demographic_distributions.csv": lambda f: theme_distributions.export_theme_distributions_csv(
+            participants_by_column, "consent_withdrawn", demog_column_configs, [], f
+        ),
+        "cross_tabs_s01e01_vs_gender.csv": lambda f: cross_tabs.export_cross_tabs_csv(
+            participants_by_column, "consent_withdrawn", config_index.get_column_config_for_dataset_name("s01e01"),
+            config_index.get_column_config_for_dataset_name("gender"), f
+        )
+    }
+    for file_name, export in core_data_modules_exporters.items():
+        with open(f"{tmp_path}/{file_name}", "w") as f:
+            export(f)
+        with open(f"{tmp_path}/{file_name}") as f:
+            assert analysis_counts_files[file_name] == f.read(), file_name
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.engagement_db_to_analysis import google_drive_upload
+
+FOLDER = "application/vnd.google-apps.folder"
+
+
+class _Request:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self):
+        return self._result
+
+
+class FakeDriveService:
+    """
+    In-memory Google Drive, supporting the queries made by `google_drive_upload` and uploads made by a fake
+    `drive_client_wrapper` that resolves folder paths in the same way as the real one.
+    """
+    def __init__(self):
+        self.items = dict()  # of id -> file/folder dict
+        self._next_id = 0
+        self.created_folders = []
+        self.uploads = []  # of (target dir, list of file names) for each batch upload
+
+    def add(self, name, parent_id=None, md5=None, folder=False):
+        item_id = f"id-{self._next_id}"
+        self._next_id += 1
+        self.items[item_id] = {
+            "id": item_id, "name": name, "mimeType": FOLDER if folder else "text/csv",
+            "parents": [] if parent_id is None else [parent_id], "sharedWithMe": parent_id is None,
+            "md5Checksum": md5
+        }
+        return item_id
+
+    def files(self):
+        return self
+
+    def list(self, q, fields, pageToken=None, **kwargs):
+        name = re.search(r"name = '([^']*)'", q)
+        parent = re.search(r"'([^']*)' in parents", q)
+        files = [
+            item for item in self.items.values()
+            if (name is None or item["name"] == name.group(1))
+            and ("mimeType" not in q or item["mimeType"] == FOLDER)
+            and ("sharedWithMe" not in q or item["sharedWithMe"])
+            and (parent is None or parent.group(1) in item["parents"])
+        ]
+        return _Request({"files": [dict(f) for f in files]})
+
+    def create(self, body, fields, **kwargs):
+        folder_id = self.add(body["name"], body["parents"][0], folder=True)
+        self.created_folders.append(body["name"])
+        return _Request({"id": folder_id})
+
+    def _resolve_path(self, target_dir):
+        folder_id = None
+        for folder_name in target_dir.split("/"):
+            folders = [
+                item for item in self.items.values()
+                if item["name"] == folder_name and item["mimeType"] == FOLDER
+                and (item["sharedWithMe"] if folder_id is None else folder_id in item["parents"])
+            ]
+            if len(folders) == 0:
+                folder_id = self.add(folder_name, folder_id, folder=True)
+            else:
+                folder_id = folders[0]["id"]
+        return folder_id
+
+    def update_or_create_batch(self, source_file_paths, target_folder_path, **kwargs):
+        folder_id = self._resolve_path(target_folder_path)
+        for source_file_path in source_file_paths:
+            name = os.path.basename(source_file_path)
+            for item_id, item in list(self.items.items()):
+                if item["name"] == name and folder_id in item["parents"]:
+                    del self.items[item_id]
+            self.add(name, folder_id, md5=_md5(source_file_path))
+        self.uploads.append((target_folder_path, sorted(os.path.basename(p) for p in source_file_paths)))
+
+    def update_or_create(self, source_file_path, target_folder_path, **kwargs):
+        self.update_or_create_batch([source_file_path], target_folder_path)
+
+
+def _md5(file_path):
+    with open(file_path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+@pytest.fixture
+def drive(monkeypatch):
+    drive = FakeDriveService()
+    monkeypatch.setattr(google_drive_upload.drive_client_wrapper, "update_or_create_batch",
+                        drive.update_or_create_batch)
+    monkeypatch.setattr(google_drive_upload.drive_client_wrapper, "update_or_create", drive.update_or_create)
+    monkeypatch.setattr(google_drive_upload, "_credentials_info", {})
+    # Run the upload workers as threads in this process, so they use the fake Drive.
+    monkeypatch.setattr(
+        google_drive_upload, "ProcessPoolExecutor",
+        lambda max_workers, initializer, initargs, **kwargs: ThreadPoolExecutor(max_workers)
+    )
+    return drive
+
+
+def test_upload_files_skips_unchanged_files(drive, tmp_path):
+    shared_id = drive.add("project", folder=True)
+    unchanged = _write(f"{tmp_path}/unchanged.csv", "a")
+    changed = _write(f"{tmp_path}/changed.csv", "b")
+    new = _write(f"{tmp_path}/new.csv", "c")
+    drive.add("unchanged.csv", shared_id, md5=_md5(unchanged))
+    drive.add("changed.csv", shared_id, md5="stale")
+
+    google_drive_upload.upload_files(
+        [(unchanged, "project"), (changed, "project"), (new, "project")], drive_service=drive
+    )
+
+    assert drive.uploads == [("project", ["changed.csv", "new.csv"])]
+
+
+def test_upload_files_does_not_skip_files_in_ambiguous_folders(drive, tmp_path):
+    shared_id = drive.add("project", folder=True)
+    unchanged = _write(f"{tmp_path}/unchanged.csv", "a")
+    first_id = drive.add("analysis", shared_id, folder=True)
+    drive.add("unchanged.csv", first_id, md5=_md5(unchanged))
+    second_id = drive.add("analysis", shared_id, folder=True)
+    drive.add("unchanged.csv", second_id, md5="stale")
+
+    google_drive_upload.upload_files([(unchanged, "project/analysis")], drive_service=drive)
+
+    assert drive.uploads == [("project/analysis", ["unchanged.csv"])]
+
+
+def test_concurrent_upload_files_creates_each_folder_once(drive, tmp_path):
+    drive.add("project", folder=True)
+    uploads = []
+    for dataset in ["age", "gender", "location"]:
+        for i in range(3):
+            uploads.append((_write(f"{tmp_path}/maps/{dataset}/{i}.png", f"{dataset}-{i}"), f"project/maps/{dataset}"))
+
+    google_drive_upload.upload_files(uploads, max_concurrent_uploads=3, drive_service=drive)
+
+    assert drive.created_folders == ["maps", "age", "gender", "location"]
+    assert [item["name"] for item in drive.items.values() if item["mimeType"] == FOLDER] == \
+        ["project", "maps", "age", "gender", "location"]
+    assert sorted(drive.uploads) == [
+        (f"project/maps/{dataset}", ["0.png", "1.png", "2.png"]) for dataset in ["age", "gender", "location"]
+    ]
+
+    # Nothing has changed, so uploading again should skip every file.
+    drive.uploads = []
+    google_drive_upload.upload_files(uploads, max_concurrent_uploads=3, drive_service=drive)
+    assert drive.uploads == []
@@ -0,0 +1,30 @@
+from core_data_modules.traced_data import Metadata, TracedData
+
+from src.engagement_db_to_analysis import sharded_imputation
+
+
+def _make_high_volume_participant(messages=1000):
+    """
+    Makes column-view TracedData for a participant with many messages, where each message is appended to the
+    participant's history, as the column-view conversion does.
+    """
+    participant = TracedData({"participant_uuid": "avf-participant-uuid-0"}, Metadata("test", "test", "test"))
+    for i in range(messages):
+        message = TracedData(
+            {"participant_uuid": "avf-participant-uuid-0", "text": f"message {i}"}, Metadata("test", "test", "test")
+        )
+        participant.append_traced_data(f"message_{i}", message, Metadata("test", "test", "test"))
+        participant.append_data({"latest_text": f"message {i}"}, Metadata("test", "test", "test"))
+    return participant
+
+
+def test_serialized_traced_data_round_trips_high_volume_participant():
+    participant = _make_high_volume_participant()
+
+    deserialized = sharded_imputation._deserialize_traced_data(
+        sharded_imputation._serialize_traced_data([participant])
+    )
+
+    assert len(deserialized) == 1
+    assert dict(deserialized[0].items()) == dict(participant.items())
+    assert deserialized[0].get_history("latest_text") == participant.get_history("latest_text")
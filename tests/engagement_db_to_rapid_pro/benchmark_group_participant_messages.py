@@ -0,0 +1,97 @@
+"""
+Benchmarks deriving each participant's normal contact fields by grouping their messages in a single pass
+(`_group_participant_messages`), against the previous approach of scanning all of the participant's messages again for
+every dataset configuration, and checks that both derive the same contact fields.
+
+Run from the repository root with:
+
+    python tests/engagement_db_to_rapid_pro/benchmark_group_participant_messages.py
+"""
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+
+from src.engagement_db_to_rapid_pro.configuration import (ContactField, DatasetConfiguration,
+                                                          EngagementDBToRapidProConfiguration, WriteModes)
+from src.engagement_db_to_rapid_pro.engagement_db_to_rapid_pro import (_get_dataset_to_normal_dataset_config_indices,
+                                                                       _get_normal_contact_fields_for_participant,
+                                                                       _group_participant_messages)
+
+PARTICIPANTS = 500
+MESSAGES_PER_PARTICIPANT = 200
+DATASET_CONFIGS = 20
+
+
+def _make_sync_config():
+    normal_datasets = [
+        DatasetConfiguration([f"s01e{i:02}", f"s01e{i:02}_followup"], ContactField(f"s01e{i:02}", f"s01e{i:02}"))
+        for i in range(DATASET_CONFIGS)
+    ]
+    return EngagementDBToRapidProConfiguration(
+        allow_clearing_fields=True,
+        write_mode=WriteModes.CONCATENATE_TEXTS,
+        normal_datasets=normal_datasets,
+        consent_withdrawn_dataset=DatasetConfiguration(["age", "gender"], ContactField("consent", "consent"))
+    )
+
+
+def _make_participants_messages(rng):
+    datasets = [f"s01e{i:02}" for i in range(DATASET_CONFIGS)] + \
+               [f"s01e{i:02}_followup" for i in range(DATASET_CONFIGS)] + ["age", "gender"]
+    return [
+        [
+            SimpleNamespace(dataset=rng.choice(datasets), text=None if rng.random() < 0.1 else f"message {i}-{j}")
+            for j in range(MESSAGES_PER_PARTICIPANT)
+        ]
+        for i in range(PARTICIPANTS)
+    ]
+
+
+def _get_normal_contact_fields_by_scanning_per_dataset_config(participant_messages, sync_config):
+    """
+    Derives a participant's normal contact fields by scanning all of their messages for each dataset configuration, as
+    `engagement_db_to_rapid_pro` did before grouping the messages in a single pass.
+    """
+    normal_dataset_messages = []
+    for dataset_config in sync_config.normal_datasets:
+        normal_dataset_messages.append([
+            msg for msg in participant_messages
+            if msg.dataset in dataset_config.engagement_db_datasets and msg.text is not None
+        ])
+    return _get_normal_contact_fields_for_participant(normal_dataset_messages, sync_config)
+
+
+def main():
+    sync_config = _make_sync_config()
+    participants_messages = _make_participants_messages(random.Random(0))
+
+    start = time.perf_counter()
+    scanned_contact_fields = [
+        _get_normal_contact_fields_by_scanning_per_dataset_config(participant_messages, sync_config)
+        for participant_messages in participants_messages
+    ]
+    scan_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dataset_to_normal_dataset_config_indices = _get_dataset_to_normal_dataset_config_indices(sync_config)
+    grouped_contact_fields = []
+    for participant_messages in participants_messages:
+        normal_dataset_messages, _ = _group_participant_messages(
+            participant_messages, sync_config, dataset_to_normal_dataset_config_indices
+        )
+        grouped_contact_fields.append(_get_normal_contact_fields_for_participant(normal_dataset_messages, sync_config))
+    group_seconds = time.perf_counter() - start
+
+    assert grouped_contact_fields == scanned_contact_fields
+
+    print(f"{PARTICIPANTS} participants x {MESSAGES_PER_PARTICIPANT} messages, {DATASET_CONFIGS} dataset configs")
+    print(f"Scanning per dataset config: {scan_seconds:.3f}s")
+    print(f"Grouping in a single pass:   {group_seconds:.3f}s ({scan_seconds / group_seconds:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
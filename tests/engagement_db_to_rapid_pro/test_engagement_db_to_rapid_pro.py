@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+from src.engagement_db_to_rapid_pro.configuration import (ContactField, DatasetConfiguration,
+                                                          EngagementDBToRapidProConfiguration, WriteModes)
+from src.engagement_db_to_rapid_pro.engagement_db_to_rapid_pro import (_get_dataset_to_normal_dataset_config_indices,
+                                                                       _get_normal_contact_fields_for_participant,
+                                                                       _group_participant_messages)
+
+
+def test_dataset_listed_twice_in_a_dataset_config_groups_each_message_once():
+    sync_config = EngagementDBToRapidProConfiguration(
+        allow_clearing_fields=False,
+        write_mode=WriteModes.CONCATENATE_TEXTS,
+        normal_datasets=[
+            DatasetConfiguration(["s01e01", "s01e01"], ContactField("s01e01", "s01e01")),
+            DatasetConfiguration(["s01e01", "s01e02"], ContactField("s01e01_or_s01e02", "s01e01 or s01e02"))
+        ]
+    )
+    participant_messages = [
+        SimpleNamespace(dataset="s01e01", text="first"),
+        SimpleNamespace(dataset="s01e02", text="second")
+    ]
+
+    dataset_to_normal_dataset_config_indices = _get_dataset_to_normal_dataset_config_indices(sync_config)
+    assert dataset_to_normal_dataset_config_indices == {"s01e01": [0, 1], "s01e02": [1]}
+
+    normal_dataset_messages, _ = _group_participant_messages(
+        participant_messages, sync_config, dataset_to_normal_dataset_config_indices
+    )
+    assert _get_normal_contact_fields_for_participant(normal_dataset_messages, sync_config) == {
+        "s01e01": "\"first\" - engagement_db.s01e01",
+        "s01e01_or_s01e02": "\"first\" - engagement_db.s01e01; \"second\" - engagement_db.s01e02"
+    }